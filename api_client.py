@@ -0,0 +1,248 @@
+import asyncio
+import json
+import logging
+import os
+import random
+from dataclasses import dataclass, field
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Адрес сервера генерации
+API_BASE_URL = os.getenv("API_BASE_URL", "http://127.0.0.1:8000")
+# Сколько секунд сервер держит long-poll запрос статуса
+STATUS_LONG_POLL_SECONDS = 30
+
+# Таймауты по эндпоинтам, секунды
+ENDPOINT_TIMEOUTS = {
+    "submit": 30,
+    "status": STATUS_LONG_POLL_SECONDS + 30,  # с запасом на окно long-poll
+    "images": 60,
+    "generate": 300,
+    "generate_by_reference": 300,
+}
+DEFAULT_TIMEOUT = 60
+# Срок задачи на сервере для синхронной генерации — чуть меньше таймаута HTTP:
+# изображение, которое клиент уже не дождётся, сервер не генерирует
+SERVER_TIMEOUT_MARGIN = 10
+
+# Повторы на перегрузку сервера: не больше MAX_RETRIES, задержка растёт вдвое от RETRY_BASE_DELAY
+# со случайным джиттером; Retry-After сервера имеет приоритет
+RETRY_STATUSES = (429, 503)
+MAX_RETRIES = 3
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+
+# Одновременных запросов к серверу от одного бота
+MAX_CONCURRENT_REQUESTS = int(os.getenv("API_MAX_CONCURRENT_REQUESTS", "8"))
+# Пул соединений keep-alive
+POOL_LIMIT = 32
+KEEPALIVE_TIMEOUT = 60
+
+
+class ApiError(Exception):
+    """
+    Сервер ответил ошибкой (после всех повторов) или недоступен.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}" if status else message)
+        self.status = status
+        self.message = message
+
+
+def error_message(body):
+    # Текст ошибки из JSON {"detail": ...} сервера, иначе тело как есть
+    try:
+        detail = json.loads(body).get("detail")
+    except (ValueError, AttributeError):
+        return body[:500]
+    if isinstance(detail, dict):
+        return detail.get("message", str(detail))
+    return str(detail)
+
+
+def retry_delay(attempt, retry_after=None):
+    if retry_after is not None:
+        try:
+            return min(RETRY_MAX_DELAY, float(retry_after))
+        except ValueError:
+            pass
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+# Изображение из ответа сервера; variants — дополнительные выходы того же изображения (имя -> OutputImage)
+@dataclass
+class OutputImage:
+    filename: str
+    data: bytes
+    variants: dict = field(default_factory=dict)
+
+    def __iter__(self):
+        # Распаковка как пара (имя файла, байты)
+        return iter((self.filename, self.data))
+
+
+async def read_multipart_images(res):
+    """
+    Разбирает multipart/mixed ответ сервера в список OutputImage.
+    Части с заголовком X-Variant прикрепляются к предшествующему основному изображению.
+    """
+    images = []
+    reader = aiohttp.MultipartReader.from_response(res)
+    while True:
+        part = await reader.next()
+        if part is None:
+            break
+        if not part.headers.get(aiohttp.hdrs.CONTENT_TYPE, "").startswith("image/"):
+            continue
+        image = OutputImage(part.filename or f"image_{len(images)}.png", await part.read())
+        variant = part.headers.get("X-Variant")
+        if variant and images:
+            images[-1].variants[variant] = image
+        else:
+            images.append(image)
+    return images
+
+
+async def read_first_image(res):
+    """
+    Первое изображение multipart-ответа вместе с его вариантами.
+    """
+    images = await read_multipart_images(res)
+    if not images:
+        raise ApiError(res.status, "изображение не было возвращено")
+    return images[0]
+
+
+async def read_json(res):
+    return await res.json()
+
+
+class RetryableResponse:
+    """
+    Ответ 429/503, после которого запрос стоит повторить.
+    """
+
+    def __init__(self, status, message, retry_after):
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+
+class ApiClient:
+    """
+    Общий асинхронный клиент API генерации для ботов.
+    - Одна долгоживущая сессия aiohttp с пулом keep-alive соединений,
+      создаётся при первом запросе в event loop бота.
+    - Свой таймаут на каждый эндпоинт.
+    - Ограниченные повторы с джиттером на 429 и 503, а также при отказе в соединении.
+    - Не больше max_concurrency одновременных запросов; long-poll статуса
+      в лимит не входит — серверу он почти ничего не стоит.
+    """
+
+    def __init__(self, base_url=API_BASE_URL, max_concurrency=MAX_CONCURRENT_REQUESTS, max_retries=MAX_RETRIES):
+        self.base_url = base_url.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.session = None
+        self.slots = None
+
+    def _ensure_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=POOL_LIMIT, keepalive_timeout=KEEPALIVE_TIMEOUT)
+            self.session = aiohttp.ClientSession(connector=connector)
+            self.slots = asyncio.Semaphore(self.max_concurrency)
+        return self.session
+
+    async def request(self, endpoint, method, path, reader=read_json, json_body=None, form=None, params=None,
+                      limited=True):
+        """
+        Выполняет запрос и возвращает результат reader(response) для успешного ответа.
+        form — список (имя, значение[, имя файла, content type]); FormData собирается заново
+        на каждую попытку, потому что aiohttp не умеет отправлять её повторно.
+        """
+        session = self._ensure_session()
+        timeout = aiohttp.ClientTimeout(total=ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT))
+        url = f"{self.base_url}{path}"
+        for attempt in range(self.max_retries + 1):
+            data = None
+            if form is not None:
+                data = aiohttp.FormData()
+                for name, value, *file_info in form:
+                    if file_info:
+                        data.add_field(name, value, filename=file_info[0], content_type=file_info[1])
+                    else:
+                        data.add_field(name, str(value).lower() if isinstance(value, bool) else str(value))
+            try:
+                if limited:
+                    async with self.slots:
+                        result = await self._send(session, method, url, reader, timeout, json_body, data, params)
+                else:
+                    result = await self._send(session, method, url, reader, timeout, json_body, data, params)
+            except aiohttp.ClientConnectorError as e:
+                # Запрос не ушёл на сервер — повтор безопасен
+                if attempt == self.max_retries:
+                    raise ApiError(None, f"сервер недоступен: {e}")
+                delay = retry_delay(attempt)
+                logger.warning(f"{endpoint}: сервер недоступен, повтор через {delay:.1f} с")
+            else:
+                if not isinstance(result, RetryableResponse):
+                    return result
+                if attempt == self.max_retries:
+                    raise ApiError(result.status, result.message)
+                delay = retry_delay(attempt, result.retry_after)
+                logger.warning(f"{endpoint}: сервер ответил {result.status}, повтор через {delay:.1f} с")
+            await asyncio.sleep(delay)
+
+    async def _send(self, session, method, url, reader, timeout, json_body, data, params):
+        async with session.request(method, url, json=json_body, data=data, params=params, timeout=timeout) as res:
+            if res.status in RETRY_STATUSES:
+                return RetryableResponse(res.status, error_message(await res.text()), res.headers.get("Retry-After"))
+            if res.status != 200:
+                raise ApiError(res.status, error_message(await res.text()))
+            return await reader(res)
+
+    async def submit(self, prompt, num_images=1, **options):
+        """
+        Ставит задачу txt2img; возвращает её описание с task_id.
+        """
+        payload = {"prompt": prompt, "num_images": num_images, **options}
+        return await self.request("submit", "POST", "/submit", json_body=payload)
+
+    async def status(self, task_id, wait=STATUS_LONG_POLL_SECONDS):
+        """
+        Long-poll статуса: сервер отвечает сразу по завершении задачи или через wait секунд.
+        """
+        return await self.request("status", "GET", f"/status/{task_id}", params={"wait": wait}, limited=False)
+
+    async def images(self, task_id):
+        """
+        Все изображения завершённой задачи: список OutputImage.
+        """
+        return await self.request("images", "GET", f"/status/images/{task_id}", reader=read_multipart_images)
+
+    async def generate(self, prompt, **options):
+        """
+        Синхронная генерация одного изображения: OutputImage (распаковывается как (имя файла, байты)).
+        """
+        payload = {"prompt": prompt, "response_mode": "multipart",
+                   "timeout": ENDPOINT_TIMEOUTS["generate"] - SERVER_TIMEOUT_MARGIN, **options}
+        return await self.request("generate", "POST", "/generate", reader=read_first_image, json_body=payload)
+
+    async def generate_by_reference(self, prompt, image_bytes, content_type="image/png", **options):
+        """
+        Генерация по референсу: OutputImage.
+        """
+        options = {"timeout": ENDPOINT_TIMEOUTS["generate_by_reference"] - SERVER_TIMEOUT_MARGIN, **options}
+        form = [("prompt", prompt), ("image", bytes(image_bytes), "reference.png", content_type),
+                ("response_mode", "multipart")]
+        form += [(name, value) for name, value in options.items() if value is not None]
+        return await self.request("generate_by_reference", "POST", "/generate_by_reference",
+                                  reader=read_first_image, form=form)
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
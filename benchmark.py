@@ -0,0 +1,320 @@
+"""
+Бенчмарк пути генерации сервера.
+
+Поднимает server.py в отдельном процессе (или использует уже запущенный через --url),
+нагружает /generate и /generate_by_reference с 1..N одновременными клиентами и пишет JSON:
+- end-to-end задержку (mean / p50 / p95 / p99 / max) и изображения в секунду — со стороны клиента;
+- ожидание в очереди, инференс, апскейл и кодирование PNG — из /timings сервера;
+- пиковую память и скорость профиля памяти по размерам выхода — из /pipelines сервера.
+
+Бэкенды модели:
+- stub — заглушка без весов, каждый шаг стоит --step-ms миллисекунд;
+- tiny — маленькая случайно инициализированная модель диффузоров на CPU;
+- model — модель из MODEL_PATH на INFERENCE_DEVICE;
+- ray — маленькая модель в пуле Ray-акторов (--ray-actors) на локальном кластере, только CPU:
+  проверка пути Ray (USE_RAY=1) без GPU.
+
+Примеры:
+    python benchmark.py --backend stub --step-ms 20 --concurrency 1,2,4,8
+    python benchmark.py --backend tiny --requests 8 --output baseline.json
+    python benchmark.py --backend stub --compare baseline.json
+    python benchmark.py --backend model --endpoints generate --memory-profile offload --hires-scale 2
+    python benchmark.py --backend ray --ray-actors 2 --concurrency 1,2,4 --requests 8
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import aiohttp
+import numpy as np
+from PIL import Image
+
+# Маленькая случайно инициализированная SD-модель (скачивается с Hugging Face Hub)
+TINY_MODEL_PATH = "hf-internal-testing/tiny-stable-diffusion-pipe"
+# Сколько ждать, пока поднятый сервер загрузит модель
+SERVER_START_TIMEOUT = 600
+ENDPOINTS = ("generate", "generate_by_reference")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def pick(q):
+        return values[min(len(values) - 1, round(q * (len(values) - 1)))]
+
+    return {"mean": sum(values) / len(values), "p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99),
+            "max": values[-1]}
+
+
+def reference_png(size=(512, 512)):
+    gradient = np.linspace(0, 255, size[0], dtype=np.uint8)
+    array = np.stack([np.tile(gradient, (size[1], 1))] * 3, axis=-1)
+    buffer = io.BytesIO()
+    Image.fromarray(array).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def server_env(args, cache_dir):
+    env = dict(os.environ)
+    env.update({
+        "CACHE_DIR": cache_dir,
+        "USE_RAY": "1" if args.backend == "ray" else "0",
+        "PREVIEW_EVERY_STEPS": str(args.preview_every),
+        "BATCH_MAX_SIZE": str(args.batch_size),
+        "MEMORY_PROFILE": args.memory_profile,
+    })
+    if args.backend == "stub":
+        env.update({"PIPELINE_BACKEND": "stub", "STUB_STEP_MS": str(args.step_ms)})
+    elif args.backend == "tiny":
+        env.update({"PIPELINE_BACKEND": "diffusers", "MODEL_PATH": TINY_MODEL_PATH, "INFERENCE_DEVICE": "cpu"})
+    elif args.backend == "ray":
+        # RAY_ADDRESS пустой — сервер поднимает свой локальный кластер
+        env.update({"PIPELINE_BACKEND": "diffusers", "MODEL_PATH": TINY_MODEL_PATH, "RAY_ADDRESS": "",
+                    "RAY_DEVICE": "cpu", "RAY_ACTORS_PER_NODE": str(args.ray_actors)})
+    else:
+        env["PIPELINE_BACKEND"] = "diffusers"
+    return env
+
+
+def start_server(args, cache_dir):
+    """
+    Запускает server.py в отдельном процессе на свободном порту; возвращает процесс и адрес.
+    """
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        env=server_env(args, cache_dir),
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    return process, f"http://127.0.0.1:{port}"
+
+
+async def wait_server(session, url, process):
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Сервер завершился при старте с кодом {process.returncode}")
+        try:
+            async with session.get(f"{url}/ready") as res:
+                status = await res.json()
+                if res.status == 200:
+                    return status
+                if status.get("error"):
+                    raise RuntimeError(f"Сервер не загрузил модель: {status['error']}")
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError("Сервер не поднялся за отведённое время")
+
+
+async def request_once(session, url, endpoint, upscaler, reference, hires_scale=None):
+    # Уникальный промпт, чтобы не мерить кэши
+    prompt = f"benchmark {uuid.uuid4().hex}"
+    started = time.perf_counter()
+    if endpoint == "generate":
+        payload = {"prompt": prompt, "response_mode": "image", "upscaler": upscaler, "save_to_disk": False,
+                   "hires_scale": hires_scale}
+        request = session.post(f"{url}/generate", json=payload)
+    else:
+        form = aiohttp.FormData()
+        form.add_field("prompt", prompt)
+        form.add_field("image", reference, filename="reference.png", content_type="image/png")
+        form.add_field("response_mode", "image")
+        form.add_field("upscaler", upscaler)
+        form.add_field("save_to_disk", "false")
+        request = session.post(f"{url}/generate_by_reference", data=form)
+    async with request as res:
+        await res.read()
+        return res.status, time.perf_counter() - started
+
+
+async def run_level(session, url, endpoint, concurrency, total, upscaler, reference, hires_scale=None):
+    """
+    total запросов к endpoint, не больше concurrency одновременно.
+    """
+    async with session.delete(f"{url}/timings") as res:
+        res.raise_for_status()
+
+    queue = asyncio.Queue()
+    for _ in range(total):
+        queue.put_nowait(None)
+    latencies = []
+    statuses = {}
+
+    async def client():
+        while not queue.empty():
+            queue.get_nowait()
+            status, latency = await request_once(session, url, endpoint, upscaler, reference, hires_scale)
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 200:
+                latencies.append(latency)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+
+    async with session.get(f"{url}/timings") as res:
+        stages = await res.json()
+    async with session.get(f"{url}/pipelines") as res:
+        memory = (await res.json()).get("memory_profile")
+
+    result = {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": total,
+        "ok": len(latencies),
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "wall": wall,
+        "images_per_sec": len(latencies) / wall if wall else 0.0,
+        "latency": summarize(latencies),
+        "stages": stages,
+        "memory": memory,
+    }
+    p50 = result["latency"]["p50"] if result["latency"] else float("nan")
+    print(f"{endpoint:>22} c={concurrency:<3} {result['images_per_sec']:7.2f} img/s  p50 {p50:7.3f} s  "
+          f"ошибок {total - len(latencies)}")
+    return result
+
+
+async def run_benchmark(args):
+    process = None
+    url = args.url
+    cache_dir = tempfile.mkdtemp(prefix="bench_cache_")
+    if url is None:
+        process, url = start_server(args, cache_dir)
+
+    timeout = aiohttp.ClientTimeout(total=None)
+    connector = aiohttp.TCPConnector(limit=0)
+    try:
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            startup = await wait_server(session, url, process)
+            reference = reference_png()
+            # Прогрев: первый вызов собирает пайплайны и кэширует эмбеддинги
+            for endpoint in args.endpoints:
+                for _ in range(args.warmup):
+                    await request_once(session, url, endpoint, args.upscaler, reference, args.hires_scale)
+
+            runs = []
+            for endpoint in args.endpoints:
+                for concurrency in args.concurrency:
+                    total = max(args.requests, concurrency)
+                    runs.append(await run_level(session, url, endpoint, concurrency, total, args.upscaler, reference,
+                                                args.hires_scale))
+
+            async with session.get(f"{url}/pipelines") as res:
+                pipelines = await res.json()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "config": {
+            "backend": args.backend if args.url is None else "external",
+            "step_ms": args.step_ms if args.backend == "stub" else None,
+            "ray_actors": args.ray_actors if args.backend == "ray" else None,
+            "url": args.url,
+            "upscaler": args.upscaler,
+            "batch_size": args.batch_size,
+            "preview_every": args.preview_every,
+            "memory_profile": args.memory_profile,
+            "hires_scale": args.hires_scale,
+            "requests": args.requests,
+            "warmup": args.warmup,
+        },
+        "startup": startup,
+        "pipelines": pipelines,
+        "runs": runs,
+    }
+
+
+def compare(report, baseline):
+    """
+    Печатает изменение img/s и p50 задержки относительно прошлого прогона.
+    """
+    previous = {(run["endpoint"], run["concurrency"]): run for run in baseline["runs"]}
+    print(f"Сравнение с {baseline.get('timestamp')} ({baseline.get('commit')}):")
+    for run in report["runs"]:
+        old = previous.get((run["endpoint"], run["concurrency"]))
+        if old is None or not old["latency"] or not run["latency"]:
+            continue
+        throughput = (run["images_per_sec"] / old["images_per_sec"] - 1) * 100 if old["images_per_sec"] else 0.0
+        latency = (run["latency"]["p50"] / old["latency"]["p50"] - 1) * 100
+        print(f"{run['endpoint']:>22} c={run['concurrency']:<3} img/s {throughput:+6.1f}%  p50 {latency:+6.1f}%")
+
+
+def add_server_arguments(parser):
+    """
+    Параметры сервера, который поднимается для прогона (см. server_env), и адрес уже запущенного.
+    """
+    parser.add_argument("--backend", choices=("stub", "tiny", "model", "ray"), default="stub")
+    parser.add_argument("--step-ms", type=float, default=20.0, help="стоимость шага заглушки, мс")
+    parser.add_argument("--url", help="адрес уже запущенного сервера вместо запуска своего")
+    parser.add_argument("--batch-size", type=int, default=4, help="BATCH_MAX_SIZE сервера")
+    parser.add_argument("--preview-every", type=int, default=0, help="PREVIEW_EVERY_STEPS сервера")
+    parser.add_argument("--memory-profile", default="balanced", help="MEMORY_PROFILE сервера")
+    parser.add_argument("--ray-actors", type=int, default=2, help="акторов инференса для --backend ray")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарк задержки и пропускной способности server.py")
+    add_server_arguments(parser)
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    parser.add_argument("--concurrency", default="1,2,4,8", help="уровни одновременных клиентов через запятую")
+    parser.add_argument("--requests", type=int, default=16, help="запросов на каждый уровень")
+    parser.add_argument("--warmup", type=int, default=1, help="прогревочных запросов на эндпоинт")
+    parser.add_argument("--upscaler", default="cubic")
+    parser.add_argument("--hires-scale", type=float, help="латентный hires для /generate, например 2")
+    parser.add_argument("--output", help="куда записать JSON (по умолчанию benchmark_<время>.json)")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args()
+    args.endpoints = [endpoint for endpoint in args.endpoints.split(",") if endpoint]
+    unknown = set(args.endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"неизвестные эндпоинты: {', '.join(sorted(unknown))}")
+    args.concurrency = [int(level) for level in args.concurrency.split(",") if level]
+    return args
+
+
+def main():
+    args = parse_args()
+    report = asyncio.run(run_benchmark(args))
+    output = args.output or f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {output}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+import csv
+import io
+import json
+import logging
+import os
+import random
+import re
+import tarfile
+import time
+from dataclasses import dataclass
+
+from dataset_store import sanitize_filename
+
+logger = logging.getLogger("FastAPI")
+
+# Файлы каталога прогона
+CONFIG_NAME = "config.json"
+ROWS_NAME = "rows.jsonl"
+MANIFEST_NAME = "manifest.jsonl"
+# Форматы вывода: webdataset-архивы shard-NNNNNN.tar или дерево каталогов NNNNNN/
+OUTPUTS = ("tar", "directory")
+SHARD_PATTERN = re.compile(r"^shard-(\d{6})\.tar$")
+DIRECTORY_PATTERN = re.compile(r"^(\d{6})$")
+# Имя прогона — имя его каталога
+RUN_NAME_PATTERN = re.compile(r"^[\w-]{1,80}$")
+# Конец tar-архива: два пустых блока по 512 байт
+TAR_END = b"\0" * 1024
+
+# Параметры строки входного файла и их типы; пустые значения CSV считаются незаданными
+ROW_FIELDS = {
+    "prompt": str,
+    "key": str,
+    "seed": int,
+    "num_images": int,
+    "steps": int,
+    "guidance": float,
+    "scheduler": str,
+    "width": int,
+    "height": int,
+    "tier": str,
+    "hires_scale": float,
+    "hires_steps": int,
+    "hires_strength": float,
+    "model": str,
+}
+# Изображений на одну строку не больше
+MAX_IMAGES_PER_ROW = 16
+# Длина ключа: имена в USTAR-архиве не длиннее 100 символов
+MAX_KEY_LENGTH = 80
+
+
+class BulkError(ValueError):
+    """
+    Входной файл или каталог прогона некорректен.
+    """
+
+
+# Один образец прогона: изображение с подписью и параметрами генерации
+@dataclass(frozen=True)
+class Sample:
+    key: str
+    prompt: str
+    seed: int
+    params: tuple  # пары (параметр, значение) строки, кроме prompt, key, seed и num_images
+
+    def sampling(self):
+        return dict(self.params)
+
+
+def convert_row(raw, line):
+    unknown = set(raw) - set(ROW_FIELDS)
+    if unknown:
+        raise BulkError(f"Строка {line}: неизвестные поля {', '.join(sorted(unknown))}")
+    row = {}
+    for name, value in raw.items():
+        if value is None or value == "":
+            continue
+        try:
+            row[name] = ROW_FIELDS[name](value)
+        except (TypeError, ValueError):
+            raise BulkError(f"Строка {line}: некорректное значение {name}={value!r}")
+    if not row.get("prompt", "").strip():
+        raise BulkError(f"Строка {line}: пустой prompt")
+    if not 1 <= row.get("num_images", 1) <= MAX_IMAGES_PER_ROW:
+        raise BulkError(f"Строка {line}: num_images должно быть от 1 до {MAX_IMAGES_PER_ROW}")
+    return row
+
+
+def parse_rows(data, filename=""):
+    """
+    Разбирает JSONL (объект на строку) или CSV с заголовком; формат — по расширению файла,
+    без расширения — по первому символу. Возвращает нормализованные строки:
+    у каждой есть уникальный безопасный для имён файлов key и seed (случайный, если не задан),
+    поэтому повторный запуск прогона генерирует те же изображения.
+    """
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise BulkError("Файл должен быть в UTF-8")
+    extension = os.path.splitext(filename)[1].lower()
+    is_json = extension in (".jsonl", ".json", ".ndjson") or (extension != ".csv" and text.lstrip().startswith("{"))
+
+    raw_rows = []
+    if is_json:
+        for line, content in enumerate(text.splitlines(), start=1):
+            if not content.strip():
+                continue
+            try:
+                raw = json.loads(content)
+            except ValueError as e:
+                raise BulkError(f"Строка {line}: некорректный JSON ({e})")
+            if not isinstance(raw, dict):
+                raise BulkError(f"Строка {line}: ожидается JSON-объект")
+            raw_rows.append((line, raw))
+    else:
+        reader = csv.DictReader(io.StringIO(text))
+        if reader.fieldnames is None or "prompt" not in reader.fieldnames:
+            raise BulkError("В заголовке CSV нет колонки prompt")
+        # Номер строки файла с учётом заголовка
+        raw_rows = [(index + 2, raw) for index, raw in enumerate(reader)]
+    if not raw_rows:
+        raise BulkError("Файл не содержит ни одной строки")
+
+    rows, keys = [], set()
+    for index, (line, raw) in enumerate(raw_rows):
+        row = convert_row(raw, line)
+        key = sanitize_filename(row.get("key") or f"{index:06d}", limit=MAX_KEY_LENGTH)
+        if key in keys:
+            raise BulkError(f"Строка {line}: повторяющийся key {key}")
+        keys.add(key)
+        row["key"] = key
+        row.setdefault("seed", random.randrange(2 ** 32))
+        rows.append(row)
+    # Ключи <key>_<i> строк с несколькими изображениями не должны совпасть с чужими
+    sample_keys = [sample.key for sample in expand_samples(rows)]
+    if len(set(sample_keys)) != len(sample_keys):
+        raise BulkError("Ключи образцов повторяются: key строки совпадает с <key>_<NN> другой строки")
+    return rows
+
+
+def run_root(base_dir, name):
+    """
+    Каталог прогона name в base_dir; имя — буквы, цифры, '_' и '-', чтобы не выйти за base_dir.
+    """
+    if not RUN_NAME_PATTERN.match(name):
+        raise BulkError(f"Некорректное имя прогона: {name!r}")
+    return os.path.join(base_dir, name)
+
+
+def expand_samples(rows):
+    """
+    Образцы прогона: по num_images на строку, i-е изображение строки — с seed + i
+    и ключом <key>_<i> (без суффикса, если изображение одно).
+    """
+    samples = []
+    for row in rows:
+        count = row.get("num_images", 1)
+        params = tuple(sorted((name, value) for name, value in row.items()
+                              if name not in ("prompt", "key", "seed", "num_images")))
+        for i in range(count):
+            key = row["key"] if count == 1 else f"{row['key']}_{i:02d}"
+            samples.append(Sample(key=key, prompt=row["prompt"], seed=row["seed"] + i, params=params))
+    return samples
+
+
+class BulkRun:
+    """
+    Каталог прогона массовой генерации.
+    - config.json — параметры прогона, rows.jsonl — нормализованные строки с назначенными seed.
+    - manifest.jsonl — по строке на готовый образец; строка дописывается только после того,
+      как файлы образца записаны, поэтому манифест — это и чекпоинт: при возобновлении
+      готовые образцы пропускаются.
+    - output "tar": webdataset-архивы shard-NNNNNN.tar, в каждом <key>.<ext>, <key>.txt и <key>.json;
+      "directory": те же файлы в подкаталогах NNNNNN/.
+    - В шарде не больше shard_size образцов. Возобновлённый прогон пишет в новые шарды,
+      а недописанный tar обрезается до последнего образца из манифеста.
+    Методы записи синхронные и не потокобезопасные — вызываются из одного потока.
+    """
+
+    def __init__(self, root, config, rows):
+        self.root = root
+        self.config = config
+        self.rows = rows
+        self.done = {}  # key -> запись манифеста
+        self.manifest = None
+        self.shard = -1  # номер последнего шарда на диске
+        self.shard_count = None  # образцов в текущем шарде; None — шард в этом запуске ещё не открыт
+        self.tar_file = None
+        self.tar = None
+
+    @classmethod
+    def create(cls, root, rows, output="tar", shard_size=1000, **config):
+        if output not in OUTPUTS:
+            raise BulkError(f"Неизвестный формат вывода: {output}. Доступны: {', '.join(OUTPUTS)}")
+        if shard_size < 1:
+            raise BulkError("shard_size должно быть положительным")
+        if os.path.exists(os.path.join(root, CONFIG_NAME)):
+            raise FileExistsError(root)
+        os.makedirs(root, exist_ok=True)
+        config = {"output": output, "shard_size": shard_size, "created_at": time.time(), **config}
+        with open(os.path.join(root, ROWS_NAME), "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        with open(os.path.join(root, CONFIG_NAME), "w", encoding="utf-8") as f:
+            json.dump(config, f, ensure_ascii=False, indent=2)
+        return cls(root, config, rows)
+
+    @classmethod
+    def open(cls, root):
+        try:
+            with open(os.path.join(root, CONFIG_NAME), encoding="utf-8") as f:
+                config = json.load(f)
+            with open(os.path.join(root, ROWS_NAME), encoding="utf-8") as f:
+                rows = [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            raise BulkError(f"Прогон не найден: {root}")
+        return cls(root, config, rows)
+
+    @property
+    def output(self):
+        return self.config["output"]
+
+    def samples(self):
+        return expand_samples(self.rows)
+
+    def _shard_name(self, shard):
+        return f"shard-{shard:06d}.tar" if self.output == "tar" else f"{shard:06d}"
+
+    def _existing_shards(self):
+        pattern = SHARD_PATTERN if self.output == "tar" else DIRECTORY_PATTERN
+        return sorted(int(match.group(1)) for match in map(pattern.match, os.listdir(self.root)) if match)
+
+    def read_manifest(self):
+        """
+        Загружает готовые образцы из манифеста, ничего не меняя на диске.
+        Возвращает длину корректной части манифеста в байтах.
+        """
+        self.done = {}
+        valid_bytes = 0
+        path = os.path.join(self.root, MANIFEST_NAME)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Строка, оборванная на записи, — последняя; дальше её не читаем
+                        break
+                    self.done[entry["key"]] = entry
+                    valid_bytes += len(line)
+        return valid_bytes
+
+    def recover(self):
+        """
+        Читает манифест и приводит манифест и шарды в соответствие друг с другом после
+        прерванного прогона. Возвращает множество ключей готовых образцов.
+        """
+        valid_bytes = self.read_manifest()
+        path = os.path.join(self.root, MANIFEST_NAME)
+        if os.path.exists(path) and valid_bytes != os.path.getsize(path):
+            with open(path, "r+b") as f:
+                f.truncate(valid_bytes)
+
+        shards = self._existing_shards()
+        kept = []
+        for shard in shards:
+            name = self._shard_name(shard)
+            entries = [entry for entry in self.done.values() if entry["shard"] == name]
+            shard_path = os.path.join(self.root, name)
+            if self.output == "tar":
+                if not entries:
+                    os.remove(shard_path)
+                    continue
+                kept.append(shard)
+                # Обрезаем недописанный образец и закрываем архив заново
+                with open(shard_path, "r+b") as f:
+                    f.truncate(max(entry["end"] for entry in entries))
+                    f.seek(0, os.SEEK_END)
+                    f.write(TAR_END)
+            else:
+                known = {file for entry in entries for file in entry["files"]}
+                for entry in os.scandir(shard_path):
+                    if entry.name not in known:
+                        os.remove(entry.path)
+                kept.append(shard)
+        # Номера удалённых шардов без готовых образцов занимает продолжение прогона
+        self.shard = kept[-1] if kept else -1
+        if self.done:
+            logger.info(f"Прогон {self.root}: готово образцов — {len(self.done)}, продолжение с шарда {self.shard + 1}")
+        return set(self.done)
+
+    def _next_shard(self):
+        self._close_shard()
+        self.shard += 1
+        self.shard_count = 0
+        path = os.path.join(self.root, self._shard_name(self.shard))
+        if self.output == "tar":
+            self.tar_file = open(path, "wb")
+            self.tar = tarfile.open(fileobj=self.tar_file, mode="w", format=tarfile.USTAR_FORMAT)
+        else:
+            os.makedirs(path, exist_ok=True)
+
+    def _close_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.tar_file.close()
+            self.tar = self.tar_file = None
+        if self.manifest is not None:
+            self.manifest.flush()
+            os.fsync(self.manifest.fileno())
+
+    def write(self, sample, files, metadata=None):
+        """
+        Записывает файлы образца (расширение -> байты) в текущий шард и дописывает манифест.
+        """
+        if self.manifest is None:
+            self.manifest = open(os.path.join(self.root, MANIFEST_NAME), "a", encoding="utf-8")
+        if self.shard_count is None or self.shard_count >= self.config["shard_size"]:
+            self._next_shard()
+
+        names = [f"{sample.key}{extension}" for extension in files]
+        shard_name = self._shard_name(self.shard)
+        entry = {"key": sample.key, "shard": shard_name, "files": names, "seed": sample.seed}
+        if self.output == "tar":
+            now = time.time()
+            for name, data in zip(names, files.values()):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = now
+                info.mode = 0o644
+                self.tar.addfile(info, io.BytesIO(data))
+            self.tar_file.flush()
+            entry["end"] = self.tar.offset
+        else:
+            directory = os.path.join(self.root, shard_name)
+            for name, data in zip(names, files.values()):
+                with open(os.path.join(directory, name), "wb") as f:
+                    f.write(data)
+        if metadata:
+            entry.update(metadata)
+
+        self.manifest.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.manifest.flush()
+        self.done[sample.key] = entry
+        self.shard_count += 1
+        return entry
+
+    def close(self):
+        self._close_shard()
+        self.shard_count = None
+        if self.manifest is not None:
+            self.manifest.close()
+            self.manifest = None
+
+    def stats(self):
+        total = len(self.samples())
+        return {
+            "output": self.output,
+            "root": self.root,
+            "total": total,
+            "done": len(self.done),
+            "remaining": total - len(self.done),
+            "shards": len(self._existing_shards()),
+            "config": self.config,
+        }
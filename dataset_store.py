@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Имя файла манифеста в корне датасета
+MANIFEST_NAME = "manifest.sqlite"
+# Номер в имени файла: <base>_<NN>[suffix].<ext>
+NAME_PATTERN = re.compile(r"^(?P<base>.+)_(?P<number>\d{2,})(?P<suffix>_x\d+)?$")
+
+
+def sanitize_filename(text, limit=50):
+    """
+    Очищает строку от неподдерживаемых символов для имени файла.
+    - Убирает все символы, кроме букв, цифр, пробелов, и тире.
+    - Преобразует пробелы в подчеркивания.
+    - Обрезает строку до limit символов.
+    """
+    clean = re.sub(r'[^\w\s-]', '', text).strip().replace(' ', '_')
+    return clean[:limit] if clean else "image"
+
+
+def write_bytes(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def write_text(path, text):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+class DatasetStore:
+    """
+    Датасет пар «изображение + подпись» для ботов.
+    - Следующий номер для каждого базового имени хранится в памяти, выбор имени — O(1)
+      без проверок os.path.exists.
+    - Индекс восстанавливается при старте из манифеста SQLite; если манифеста ещё нет,
+      существующие файлы импортируются один раз.
+    - Файлы и манифест пишутся в пуле потоков, event loop бота не блокируется.
+    - shards > 0 раскладывает пары по подкаталогам 000..shards-1 по хэшу имени.
+    Каталог должен принадлежать одному процессу: индекс имён не делится между процессами.
+    """
+
+    def __init__(self, root, shards=0, workers=2):
+        self.root = root
+        self.shards = shards
+        self.counters = {}  # базовое имя -> последний выданный номер
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dataset")
+        os.makedirs(root, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(root, MANIFEST_NAME), check_same_thread=False)
+        self.db_lock = threading.Lock()
+        self._load_index()
+
+    def _load_index(self):
+        with self.db_lock:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "name TEXT PRIMARY KEY, base TEXT NOT NULL, number INTEGER NOT NULL, "
+                "image TEXT NOT NULL, caption TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            rows = self.db.execute("SELECT base, MAX(number) FROM entries GROUP BY base").fetchall()
+        self.counters = dict(rows)
+        if not rows:
+            self._import_existing()
+        logger.info(f"Датасет {self.root}: {len(self.counters)} базовых имён в индексе")
+
+    def _import_existing(self):
+        # Датасет, собранный до появления манифеста: один проход по каталогу вместо проверок на каждое имя
+        entries = []
+        for entry in os.scandir(self.root):
+            stem, extension = os.path.splitext(entry.name)
+            match = NAME_PATTERN.match(stem)
+            if not entry.is_file() or extension == ".txt" or match is None:
+                continue
+            base, number = match.group("base"), int(match.group("number"))
+            self.counters[base] = max(self.counters.get(base, 0), number)
+            caption = os.path.join(self.root, f"{stem}.txt")
+            entries.append((stem, base, number, entry.path, caption, entry.stat().st_mtime))
+        if entries:
+            with self.db_lock, self.db:
+                self.db.executemany("INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, ?, ?)", entries)
+            logger.info(f"В манифест импортировано существующих файлов: {len(entries)}")
+
+    def _directory(self, name):
+        if self.shards <= 0:
+            return self.root
+        shard = zlib.crc32(name.encode("utf-8")) % self.shards
+        directory = os.path.join(self.root, f"{shard:03d}")
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def allocate_name(self, base, suffix=""):
+        """
+        Выдаёт свободное имя <base>_<NN><suffix>. Вызывается из event loop, без обращений к диску.
+        """
+        number = self.counters.get(base, 0) + 1
+        self.counters[base] = number
+        return f"{base}_{number:02d}{suffix}", number
+
+    def _write(self, name, base, number, image_data, caption, extension):
+        directory = self._directory(name)
+        image_path = os.path.join(directory, f"{name}{extension}")
+        caption_path = os.path.join(directory, f"{name}.txt")
+        write_bytes(image_path, image_data)
+        write_text(caption_path, caption)
+        with self.db_lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                            (name, base, number, image_path, caption_path, time.time()))
+        return image_path
+
+    async def save(self, base, image_data, caption, suffix="", extension=".png"):
+        """
+        Сохраняет изображение и подпись под новым именем; возвращает (имя, путь к изображению).
+        """
+        base = sanitize_filename(base)
+        name, number = self.allocate_name(base, suffix)
+        loop = asyncio.get_running_loop()
+        path = await loop.run_in_executor(self.executor, self._write, name, base, number, image_data, caption,
+                                          extension)
+        return name, path
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        with self.db_lock:
+            self.db.close()
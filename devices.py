@@ -0,0 +1,203 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psutil
+
+logger = logging.getLogger("FastAPI")
+
+# dtype, которые можно запросить по имени (атрибуты torch); "auto" — по устройству (см. select_dtype)
+DTYPES = ("float16", "bfloat16", "float32")
+
+# Профили памяти: сочетания оптимизаций поверх оптимизаций устройства (см. optimize_pipelines).
+# - speed: ничего сверх оптимизаций устройства — быстрее всего, но больше всего памяти.
+# - balanced: VAE декодирует батч по одному изображению, а большие изображения — тайлами;
+#   на 512 px почти бесплатно, а hires-выходы перестают упираться в память на декодировании.
+# - low_vram: плюс attention slicing — UNet на больших размерах умещается в 4-6 ГБ, но медленнее.
+# - offload: плюс выгрузка моделей в RAM между использованиями (только CUDA) — минимум видеопамяти,
+#   ценой переноса весов на каждый батч.
+MEMORY_PROFILES = {
+    "speed": {},
+    "balanced": {"vae_slicing": True, "vae_tiling": True},
+    "low_vram": {"vae_slicing": True, "vae_tiling": True, "attention_slicing": True},
+    "offload": {"vae_slicing": True, "vae_tiling": True, "attention_slicing": True, "model_cpu_offload": True},
+}
+
+
+def resolve_device(requested="auto"):
+    """
+    Устройство инференса: "auto" — CUDA, если доступна, иначе CPU.
+    Явно запрошенная CUDA на машине без неё заменяется на CPU с предупреждением.
+    """
+    import torch
+
+    cuda = torch.cuda.is_available()
+    if requested == "auto":
+        return "cuda" if cuda else "cpu"
+    if torch.device(requested).type == "cuda" and not cuda:
+        logger.warning(f"CUDA недоступна, вместо {requested} используется CPU")
+        return "cpu"
+    return requested
+
+
+def select_dtype(device, requested="auto"):
+    """
+    dtype весов: на CUDA по умолчанию float16, на CPU — float32.
+    На CPU можно запросить bfloat16 (быстрее на процессорах с AVX512-BF16/AMX);
+    float16 на CPU не поддерживается большинством операций и заменяется на float32.
+    """
+    import torch
+
+    on_cpu = torch.device(device).type == "cpu"
+    if requested == "auto":
+        return torch.float32 if on_cpu else torch.float16
+    if requested not in DTYPES:
+        raise ValueError(f"Неизвестный dtype: {requested}. Доступны: auto, {', '.join(DTYPES)}")
+    if on_cpu and requested == "float16":
+        logger.warning("float16 на CPU не поддерживается, используется float32")
+        return torch.float32
+    return getattr(torch, requested)
+
+
+def configure_threads(intra_op=0, inter_op=0):
+    """
+    Потоки PyTorch на CPU: intra_op — внутри одной операции, inter_op — между независимыми операциями.
+    0 — оставить значение PyTorch по умолчанию. Вызывать до первого инференса:
+    число inter-op потоков после старта пула поменять нельзя.
+    """
+    import torch
+
+    if intra_op > 0:
+        torch.set_num_threads(intra_op)
+    if inter_op > 0:
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError as e:
+            logger.warning(f"Не удалось задать inter-op потоки: {e}")
+    logger.info(f"Потоки PyTorch: intra-op {torch.get_num_threads()}, inter-op {torch.get_num_interop_threads()}")
+
+
+def enable_compile_cache(cache_dir):
+    """
+    Постоянный кэш torch.compile: скомпилированные графы и ядра Inductor переживают перезапуск,
+    поэтому повторный старт не компилирует UNet заново.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", cache_dir)
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+
+
+def optimize_pipelines(registry, compile_unet=False, compile_mode="default", memory_profile="speed"):
+    """
+    Оптимизации загруженной модели под её устройство. Компоненты общие для всех пайплайнов
+    реестра, поэтому достаточно одного вызова после load().
+    - CUDA: attention из xformers, если установлен.
+    - CPU: веса UNet и VAE в channels_last и attention slicing — меньше пиковая память
+      и лучше локальность свёрток.
+    - memory_profile: профиль из MEMORY_PROFILES.
+    - compile_unet: UNet оборачивается в torch.compile во всех пайплайнах;
+      компиляция происходит при первом вызове (см. enable_compile_cache).
+    """
+    import torch
+
+    if memory_profile not in MEMORY_PROFILES:
+        raise ValueError(f"Неизвестный профиль памяти: {memory_profile}. Доступны: {', '.join(MEMORY_PROFILES)}")
+    settings = MEMORY_PROFILES[memory_profile]
+    on_cuda = torch.device(registry.device).type == "cuda"
+    pipe = registry.get("txt2img")
+    if on_cuda:
+        try:
+            pipe.enable_xformers_memory_efficient_attention()
+            logger.info("✅ xformers активирован.")
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось активировать xformers: {e}")
+    else:
+        pipe.unet.to(memory_format=torch.channels_last)
+        pipe.vae.to(memory_format=torch.channels_last)
+        pipe.enable_attention_slicing()
+        logger.info("CPU: channels_last и attention slicing включены")
+
+    # UNet и VAE общие, поэтому настройки модулей действуют во всех пайплайнах реестра
+    if settings.get("attention_slicing"):
+        pipe.enable_attention_slicing()
+    if settings.get("vae_slicing"):
+        pipe.vae.enable_slicing()
+    if settings.get("vae_tiling"):
+        pipe.vae.enable_tiling()
+    if settings.get("model_cpu_offload"):
+        if not on_cuda:
+            logger.warning("Выгрузка моделей в RAM имеет смысл только на CUDA, пропущена")
+        else:
+            # Хуки выгрузки висят на самих модулях: пайплайны, собранные из них позже, тоже их используют
+            pipe.enable_model_cpu_offload(device=registry.device)
+            if compile_unet:
+                logger.warning("torch.compile несовместим с выгрузкой моделей и отключён")
+                compile_unet = False
+    logger.info(f"Профиль памяти: {memory_profile} {settings or ''}".rstrip())
+
+    if compile_unet:
+        registry.replace_component("unet", torch.compile(pipe.unet, mode=compile_mode))
+        logger.info(f"UNet обёрнут в torch.compile (mode={compile_mode})")
+
+
+class ProfileStats:
+    """
+    Замеры активного профиля памяти по размерам выхода: пиковая память батча и скорость.
+    - CUDA: пик выделенной памяти за батч (счётчик torch сбрасывается перед батчем).
+    - CPU: резидентная память процесса после батча — пик внутри батча так не виден,
+      но рост от размера к размеру сравнивать можно.
+    Скорость — секунды на изображение и шаги денойзинга в секунду (шаг одного изображения).
+    """
+
+    def __init__(self, profile, device="cpu"):
+        self.profile = profile
+        self.device = device
+        self.sizes = {}  # "ШxВ" -> накопленные замеры
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, size, images, steps):
+        """
+        Замеряет батч из images изображений размера size (ширина, высота) и steps шагов на изображение.
+        """
+        import torch
+
+        on_cuda = torch.device(self.device).type == "cuda"
+        if on_cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+        started = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - started
+        if on_cuda:
+            peak = torch.cuda.max_memory_allocated(self.device)
+        else:
+            peak = psutil.Process().memory_info().rss
+        with self.lock:
+            entry = self.sizes.setdefault(f"{size[0]}x{size[1]}", {"batches": 0, "images": 0, "seconds": 0.0,
+                                                                   "image_steps": 0, "peak_bytes": 0})
+            entry["batches"] += 1
+            entry["images"] += images
+            entry["seconds"] += elapsed
+            entry["image_steps"] += images * steps
+            entry["peak_bytes"] = max(entry["peak_bytes"], peak)
+
+    def stats(self):
+        with self.lock:
+            sizes = {
+                size: {
+                    "batches": entry["batches"],
+                    "images": entry["images"],
+                    "peak_bytes": entry["peak_bytes"],
+                    "seconds_per_image": entry["seconds"] / entry["images"],
+                    "steps_per_second": entry["image_steps"] / entry["seconds"] if entry["seconds"] else 0.0,
+                }
+                for size, entry in self.sizes.items()
+            }
+        return {"profile": self.profile, "device": str(self.device), "settings": MEMORY_PROFILES.get(self.profile),
+                "sizes": sizes}
+
+    def reset(self):
+        with self.lock:
+            self.sizes.clear()
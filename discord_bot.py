@@ -1,122 +1,99 @@
 import discord
 from discord.ext import commands
-import os
-import re
 from config import TOKEN
+from dataset_store import DatasetStore
 from io import BytesIO
-import aiohttp
-import asyncio
-import shutil
 import logging
+import os
+from api_client import ApiClient, ApiError
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# URL API для генерации изображений
-API_URL = "http://127.0.0.1:8000/generate"
-# URL API для получения статуса генерации
-STATUS_API_URL = "http://127.0.0.1:8000/status"
-# URL API для генерации изображений по референсу
-REF_API_URL = "http://127.0.0.1:8000/generate_by_reference"
+# Общий клиент API генерации: пул соединений, таймауты, повторы на 429/503
+api_client = ApiClient()
 
 # Путь к директории, где будут сохраняться изображения
 DATASET_PATH = r"E:\spammer\Myproject\models\cache"
+# Число подкаталогов для раскладки датасета (0 — все файлы в одном каталоге)
+DATASET_SHARDS = 0
+
+# Датасет: имена выдаются из индекса в памяти, запись — в пуле потоков
+dataset_store = DatasetStore(DATASET_PATH, shards=DATASET_SHARDS)
 
 # Создание объекта bot с настройками
 intents = discord.Intents.default()
 intents.message_content = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+class GenerationBot(commands.Bot):
+    async def close(self):
+        # Закрываем пул соединений к API вместе с ботом
+        await api_client.close()
+        await super().close()
+
+
+bot = GenerationBot(command_prefix="!", intents=intents)
 
 # Максимальный размер файла для отправки в Discord
 MAX_MESSAGE_SIZE_MB = 8  # Максимальный размер одного сообщения в MB (Discord ограничивает размер до 8 MB)
 MAX_FILES_PER_MESSAGE = 10  # Максимум 10 файлов в одном сообщении в Discord
+# Срок задачи на сервере: дольше пользователь ответа в чате не ждёт, и незавершённую к этому
+# времени генерацию сервер прерывает, а не занимает ей GPU
+JOB_TIMEOUT_SECONDS = 150
 
-def sanitize_filename(text):
-    """
-    Очищает строку от неподдерживаемых символов для имени файла.
-    - Убирает все символы, кроме букв, цифр, пробелов, и тире.
-    - Преобразует пробелы в подчеркивания.
-    - Обрезает строку до 50 символов.
-    """
-    clean = re.sub(r'[^\w\s-]', '', text).strip().replace(' ', '_')
-    return clean[:50] if clean else "image"
-
-def get_unique_filename(base_name, extension=".png"):
+async def check_generation_status(task_id, ctx):
     """
-    Генерирует уникальное имя для файла, добавляя счетчик.
-    Проверяет, существует ли файл с таким именем в указанной директории.
-    Если файл существует, добавляется номер, пока не найдется уникальное имя.
+    Long-poll статуса: сервер отвечает сразу по завершении задачи
+    или через STATUS_LONG_POLL_SECONDS, если она ещё выполняется.
     """
-    n = 1
-    while True:
-        name = f"{base_name}_{n:02d}"
-        full_path = os.path.join(DATASET_PATH, f"{name}{extension}")
-        if not os.path.exists(full_path):
-            return name
-        n += 1
-
-async def check_generation_status(task_id, ctx):
-    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=150)) as session:
-        try:
-            async with session.get(f"{STATUS_API_URL}/{task_id}") as res:
-                if res.status != 200:
-                    await ctx.send(f"❌ Ошибка при запросе статуса задачи. Статус: {res.status}")
-                    return None
-                data = await res.json()
-                return data.get("status", "unknown")
-        except Exception as e:
-            await ctx.send(f"❌ Произошла ошибка при проверке статуса: {str(e)}")
-            return None
+    try:
+        data = await api_client.status(task_id)
+        return data.get("status", "unknown")
+    except ApiError as e:
+        await ctx.send(f"❌ Ошибка при запросе статуса задачи: {e}")
+        return None
+    except Exception as e:
+        await ctx.send(f"❌ Произошла ошибка при проверке статуса: {str(e)}")
+        return None
 
 
 async def generate_image_from_api(prompt, num_images, ctx):
     """
-    Генерирует изображение через API на основе текста и возвращает путь к изображению.
+    Ставит задачу генерации через API и возвращает её task_id.
     """
-    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=150)) as session:
-        try:
-            logger.info(f"Отправляю запрос в API: {API_URL}, с параметрами: prompt={prompt}, num_images={num_images}")
-            async with session.post(API_URL, json={"prompt": prompt, "num_images": num_images}) as res:
-                logger.info(f"Ответ от API: {res.status}")
-
-                # Логируем полный текст ответа от API для диагностики
-                response_text = await res.text()
-                logger.info(f"Ответ от API: {response_text}")
-
-                if res.status != 200:
-                    await ctx.send(f"❌ Ошибка при запросе к API. Статус: {res.status}. Ответ: {response_text}")
-                    return None
-
-                try:
-                    # Пытаемся разобрать JSON
-                    data = await res.json()
-                    logger.info(f"Полученные данные от API: {data}")
-
-                    # Проверяем, если получены файлы
-                    filenames = data.get("filenames", [])
-                    if filenames:
-                        logger.info(f"Получены файлы: {filenames}")
-                        return filenames
-                    else:
-                        await ctx.send("❌ Не удалось получить файлы от API.")
-                        return None
-
-                except Exception as e:
-                    # Если ошибка при обработке ответа (например, неправильный формат данных)
-                    await ctx.send(f"❌ Ошибка при обработке ответа от API: {e}. Ответ: {response_text}")
-                    logger.error(f"Ошибка при обработке ответа от API: {e}. Ответ: {response_text}")
-                    return None
-
-        except Exception as e:
-            logger.error(f"Ошибка при запросе к API: {e}")
-            await ctx.send(f"❌ Произошла ошибка при связи с API: {str(e)}")
-            return None
+    try:
+        logger.info(f"Отправляю запрос в API: prompt={prompt}, num_images={num_images}")
+        # Изображения забираем по HTTP, поэтому серверу не нужно писать их на свой диск.
+        # client_id — автор команды: сервер делит очередь между пользователями.
+        # В чат уходит WebP под лимит вложений Discord, в датасет — PNG без потерь (вариант "dataset").
+        data = await api_client.submit(prompt, num_images, save_to_disk=False, client_id=f"discord:{ctx.author.id}",
+                                       output_format="discord", variants="dataset", timeout=JOB_TIMEOUT_SECONDS)
+        logger.info(f"Полученные данные от API: {data}")
+
+        # Проверяем, что задача поставлена
+        task_id = data.get("task_id")
+        if task_id:
+            logger.info(f"Задача поставлена: {task_id}")
+            if data.get("queue_position"):
+                await ctx.send(f"⏳ Перед вами в очереди {data['queue_position']} изображений, "
+                               f"ожидание ~{data['estimated_wait']:.0f} с.")
+            return task_id
+        await ctx.send("❌ Не удалось поставить задачу в API.")
+        return None
+
+    except ApiError as e:
+        logger.error(f"Ошибка API при постановке задачи: {e}")
+        await ctx.send(f"❌ Ошибка при запросе к API: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"Ошибка при запросе к API: {e}")
+        await ctx.send(f"❌ Произошла ошибка при связи с API: {str(e)}")
+        return None
 
 async def get_generated_files(task_id, ctx):
     """
-    Проверка статуса задачи и получение файлов по завершении генерации.
+    Проверка статуса задачи и получение изображений (OutputImage) по завершении генерации.
     """
     await ctx.send("🔄 Ожидание завершения генерации...")
 
@@ -124,26 +101,26 @@ async def get_generated_files(task_id, ctx):
         status = await check_generation_status(task_id, ctx)
         if status == "completed":
             logger.info(f"Генерация завершена для task_id: {task_id}")
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=150)) as session:
-                try:
-                    async with session.get(f"{STATUS_API_URL}/files/{task_id}") as res:
-                        logger.info(f"Запрос на получение файлов для task_id: {task_id}, статус ответа: {res.status}")
-                        if res.status != 200:
-                            await ctx.send(f"❌ Ошибка при получении файлов. Статус: {res.status}")
-                            return None
-                        data = await res.json()
-                        filenames = data.get("filenames", [])
-                        logger.info(f"Полученные файлы: {filenames}")
-                        return filenames
-                except Exception as e:
-                    logger.error(f"Ошибка при получении файлов: {e}")
-                    await ctx.send(f"❌ Произошла ошибка при получении файлов: {str(e)}")
-                    return None
+            try:
+                images = await api_client.images(task_id)
+                logger.info(f"Полученные файлы: {[image.filename for image in images]}")
+                return images
+            except Exception as e:
+                logger.error(f"Ошибка при получении файлов: {e}")
+                await ctx.send(f"❌ Произошла ошибка при получении файлов: {str(e)}")
+                return None
         elif status == "failed":
             await ctx.send("❌ Генерация не удалась. Попробуйте снова.")
             return None
-        else:
-            await asyncio.sleep(5)
+        elif status == "expired":
+            await ctx.send("⌛ Сервер перегружен, генерация не успела завершиться. Попробуйте позже.")
+            return None
+        elif status == "cancelled":
+            await ctx.send("❌ Генерация отменена.")
+            return None
+        elif status is None:
+            return None
+        # Иначе long-poll истёк, а задача ещё выполняется — сразу спрашиваем снова
 
 @bot.command()
 async def generate(ctx, *, prompt: str):
@@ -164,31 +141,24 @@ async def generate(ctx, *, prompt: str):
 
     await ctx.send(f"🔄 Генерация {num_images} изображений по запросу: {prompt}... Пожалуйста, подождите.")
 
-    filenames = await generate_image_from_api(prompt, num_images, ctx)
+    task_id = await generate_image_from_api(prompt, num_images, ctx)
+    if not task_id:
+        return
 
-    if not filenames:
+    images = await get_generated_files(task_id, ctx)
+    if not images:
         return
 
     saved_files = []
-    for filename in filenames:
-        safe_name = sanitize_filename(filename)
-        unique_name = get_unique_filename(safe_name)
-
-        if "_x2" in filename:
-            unique_name += "_x2"
-
-        final_image_path = os.path.join(DATASET_PATH, f"{unique_name}.png")
-        final_prompt_path = os.path.join(DATASET_PATH, f"{unique_name}.txt")
-
-        logger.info(f"Сохраняю изображение {filename} в {final_image_path}")
-
-        if os.path.exists(filename):
-            shutil.move(filename, final_image_path)
-            with open(final_prompt_path, "w", encoding="utf-8") as f:
-                f.write(prompt)
-            saved_files.append(final_image_path)
-        else:
-            await ctx.send(f"❌ Файл {filename} не найден. Делаем попытку снова. Пропускаем.")
+    for image in images:
+        suffix = "_x2" if "_x2" in image.filename else ""
+        # В датасет — PNG-вариант, если сервер его вернул, иначе основной выход
+        dataset_image = image.variants.get("dataset", image)
+        unique_name, final_image_path = await dataset_store.save(
+            image.filename, dataset_image.data, prompt, suffix=suffix,
+            extension=os.path.splitext(dataset_image.filename)[1] or ".png")
+        logger.info(f"Изображение {image.filename} сохранено в {final_image_path}")
+        saved_files.append((f"{unique_name}{os.path.splitext(image.filename)[1] or '.png'}", image.data))
 
     chunks = []
     current_chunk = []
@@ -197,7 +167,7 @@ async def generate(ctx, *, prompt: str):
 
     for file in saved_files:
         current_chunk.append(file)
-        current_chunk_size += os.path.getsize(file) / (1024 * 1024)  # Размер в МБ
+        current_chunk_size += len(file[1]) / (1024 * 1024)  # Размер в МБ
         current_file_count += 1
         if current_chunk_size >= MAX_MESSAGE_SIZE_MB or current_file_count > MAX_FILES_PER_MESSAGE:
             chunks.append(current_chunk)
@@ -209,7 +179,8 @@ async def generate(ctx, *, prompt: str):
         chunks.append(current_chunk)
 
     for chunk in chunks:
-        files = [discord.File(file_path) for file_path in chunk]
+        # Отправляем байты из памяти, не перечитывая только что записанные файлы
+        files = [discord.File(BytesIO(image_data), filename=filename) for filename, image_data in chunk]
         await ctx.send("Вот ваши изображения:", files=files)
 
 @bot.command()
@@ -232,26 +203,16 @@ async def refgen(ctx, prompt: str):
 
     await ctx.send(f"🔄 Генерация изображения по референсу с запросом: {prompt}.")
     try:
-        # Отправляем асинхронный запрос к API для генерации по референсу
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=150)) as session:
-            data = aiohttp.FormData()
-            data.add_field('image', image_bytes, filename='image.png', content_type='image/png')
-
-            async with session.post(REF_API_URL, data=data, params={"prompt": prompt}) as res:
-                if res.status != 200:
-                    await ctx.send(f"❌ Ошибка при запросе к API. Статус: {res.status}")
-                    return
-
-                data = await res.json()
-                filename = data.get("filename", None)
-
-                if not filename:
-                    await ctx.send("❌ Ошибка: изображение не было возвращено.")
-                    return
-
-                await ctx.send(f"✅ Изображение успешно сгенерировано! Ссылка на изображение: {filename}")
-                await ctx.send(file=discord.File(filename))
-
+        # Сервер возвращает само изображение, а не путь на своём диске
+        content_type = attachment.content_type or "image/png"
+        filename, image_data = await api_client.generate_by_reference(prompt, image_bytes, content_type=content_type,
+                                                                      client_id=f"discord:{ctx.author.id}",
+                                                                      output_format="discord")
+        await ctx.send("✅ Изображение успешно сгенерировано!")
+        await ctx.send(file=discord.File(BytesIO(image_data), filename=filename))
+
+    except ApiError as e:
+        await ctx.send(f"❌ Ошибка при запросе к API: {e}")
     except Exception as e:
         await ctx.send(f"❌ Произошла ошибка при генерации изображения: {e}")
 
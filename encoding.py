@@ -0,0 +1,106 @@
+import io
+import math
+from dataclasses import dataclass, replace
+
+from PIL import Image
+
+# Форматы вывода: content type и расширение файла
+CONTENT_TYPES = {"png": "image/png", "webp": "image/webp", "jpeg": "image/jpeg"}
+EXTENSIONS = {"png": ".png", "webp": ".webp", "jpeg": ".jpg"}
+
+# Качество WebP/JPEG по умолчанию и границы подбора качества под целевой размер
+DEFAULT_QUALITY = {"webp": 90, "jpeg": 92}
+MIN_QUALITY = 40
+MAX_QUALITY = 95
+# Меньше этой стороны изображение ради размера файла не уменьшается
+MIN_SIDE = 64
+
+
+# Параметры кодирования одного выхода. Неизменяемые: входят в ключ кэша результатов.
+@dataclass(frozen=True)
+class OutputSpec:
+    format: str = "png"  # "png", "webp" или "jpeg"
+    quality: int = None  # WebP/JPEG; None — DEFAULT_QUALITY или подбор под max_bytes
+    max_bytes: int = None  # WebP/JPEG: наибольшее качество, при котором файл не больше max_bytes
+    max_side: int = None  # уменьшить длинную сторону до max_side (миниатюры, чаты)
+    compress_level: int = 6  # PNG: 0 — быстро и крупно, 9 — медленно и компактно
+
+    @property
+    def content_type(self):
+        return CONTENT_TYPES[self.format]
+
+    @property
+    def extension(self):
+        return EXTENSIONS[self.format]
+
+
+# Готовые наборы параметров по назначению
+PRESETS = {
+    "png": OutputSpec(),
+    # Датасет: без потерь, максимальное сжатие (запись идёт в фоне, скорость не критична)
+    "dataset": OutputSpec(format="png", compress_level=9),
+    "webp": OutputSpec(format="webp"),
+    "jpeg": OutputSpec(format="jpeg"),
+    # Discord: до 10 файлов в сообщении общим размером до 8 МБ
+    "discord": OutputSpec(format="webp", max_bytes=800 * 1024),
+    # Telegram всё равно пережимает фото в JPEG до 1280 px — отдаём сразу такое
+    "telegram": OutputSpec(format="jpeg", max_bytes=1024 * 1024, max_side=1280),
+    "thumbnail": OutputSpec(format="webp", quality=80, max_side=256),
+}
+
+
+def save(image, spec, quality=None):
+    buffer = io.BytesIO()
+    if spec.format == "png":
+        image.save(buffer, format="PNG", compress_level=spec.compress_level)
+    elif spec.format == "webp":
+        image.save(buffer, format="WEBP", quality=quality, method=4)
+    else:
+        image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def encode_lossy(image, spec):
+    if spec.max_bytes is None:
+        return save(image, spec, spec.quality or DEFAULT_QUALITY[spec.format])
+
+    # Сначала пробуем верхнее качество: обычно файл и так укладывается в лимит
+    quality = spec.quality or MAX_QUALITY
+    data = save(image, spec, quality)
+    if len(data) <= spec.max_bytes:
+        return data
+
+    # Двоичный поиск наибольшего качества, укладывающегося в лимит
+    low, high, best = MIN_QUALITY, quality - 1, None
+    while low <= high:
+        middle = (low + high) // 2
+        data = save(image, spec, middle)
+        if len(data) <= spec.max_bytes:
+            best, low = data, middle + 1
+        else:
+            high = middle - 1
+    if best is not None:
+        return best
+
+    # Даже минимальное качество не укладывается — уменьшаем изображение пропорционально лишнему объёму
+    data = save(image, spec, MIN_QUALITY)
+    ratio = math.sqrt(spec.max_bytes / len(data)) * 0.9
+    size = (round(image.width * ratio), round(image.height * ratio))
+    if min(size) < MIN_SIDE:
+        return data
+    return encode_lossy(image.resize(size, Image.LANCZOS), replace(spec, quality=MIN_QUALITY))
+
+
+def encode_image(image, spec):
+    """
+    Кодирует изображение по OutputSpec и возвращает байты.
+    JPEG и WebP с max_bytes подбирают качество (и при необходимости размер) под лимит.
+    """
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if spec.max_side is not None and max(image.size) > spec.max_side:
+        image = image.copy()
+        image.thumbnail((spec.max_side, spec.max_side), Image.LANCZOS)
+    if spec.format == "png":
+        return save(image, spec)
+    return encode_lossy(image, spec)
@@ -0,0 +1,162 @@
+import asyncio
+import itertools
+from dataclasses import dataclass
+
+# Классы приоритета, от старшего к младшему
+PRIORITIES = ("high", "normal", "low")
+PRIORITY_RANK = {name: rank for rank, name in enumerate(PRIORITIES)}
+
+
+# Клиент очереди: бот, API-ключ или конкретный пользователь
+@dataclass(frozen=True)
+class Client:
+    id: str = "anonymous"
+    weight: float = 1.0
+    priority: str = "normal"
+
+
+@dataclass
+class ClientState:
+    finish: float = 0.0  # виртуальное время окончания последнего запроса клиента
+    queued: int = 0  # запросов в очереди
+    in_flight: int = 0  # изображений в работе
+
+
+class FairQueue:
+    """
+    Очередь запросов микробатчера с взвешенным справедливым разделением между клиентами (WFQ).
+    - Запрос стоимостью cost изображений получает метки start = max(V, finish клиента)
+      и finish = start + cost / weight; выбирается запрос с наименьшим finish.
+      Поэтому клиент с сотней изображений в очереди не задерживает клиента с одним.
+    - Классы приоритета строгие: пока есть допустимые запросы high, normal не выбирается.
+    - Клиент, у которого в работе уже max_in_flight изображений, пропускается
+      до завершения его батчей (один запрос при пустом in_flight проходит всегда).
+    Элементы — объекты с полями client (Client) и num_images.
+    """
+
+    def __init__(self, max_in_flight=None):
+        self.max_in_flight = max_in_flight
+        self.entries = []  # (ключ порядка, элемент)
+        self.clients = {}
+        self.virtual_time = 0.0
+        self.counter = itertools.count()
+        self.changed = asyncio.Event()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _state(self, client):
+        state = self.clients.get(client.id)
+        if state is None:
+            state = self.clients[client.id] = ClientState()
+        return state
+
+    def _notify(self):
+        self.changed.set()
+
+    def put(self, item):
+        client = item.client
+        state = self._state(client)
+        start = max(self.virtual_time, state.finish)
+        state.finish = start + item.num_images / client.weight
+        state.queued += 1
+        key = (PRIORITY_RANK.get(client.priority, PRIORITY_RANK["normal"]), state.finish, next(self.counter), start)
+        self.entries.append((key, item))
+        self._notify()
+
+    def _eligible(self, item):
+        if self.max_in_flight is None:
+            return True
+        in_flight = self._state(item.client).in_flight
+        return in_flight == 0 or in_flight + item.num_images <= self.max_in_flight
+
+    def _remove(self, index):
+        key, item = self.entries.pop(index)
+        state = self.clients[item.client.id]
+        state.queued -= 1
+        return key, item
+
+    def _forget_idle(self):
+        # Простаивающие клиенты без накопленного отставания больше не нужны
+        for client_id, state in list(self.clients.items()):
+            if state.queued == 0 and state.in_flight == 0 and state.finish <= self.virtual_time:
+                del self.clients[client_id]
+
+    def pop(self, predicate=None):
+        """
+        Забирает следующий по порядку допустимый элемент, для которого predicate истинен; None — если таких нет.
+        Элемент считается взятым в работу до вызова release.
+        """
+        best = None
+        for index, (key, item) in enumerate(self.entries):
+            if (best is None or key < self.entries[best][0]) and self._eligible(item) \
+                    and (predicate is None or predicate(item)):
+                best = index
+        if best is None:
+            return None
+        key, item = self._remove(best)
+        self.virtual_time = max(self.virtual_time, key[3])
+        self.clients[item.client.id].in_flight += item.num_images
+        return item
+
+    async def get(self, predicate=None, timeout=None):
+        """
+        Как pop, но ждёт подходящий элемент не дольше timeout секунд (None — без ограничения).
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            item = self.pop(predicate)
+            if item is not None:
+                return item
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return None
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return None
+
+    def release(self, items):
+        """
+        Отмечает элементы, взятые через pop, как завершённые.
+        """
+        for item in items:
+            state = self.clients.get(item.client.id)
+            if state is not None:
+                state.in_flight -= item.num_images
+        self._forget_idle()
+        self._notify()
+
+    def purge(self, predicate):
+        """
+        Убирает из очереди элементы, для которых predicate истинен, и возвращает их.
+        """
+        removed = []
+        for index in reversed(range(len(self.entries))):
+            if predicate(self.entries[index][1]):
+                removed.append(self._remove(index)[1])
+        if removed:
+            self._forget_idle()
+        return removed
+
+    def position(self, predicate):
+        """
+        Сколько изображений в очереди стоит перед первым элементом, для которого predicate истинен;
+        None — если таких элементов в очереди нет.
+        """
+        ahead = 0
+        for key, item in sorted(self.entries, key=lambda entry: entry[0]):
+            if predicate(item):
+                return ahead
+            ahead += item.num_images
+        return None
+
+    def stats(self):
+        return {
+            "queued": len(self.entries),
+            "virtual_time": self.virtual_time,
+            "clients": {client_id: {"queued": state.queued, "in_flight": state.in_flight}
+                        for client_id, state in self.clients.items()},
+        }
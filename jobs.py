@@ -0,0 +1,261 @@
+import asyncio
+import logging
+import time
+import uuid
+from dataclasses import dataclass, field
+
+logger = logging.getLogger("FastAPI")
+
+# Состояния задачи
+QUEUED = "queued"
+IN_PROGRESS = "in_progress"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+EXPIRED = "expired"  # прервана по истечении срока
+FINISHED_STATES = (COMPLETED, FAILED, CANCELLED, EXPIRED)
+
+# Сколько секунд хранить завершённую задачу
+JOB_TTL_SECONDS = 3600
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    state: str = QUEUED
+    results: list = field(default_factory=list)
+    error: str = None
+    exception: Exception = None
+    created_at: float = field(default_factory=time.time)
+    started_at: float = None
+    finished_at: float = None
+    deadline: float = None  # time.time() срока задачи — только для показа клиенту
+    task: asyncio.Task = None
+    timer: asyncio.TimerHandle = None  # прерывание по сроку
+    # Срок истёк: задачу прервал таймер или планировщик выбросил её просроченный запрос.
+    # Флаг, а не сравнение с deadline: таймер цикла может сработать чуть раньше, а время Unix — сдвинуться.
+    timed_out: bool = False
+    # Последнее превью каждого изображения: индекс -> Preview
+    previews: dict = field(default_factory=dict)
+    # Ход длинной задачи (массовая генерация): счётчики обновляются по мере работы
+    progress: dict = None
+    result_bytes: int = 0  # память, занятая результатами
+    results_released: bool = False  # результаты уже отданы синхронно или вытеснены лимитом памяти
+    # Событие пересоздаётся при каждом изменении задачи, ожидающие будятся через set()
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+
+    @property
+    def finished(self):
+        return self.state in FINISHED_STATES
+
+    def to_dict(self):
+        status = {
+            "task_id": self.id,
+            "kind": self.kind,
+            "status": self.state,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self.deadline is not None:
+            status["deadline"] = self.deadline
+        if self.progress is not None:
+            status["progress"] = self.progress
+        if self.results_released:
+            status["results_released"] = True
+        return status
+
+
+# Промежуточное превью изображения задачи (JPEG)
+@dataclass
+class Preview:
+    index: int
+    step: int
+    steps: int
+    data: bytes
+
+
+class JobStore:
+    """
+    Хранилище задач генерации.
+    - Держит состояние, результаты, ошибки и временные метки задачи.
+    - Завершённые задачи удаляются через ttl секунд.
+    - Память результатов завершённых задач ограничена max_result_bytes: сверх лимита результаты
+      давно завершённых задач освобождаются (release_result), статус задачи остаётся.
+    - Позволяет дождаться изменения задачи (long-poll / SSE) без опроса.
+    - Хранит последнее промежуточное превью каждого изображения задачи.
+    - Незавершённую задачу можно отменить; задача с timeout прерывается по истечении срока
+      (состояние expired). Отмена доходит до корутины задачи как CancelledError.
+    """
+
+    def __init__(self, ttl=JOB_TTL_SECONDS, max_result_bytes=None, result_size=None, release_result=None):
+        """
+        result_size(result) — сколько байт памяти занимает результат; release_result(result) —
+        результат без тяжёлых данных, который остаётся в задаче после освобождения (None — ничего).
+        """
+        self.ttl = ttl
+        self.max_result_bytes = max_result_bytes
+        self.result_size = result_size or (lambda result: 0)
+        self.release_result = release_result or (lambda result: None)
+        self.jobs = {}
+        self.result_bytes = 0
+        self.released = 0  # задач, результаты которых вытеснены лимитом памяти
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def evict_expired(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job.finished and now - job.finished_at > self.ttl]
+        for job_id in expired:
+            self.result_bytes -= self.jobs.pop(job_id).result_bytes
+        if expired:
+            logger.info(f"Удалено устаревших задач: {len(expired)}")
+
+    def counts(self):
+        """
+        Количество задач по состояниям.
+        """
+        counts = dict.fromkeys((QUEUED, IN_PROGRESS) + FINISHED_STATES, 0)
+        for job in self.jobs.values():
+            counts[job.state] += 1
+        return counts
+
+    def get(self, job_id):
+        self.evict_expired()
+        return self.jobs.get(job_id)
+
+    def _notify(self, job):
+        event, job.changed = job.changed, asyncio.Event()
+        event.set()
+
+    def submit(self, kind, coro, timeout=None):
+        """
+        Создаёт задачу и запускает корутину в фоне. Корутина должна вернуть список результатов.
+        Вместо корутины можно передать функцию job -> корутина, если корутине нужна сама задача.
+        timeout — срок задачи в секундах (None — без срока).
+        """
+        self.evict_expired()
+        job = Job(id=str(uuid.uuid4()), kind=kind)
+        if timeout is not None:
+            job.deadline = job.created_at + timeout
+            job.timer = asyncio.get_running_loop().call_later(timeout, self.expire, job)
+        self.jobs[job.id] = job
+        if callable(coro):
+            coro = coro(job)
+        job.task = asyncio.create_task(self._run(job, coro))
+        return job
+
+    async def _run(self, job, coro):
+        job.state = IN_PROGRESS
+        job.started_at = time.time()
+        self._notify(job)
+        try:
+            job.results = list(await coro)
+            job.result_bytes = sum(self.result_size(result) for result in job.results)
+            self.result_bytes += job.result_bytes
+            job.state = COMPLETED
+        except asyncio.CancelledError:
+            # Отмена после срока (таймером или планировщиком, выбросившим просроченный запрос) — expired
+            if job.timed_out:
+                job.state = EXPIRED
+                logger.info(f"Задача {job.id} прервана: истёк срок")
+            else:
+                job.state = CANCELLED
+                logger.info(f"Задача {job.id} отменена")
+        except Exception as e:
+            job.exception = e
+            job.error = str(getattr(e, "detail", e))
+            job.state = FAILED
+            logger.error(f"Задача {job.id} завершилась с ошибкой: {job.error}")
+        finally:
+            if job.timer is not None:
+                job.timer.cancel()
+            job.finished_at = time.time()
+            self._notify(job)
+            self._trim_results()
+
+    def release_results(self, job):
+        """
+        Освобождает память результатов завершённой задачи: например, когда они уже ушли в синхронном ответе.
+        """
+        if job.results_released or not job.finished:
+            return
+        job.results = [result for result in map(self.release_result, job.results) if result is not None]
+        job.results_released = True
+        self.result_bytes -= job.result_bytes
+        job.result_bytes = 0
+
+    def _trim_results(self):
+        # Сверх лимита освобождаются результаты задач, завершённых раньше всех
+        if self.max_result_bytes is None or self.result_bytes <= self.max_result_bytes:
+            return
+        finished = sorted((job for job in self.jobs.values() if job.result_bytes), key=lambda job: job.finished_at)
+        for job in finished:
+            if self.result_bytes <= self.max_result_bytes:
+                break
+            self.release_results(job)
+            self.released += 1
+            logger.info(f"Результаты задачи {job.id} освобождены: лимит памяти результатов")
+
+    def publish_preview(self, job, preview):
+        """
+        Сохраняет превью изображения задачи и будит ожидающих.
+        """
+        if job.finished:
+            return
+        job.previews[preview.index] = preview
+        self._notify(job)
+
+    def expire(self, job):
+        """
+        Прерывает незавершённую задачу по истечении срока (состояние expired).
+        """
+        self.mark_timed_out(job.id)
+        return self.cancel(job)
+
+    def mark_timed_out(self, job_id):
+        """
+        Помечает задачу истёкшей, не отменяя её: отмену доставит тот, кто выбросил её просроченный запрос.
+        """
+        job = self.jobs.get(job_id)
+        if job is not None and not job.finished:
+            job.timed_out = True
+
+    def cancel(self, job):
+        """
+        Отменяет незавершённую задачу. Возвращает False, если задача уже завершена.
+        """
+        if job.finished:
+            return False
+        job.task.cancel()
+        return True
+
+    async def wait_changed(self, job, timeout):
+        """
+        Ждёт следующего изменения задачи не дольше timeout секунд.
+        Возвращает False, если за это время ничего не изменилось.
+        """
+        if job.finished:
+            return True
+        try:
+            await asyncio.wait_for(job.changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def wait_finished(self, job, timeout=None):
+        """
+        Ждёт завершения задачи; timeout=None — без ограничения.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while not job.finished:
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                break
+            await self.wait_changed(job, remaining)
+        return job.finished
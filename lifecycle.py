@@ -0,0 +1,57 @@
+import time
+from contextlib import contextmanager
+
+# Состояния запуска сервера
+STARTING = "starting"
+READY = "ready"
+FAILED = "failed"
+
+
+class Startup:
+    """
+    Ход запуска сервера для /health и /ready.
+    - state: starting, затем ready либо failed (с текстом ошибки).
+    - phases: длительность фаз запуска в секундах в порядке выполнения
+      (импорт, загрузка весов, перенос на устройство, прогрев и т. д.).
+    - task: фоновая задача загрузки модели.
+    """
+
+    def __init__(self):
+        self.state = STARTING
+        self.error = None
+        self.phases = {}
+        self.created_at = time.time()
+        self.ready_at = None
+        self.task = None
+
+    @property
+    def ready(self):
+        return self.state == READY
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - started
+
+    def record(self, name, seconds):
+        self.phases[name] = seconds
+
+    def mark_ready(self):
+        self.state = READY
+        self.ready_at = time.time()
+
+    def mark_failed(self, error):
+        self.state = FAILED
+        self.error = error
+
+    def to_dict(self):
+        return {
+            "status": self.state,
+            "error": self.error,
+            "ready_at": self.ready_at,
+            "startup_seconds": None if self.ready_at is None else self.ready_at - self.created_at,
+            "phases": dict(self.phases),
+        }
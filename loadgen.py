@@ -0,0 +1,536 @@
+"""
+Генератор нагрузки: воспроизводит трассу запросов к server.py так, как их шлют боты.
+
+Трасса — JSONL, строка на запрос:
+    {"t": 12.5, "endpoint": "submit", "client_id": "discord:42", "num_images": 2,
+     "options": {"output_format": "discord", "timeout": 150}, "reference": {"width": 1280, "height": 960, "format": "JPEG"}}
+- t — секунды от начала трассы (в трассе, записанной сервером, — время Unix; отсчёт идёт от первой строки);
+- endpoint — generate, submit, generate_by_reference или submit_by_reference;
+- options — параметры запроса без промпта (output_format, variants, tier, timeout, ...);
+- reference — размер и формат референса: изображение такого размера синтезируется перед прогоном.
+
+Источники трассы:
+- --trace — записанная сервером (REQUEST_TRACE_PATH) или подготовленная вручную;
+- --synthetic — команды ботов вперемешку (BOT_COMMANDS): пуассоновский поток со всплесками,
+  пользователи с неравной активностью, разное число изображений и размеры референсов.
+
+Запросы идут через api_client.ApiClient, как у ботов: повторы на 429/503 и свой лимит одновременных
+запросов на каждого бота (по префиксу client_id); /submit — long-poll статуса и забор изображений,
+синхронные эндпоинты — multipart. Поток открытый: запросы уходят по времени трассы, не дожидаясь
+ответов на предыдущие, поэтому перегрузка сервера видна, а не сглаживается клиентами.
+
+Отчёт (JSON и таблица): p50/p95/p99 задержки, доли ошибок и 429 по командам и в целом,
+пропускная способность и задержки по окнам времени, стадии сервера из /timings.
+
+Примеры:
+    python loadgen.py --backend stub --synthetic --duration 300 --rate 0.5
+    python loadgen.py --backend stub --synthetic --rate 0.3 --burst-every 60 --burst-duration 10 --burst-rate 4 \\
+        --write-trace bursty.jsonl
+    python loadgen.py --url http://127.0.0.1:8000 --trace requests_trace.jsonl --speed 2
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import platform
+import random
+import tempfile
+import time
+import uuid
+from collections import Counter
+
+import aiohttp
+import numpy as np
+from PIL import Image
+
+from api_client import MAX_CONCURRENT_REQUESTS, MAX_RETRIES, ApiClient, ApiError
+from benchmark import add_server_arguments, git_commit, start_server, summarize, wait_server
+
+ENDPOINTS = ("generate", "submit", "generate_by_reference", "submit_by_reference")
+SYNC_ENDPOINTS = ("generate", "generate_by_reference")
+
+# Команды ботов: эндпоинт и параметры запроса — как в discord_bot и telegram_bot
+BOT_COMMANDS = {
+    # !generate: задача через /submit, long-poll статуса, затем все изображения одним multipart
+    "discord.generate": ("submit", {"save_to_disk": False, "output_format": "discord", "variants": "dataset",
+                                    "timeout": 150}),
+    # !refgen: вложение сообщения синхронно через /generate_by_reference
+    "discord.refgen": ("generate_by_reference", {"output_format": "discord"}),
+    # /generate: синхронный /generate
+    "telegram.generate": ("generate", {"output_format": "telegram", "variants": "dataset"}),
+    # /refgen: фото из Telegram (всегда JPEG) синхронно через /generate_by_reference
+    "telegram.refgen": ("generate_by_reference", {"output_format": "telegram", "variants": "dataset"}),
+}
+DEFAULT_MIX = "discord.generate=0.4,discord.refgen=0.1,telegram.generate=0.35,telegram.refgen=0.15"
+# Сколько изображений просят в !generate (число в конце команды)
+DISCORD_NUM_IMAGES = {1: 0.6, 2: 0.2, 4: 0.2}
+# Референсы: (ширина, высота, формат) -> вес. Telegram отдаёт фото не больше 1280 px в JPEG,
+# в Discord прикрепляют что угодно — от картинок из интернета до снимков с телефона.
+REFERENCE_SIZES = {
+    "telegram": {(1280, 960, "JPEG"): 0.5, (960, 1280, "JPEG"): 0.3, (1280, 720, "JPEG"): 0.2},
+    "discord": {(512, 512, "PNG"): 0.2, (1024, 1024, "PNG"): 0.3, (1920, 1080, "JPEG"): 0.2,
+                (4032, 3024, "JPEG"): 0.3},
+}
+CONTENT_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+# Референс записанной трассы без размера (сервер не смог прочитать заголовок)
+DEFAULT_REFERENCE = (512, 512, "PNG")
+# Активность пользователей убывает по закону Ципфа: немногие шлют большую часть запросов
+ZIPF_EXPONENT = 1.1
+# Лимит одновременных запросов клиентов трассы, которые не являются ботами
+OTHER_CLIENTS_CONCURRENCY = 1024
+# Состояния задачи /submit, которыми она завершается без изображений
+FAILED_JOB_STATES = ("failed", "expired", "cancelled")
+
+
+class JobFailed(Exception):
+    """
+    Задача /submit завершилась без изображений: failed, expired или cancelled.
+    """
+
+    def __init__(self, state):
+        super().__init__(state)
+        self.state = state
+
+
+class RecordingClient(ApiClient):
+    """
+    ApiClient, который считает ответы сервера на запросы генерации по попыткам, включая повторённые 429/503.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.attempts = Counter()
+
+    async def _send(self, session, method, url, reader, timeout, json_body, data, params):
+        if "/status/" in url:
+            return await super()._send(session, method, url, reader, timeout, json_body, data, params)
+        try:
+            result = await super()._send(session, method, url, reader, timeout, json_body, data, params)
+        except ApiError as e:
+            self.attempts[str(e.status)] += 1
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.attempts["connection"] += 1
+            raise
+        self.attempts[str(getattr(result, "status", 200))] += 1
+        return result
+
+
+def load_trace(path):
+    events = []
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            event = json.loads(line)
+            if event.get("endpoint") not in ENDPOINTS:
+                raise ValueError(f"{path}:{number}: неизвестный эндпоинт {event.get('endpoint')}")
+            if "client_id" not in event or "t" not in event:
+                raise ValueError(f"{path}:{number}: нужны поля t и client_id")
+            events.append(event)
+    events.sort(key=lambda event: event["t"])
+    if events:
+        start = events[0]["t"]
+        for event in events:
+            event["t"] -= start
+    return events
+
+
+def parse_weights(text):
+    weights = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip():
+            weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def weighted_choice(rng, weights):
+    return rng.choices(list(weights), weights=list(weights.values()))[0]
+
+
+def rate_at(t, args):
+    # Базовый поток и всплески длиной burst_duration в начале каждых burst_every секунд
+    if args.burst_every > 0 and t % args.burst_every < args.burst_duration:
+        return args.burst_rate
+    return args.rate
+
+
+def synthetic_trace(args):
+    """
+    Трасса команд ботов: неоднородный пуассоновский поток с интенсивностью rate_at(t) (прореживанием
+    потока с наибольшей интенсивностью), команды по весам args.mix, пользователи по закону Ципфа.
+    """
+    rng = random.Random(args.seed)
+    mix = parse_weights(args.mix)
+    users = range(1, args.users + 1)
+    user_weights = [1 / rank ** ZIPF_EXPONENT for rank in users]
+    peak = max(args.rate, args.burst_rate if args.burst_every > 0 else 0)
+    events = []
+    t = 0.0
+    while True:
+        t += rng.expovariate(peak)
+        if t >= args.duration:
+            break
+        if rng.random() * peak > rate_at(t, args):
+            continue
+        command = weighted_choice(rng, mix)
+        bot = command.split(".", 1)[0]
+        endpoint, options = BOT_COMMANDS[command]
+        event = {
+            "t": round(t, 3),
+            "command": command,
+            "endpoint": endpoint,
+            "client_id": f"{bot}:{rng.choices(users, weights=user_weights)[0]}",
+            "num_images": weighted_choice(rng, DISCORD_NUM_IMAGES) if command == "discord.generate" else 1,
+            "options": dict(options),
+        }
+        if endpoint in ("generate_by_reference", "submit_by_reference"):
+            width, height, image_format = weighted_choice(rng, REFERENCE_SIZES[bot])
+            event["reference"] = {"width": width, "height": height, "format": image_format}
+        events.append(event)
+    return events
+
+
+def event_label(event):
+    # Команда бота для синтетической трассы, иначе клиент и эндпоинт ("telegram.generate", "ip.submit")
+    return event.get("command") or f"{event['client_id'].split(':', 1)[0]}.{event['endpoint']}"
+
+
+def reference_key(event):
+    reference = event.get("reference") or {}
+    if not reference.get("width") or not reference.get("height"):
+        return DEFAULT_REFERENCE
+    image_format = reference.get("format")
+    return reference["width"], reference["height"], image_format if image_format in CONTENT_TYPES else "JPEG"
+
+
+def reference_image(width, height, image_format, seed=0):
+    """
+    Референс заданного размера: плавные пятна с зерном, чтобы размер файла и время декодирования
+    были ближе к настоящему фото, чем у однотонной картинки.
+    """
+    rng = np.random.default_rng(seed)
+    spots = rng.integers(0, 256, (max(1, height // 32), max(1, width // 32), 3), dtype=np.uint8)
+    array = np.asarray(Image.fromarray(spots).resize((width, height), Image.BICUBIC), dtype=np.int16)
+    array += rng.integers(-6, 7, array.shape, dtype=np.int16)
+    buffer = io.BytesIO()
+    options = {"quality": 90} if image_format == "JPEG" else {}
+    Image.fromarray(np.clip(array, 0, 255).astype(np.uint8)).save(buffer, format=image_format, **options)
+    return buffer.getvalue()
+
+
+def replay_options(event):
+    options = dict(event.get("options") or {})
+    if event["endpoint"] in SYNC_ENDPOINTS:
+        # Ответ читается как multipart, как у ботов; запись на диск сервера — как в исходном запросе
+        if options.pop("response_mode", "path") == "path":
+            options.setdefault("save_to_disk", True)
+    return options
+
+
+async def send_event(api, event, references):
+    """
+    Выполняет запрос трассы так, как это делает бот; возвращает число полученных изображений.
+    """
+    endpoint = event["endpoint"]
+    options = replay_options(event)
+    # Уникальный промпт: кэш эмбеддингов и результатов не подменяет генерацию
+    prompt = f"loadgen {uuid.uuid4().hex}"
+    client_id = event["client_id"]
+    num_images = event.get("num_images", 1)
+    if endpoint == "generate":
+        await api.generate(prompt, client_id=client_id, num_images=num_images, **options)
+        return num_images
+    if endpoint == "submit":
+        task = await api.submit(prompt, num_images, client_id=client_id, **options)
+    else:
+        data, content_type = references[reference_key(event)]
+        if endpoint == "generate_by_reference":
+            await api.generate_by_reference(prompt, data, content_type=content_type, client_id=client_id, **options)
+            return 1
+        form = [("prompt", prompt), ("image", data, "reference", content_type), ("client_id", client_id)]
+        form += [(name, value) for name, value in options.items() if value is not None]
+        task = await api.request("submit", "POST", "/submit_by_reference", form=form)
+
+    # Как discord_bot.get_generated_files: long-poll до завершения задачи, затем все изображения
+    while True:
+        state = (await api.status(task["task_id"]))["status"]
+        if state == "completed":
+            return len(await api.images(task["task_id"]))
+        if state in FAILED_JOB_STATES:
+            raise JobFailed(state)
+
+
+async def run_event(api, event, references, started, records):
+    sent = time.perf_counter()
+    images = 0
+    try:
+        images = await send_event(api, event, references)
+        outcome = "ok"
+    except ApiError as e:
+        outcome = str(e.status) if e.status is not None else "connection"
+    except JobFailed as e:
+        outcome = e.state
+    except asyncio.TimeoutError:
+        outcome = "timeout"
+    except aiohttp.ClientError:
+        outcome = "connection"
+    except Exception as e:
+        logging.getLogger(__name__).error(f"{event_label(event)}: {e}")
+        outcome = "error"
+    records.append({
+        "label": event_label(event),
+        "endpoint": event["endpoint"],
+        "scheduled": event["t"],
+        "sent": sent - started,
+        "latency": time.perf_counter() - sent,
+        "outcome": outcome,
+        "images": images,
+    })
+
+
+async def report_progress(records, in_flight, started, window):
+    # Строка хода прогона раз в окно: сколько отправлено, в работе, готово и с ошибками
+    while True:
+        await asyncio.sleep(window)
+        errors = sum(1 for record in records if record["outcome"] != "ok")
+        print(f"{time.perf_counter() - started:7.0f} с  отправлено {len(records) + len(in_flight):5}  "
+              f"в работе {len(in_flight):4}  готово {len(records) - errors:5}  ошибок {errors:4}")
+
+
+async def replay(events, url, args, references):
+    """
+    Отправляет запросы по времени трассы (ускоренного в args.speed раз) и возвращает записи о них.
+    """
+    clients = {}
+    records = []
+    in_flight = set()
+    started = time.perf_counter()
+    progress = asyncio.create_task(report_progress(records, in_flight, started, args.window))
+    lag = 0.0
+    try:
+        for event in events:
+            delay = event["t"] / args.speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            lag = max(lag, -delay)
+            # Каждый бот — отдельный процесс со своим ApiClient и лимитом одновременных запросов
+            bot = event["client_id"].split(":", 1)[0]
+            if bot not in clients:
+                concurrency = MAX_CONCURRENT_REQUESTS if bot in ("discord", "telegram") else OTHER_CLIENTS_CONCURRENCY
+                clients[bot] = RecordingClient(url, max_concurrency=concurrency, max_retries=args.max_retries)
+            task = asyncio.create_task(run_event(clients[bot], event, references, started, records))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        await asyncio.gather(*in_flight)
+    finally:
+        progress.cancel()
+        for client in clients.values():
+            await client.close()
+    attempts = Counter()
+    for client in clients.values():
+        attempts.update(client.attempts)
+    return records, {"wall": time.perf_counter() - started, "max_send_lag": lag, "attempts": dict(attempts)}
+
+
+def summarize_records(records, wall):
+    ok = [record for record in records if record["outcome"] == "ok"]
+    outcomes = Counter(record["outcome"] for record in records)
+    images = sum(record["images"] for record in ok)
+    total = len(records)
+    return {
+        "requests": total,
+        "ok": len(ok),
+        "outcomes": dict(sorted(outcomes.items())),
+        "error_rate": (total - len(ok)) / total if total else 0.0,
+        "rate_429": outcomes.get("429", 0) / total if total else 0.0,
+        "images": images,
+        "images_per_sec": images / wall if wall else 0.0,
+        "latency": summarize([record["latency"] for record in ok]),
+    }
+
+
+def timeline(records, window):
+    """
+    Окна по window секунд: поступившие запросы (по времени отправки), завершённые, ошибки, 429,
+    изображения в секунду и задержки успешных запросов, завершившихся в окне.
+    """
+    if not records:
+        return []
+    last = max(record["sent"] + record["latency"] for record in records)
+    windows = [{"start": i * window, "arrived": 0, "completed": 0, "errors": 0, "rate_429": 0, "images": 0,
+                "latencies": []} for i in range(int(last // window) + 1)]
+    for record in records:
+        windows[int(record["sent"] // window)]["arrived"] += 1
+        current = windows[int((record["sent"] + record["latency"]) // window)]
+        current["completed"] += 1
+        if record["outcome"] == "ok":
+            current["images"] += record["images"]
+            current["latencies"].append(record["latency"])
+        else:
+            current["errors"] += 1
+            if record["outcome"] == "429":
+                current["rate_429"] += 1
+    for current in windows:
+        current["rate_429"] = current["rate_429"] / current["completed"] if current["completed"] else 0.0
+        current["images_per_sec"] = current["images"] / window
+        current["latency"] = summarize(current.pop("latencies"))
+    return windows
+
+
+def print_report(report):
+    def latency(stats):
+        if not stats:
+            return f"{'-':>8} {'-':>8} {'-':>8}"
+        return f"{stats['p50']:8.2f} {stats['p95']:8.2f} {stats['p99']:8.2f}"
+
+    print(f"\n{'команда':>30} {'запросов':>8} {'ошибок':>7} {'429':>6} {'img/s':>7} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for label, stats in [*report["commands"].items(), ("всего", report["summary"])]:
+        print(f"{label:>30} {stats['requests']:8} {stats['error_rate']:7.1%} {stats['rate_429']:6.1%} "
+              f"{stats['images_per_sec']:7.2f} {latency(stats['latency'])}")
+    print(f"\n{'окно, с':>8} {'пришло':>7} {'готово':>7} {'ошибок':>7} {'img/s':>7} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for window in report["timeline"]:
+        print(f"{window['start']:8.0f} {window['arrived']:7} {window['completed']:7} {window['errors']:7} "
+              f"{window['images_per_sec']:7.2f} {latency(window['latency'])}")
+    attempts = report["replay"]["attempts"]
+    print(f"\nОтветы сервера по попыткам: {attempts}; наибольшее отставание отправки "
+          f"{report['replay']['max_send_lag']:.2f} с")
+
+
+async def fetch_json(session, url):
+    try:
+        async with session.get(url) as res:
+            return await res.json() if res.status == 200 else None
+    except aiohttp.ClientError:
+        return None
+
+
+async def run_load(args, events):
+    process = None
+    url = args.url
+    if url is None:
+        process, url = start_server(args, tempfile.mkdtemp(prefix="loadgen_cache_"))
+
+    # Референсы синтезируются заранее, чтобы кодирование больших изображений не сбивало расписание
+    loop = asyncio.get_running_loop()
+    references = {}
+    for key in sorted({reference_key(event) for event in events
+                       if event["endpoint"] in ("generate_by_reference", "submit_by_reference")}):
+        width, height, image_format = key
+        references[key] = (await loop.run_in_executor(None, reference_image, width, height, image_format),
+                           CONTENT_TYPES[image_format])
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            startup = await wait_server(session, url, process)
+            async with session.delete(f"{url}/timings") as res:
+                res.raise_for_status()
+            records, replay_stats = await replay(events, url, args, references)
+            stages = await fetch_json(session, f"{url}/timings")
+            pipelines = await fetch_json(session, f"{url}/pipelines")
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    commands = {}
+    for label in sorted({record["label"] for record in records}):
+        commands[label] = summarize_records([record for record in records if record["label"] == label],
+                                            replay_stats["wall"])
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "config": {
+            "backend": args.backend if args.url is None else "external",
+            "step_ms": args.step_ms if args.backend == "stub" else None,
+            "ray_actors": args.ray_actors if args.backend == "ray" else None,
+            "url": args.url,
+            "batch_size": args.batch_size,
+            "memory_profile": args.memory_profile,
+            "trace": args.trace,
+            "synthetic": {name: getattr(args, name) for name in
+                          ("duration", "rate", "burst_every", "burst_duration", "burst_rate", "mix", "users", "seed")}
+            if args.synthetic else None,
+            "speed": args.speed,
+            "max_retries": args.max_retries,
+            "window": args.window,
+        },
+        "trace": {
+            "events": len(events),
+            "span": events[-1]["t"] if events else 0.0,
+            "commands": dict(Counter(event_label(event) for event in events)),
+        },
+        "startup": startup,
+        "replay": replay_stats,
+        "summary": summarize_records(records, replay_stats["wall"]),
+        "commands": commands,
+        "timeline": timeline(records, args.window),
+        "stages": stages,
+        "memory": (pipelines or {}).get("memory_profile"),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Воспроизведение трассы запросов ботов против server.py")
+    add_server_arguments(parser)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--trace", help="JSONL-трасса (например, записанная сервером через REQUEST_TRACE_PATH)")
+    source.add_argument("--synthetic", action="store_true", help="синтетическая трасса команд ботов")
+    parser.add_argument("--speed", type=float, default=1.0, help="во сколько раз ускорить время трассы")
+    parser.add_argument("--limit", type=int, help="воспроизвести только первые N запросов")
+    parser.add_argument("--duration", type=float, default=300.0, help="длительность синтетической трассы, с")
+    parser.add_argument("--rate", type=float, default=0.5, help="базовая интенсивность, запросов в секунду")
+    parser.add_argument("--burst-every", type=float, default=0.0, help="период всплесков, с (0 — без всплесков)")
+    parser.add_argument("--burst-duration", type=float, default=10.0, help="длительность всплеска, с")
+    parser.add_argument("--burst-rate", type=float, default=3.0, help="интенсивность во время всплеска, запросов в секунду")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="веса команд ботов: команда=вес через запятую")
+    parser.add_argument("--users", type=int, default=200, help="пользователей на бота")
+    parser.add_argument("--seed", type=int, default=0, help="seed синтетической трассы")
+    parser.add_argument("--write-trace", help="сохранить воспроизводимую трассу в JSONL")
+    parser.add_argument("--max-retries", type=int, default=MAX_RETRIES, help="повторов на 429/503, как у ботов")
+    parser.add_argument("--window", type=float, default=10.0, help="окно отчёта по времени, с")
+    parser.add_argument("--output", help="куда записать JSON (по умолчанию loadgen_<время>.json)")
+    args = parser.parse_args()
+    if args.speed <= 0 or args.window <= 0:
+        parser.error("--speed и --window должны быть положительными")
+    if args.synthetic:
+        if args.rate <= 0 or args.users < 1:
+            parser.error("--rate и --users должны быть положительными")
+        unknown = set(parse_weights(args.mix)) - set(BOT_COMMANDS)
+        if unknown:
+            parser.error(f"неизвестные команды: {', '.join(sorted(unknown))}. Доступны: {', '.join(BOT_COMMANDS)}")
+    return args
+
+
+def main():
+    args = parse_args()
+    # Повторы ApiClient на 429/503 попадают в отчёт, в консоли они не нужны
+    logging.getLogger("api_client").setLevel(logging.ERROR)
+    events = synthetic_trace(args) if args.synthetic else load_trace(args.trace)
+    if args.limit is not None:
+        events = events[:args.limit]
+    if args.write_trace:
+        with open(args.write_trace, "w", encoding="utf-8") as f:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+        print(f"Трасса записана в {args.write_trace}: {len(events)} запросов")
+    if not events:
+        print("Трасса пуста")
+        return
+
+    print(f"Воспроизведение {len(events)} запросов за {events[-1]['t'] / args.speed:.0f} с")
+    report = asyncio.run(run_load(args, events))
+    print_report(report)
+    output = args.output or f"loadgen_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+import gc
+import hashlib
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+
+import psutil
+
+from pipelines import module_size_bytes, synchronize
+
+logger = logging.getLogger("FastAPI")
+
+# Состояния модели: на устройстве, в RAM хоста, только на диске
+HOT = "hot"
+WARM = "warm"
+COLD = "cold"
+
+# Компоненты, которые модели с одинаковыми весами делят между собой, и что уходит вместе с ними
+SHAREABLE_COMPONENTS = {
+    "text_encoder": ("text_encoder", "tokenizer"),
+    "vae": ("vae",),
+}
+# Размер выборки из данных safetensors для отпечатка весов
+FINGERPRINT_SAMPLE_BYTES = 1024 * 1024
+# Доля памяти под веса, если бюджет не задан: на GPU остаётся место под активации, в RAM — под остальное
+AUTO_DEVICE_BUDGET_FRACTION = 0.7
+AUTO_HOST_BUDGET_FRACTION = 0.5
+
+
+def component_fingerprint(model_path, component):
+    """
+    Отпечаток весов компонента чекпоинта diffusers: заголовок safetensors (имена, формы и dtype тензоров)
+    и три выборки из данных. Файлы целиком не читаются — дообученные веса отличаются почти
+    во всех тензорах, и выборки хватает. None — если у компонента нет safetensors
+    (однофайловый чекпоинт или .bin): такие компоненты не делятся.
+    """
+    directory = os.path.join(model_path, component)
+    if not os.path.isdir(directory):
+        return None
+    files = sorted(name for name in os.listdir(directory) if name.endswith(".safetensors"))
+    if not files:
+        return None
+    digest = hashlib.sha256()
+    for name in files:
+        path = os.path.join(directory, name)
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            header_size = int.from_bytes(f.read(8), "little")
+            digest.update(f.read(header_size))
+            start = 8 + header_size
+            for offset in (start, start + (size - start) // 2, max(start, size - FINGERPRINT_SAMPLE_BYTES)):
+                f.seek(offset)
+                digest.update(f.read(FINGERPRINT_SAMPLE_BYTES))
+    return digest.hexdigest()
+
+
+@dataclass
+class ModelEntry:
+    name: str
+    path: str
+    state: str = COLD
+    registry: object = None  # PipelineRegistry, пока модель не выгружена на диск
+    embedding_cache: object = None
+    fingerprints: dict = field(default_factory=dict)  # компонент -> отпечаток весов
+    shared_from: dict = field(default_factory=dict)  # компонент -> модель, у которой он взят
+    last_used: float = 0.0
+    requests: int = 0
+    loads: int = 0  # загрузок с диска
+    promotions: int = 0  # переносов на устройство
+    evictions: int = 0  # вытеснений с устройства в RAM
+    unloads: int = 0  # выгрузок из RAM
+    timings: dict = field(default_factory=dict)  # последняя длительность: load, prepare, to_device, to_host, unload
+
+    def modules(self):
+        import torch
+
+        registry = self.registry
+        components = registry.components if registry is not None else None
+        if not components:
+            return {}
+        return {name: value for name, value in components.items() if isinstance(value, torch.nn.Module)}
+
+
+class ModelManager:
+    """
+    Реестр нескольких чекпоинтов с LRU-резидентностью.
+    - hot — веса на устройстве, warm — в RAM хоста, cold — только на диске.
+    - Запрошенная модель переносится на устройство; если веса не помещаются в device_budget,
+      давно не использованные горячие модели вытесняются в RAM. Если тёплые модели не помещаются
+      в host_budget, давно не использованные выгружаются совсем.
+    - Загрузка с диска идёт через safetensors (memory-mapped, без промежуточной копии в RAM).
+    - Текстовый энкодер (с токенизатором) и VAE с теми же весами, что у уже загруженной модели,
+      не загружаются второй раз, а берутся у неё; вместе с энкодером делится и кэш эмбеддингов.
+      Общий компонент остаётся на устройстве, пока он нужен хоть одной горячей модели.
+    - На CPU устройство и RAM совпадают: загруженная модель сразу горячая, бюджет — host_budget.
+    - move_weights=False (выгрузка моделей хуками accelerate, профиль offload): веса не переносятся,
+      модели только загружаются и выгружаются по host_budget, а компоненты не делятся
+      (хуки выгрузки связывают модули одного пайплайна в цепочку).
+    create_registry(path, shared_components) создаёт незагруженный PipelineRegistry,
+    prepare(entry) готовит модель после первого переноса на устройство (оптимизации,
+    кэш эмбеддингов в entry.embedding_cache, если он не достался от модели с тем же энкодером).
+    acquire вызывается только из потока инференса; stats — из любого потока.
+    """
+
+    def __init__(self, models, device, create_registry, prepare=None, device_budget=0, host_budget=0,
+                 move_weights=True):
+        import torch
+
+        self.entries = {name: ModelEntry(name=name, path=path) for name, path in models.items()}
+        self.device = device
+        self.create_registry = create_registry
+        self.prepare = prepare
+        self.tiered = torch.device(device).type != "cpu" and move_weights
+        self.move_weights = move_weights
+        self.host_budget = host_budget or int(psutil.virtual_memory().total * AUTO_HOST_BUDGET_FRACTION)
+        if not self.tiered:
+            self.device_budget = self.host_budget
+        elif device_budget:
+            self.device_budget = device_budget
+        else:
+            total = torch.cuda.get_device_properties(torch.device(device)).total_memory
+            self.device_budget = int(total * AUTO_DEVICE_BUDGET_FRACTION)
+        self.lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def is_hot(self, name):
+        entry = self.entries.get(name)
+        return entry is not None and entry.state == HOT
+
+    def acquire(self, name):
+        """
+        Делает модель горячей и возвращает её ModelEntry.
+        """
+        entry = self.entries.get(name)
+        if entry is None:
+            raise ValueError(f"Неизвестная модель: {name}. Доступны: {', '.join(self.entries)}")
+        with self.lock:
+            entry.last_used = time.time()
+            entry.requests += 1
+        if entry.state == HOT:
+            return entry
+        loaded = entry.state == COLD
+        if loaded:
+            self._load(entry)
+        if entry.state == WARM:
+            self._promote(entry)
+        if loaded and self.prepare is not None:
+            started = time.perf_counter()
+            self.prepare(entry)
+            with self.lock:
+                entry.timings["prepare"] = time.perf_counter() - started
+        return entry
+
+    def _load(self, entry):
+        # Освобождаем место заранее по размеру файлов: точный размер известен только после загрузки
+        self._fit_host(self._disk_bytes(entry), keep=entry)
+        shared = self._shared_components(entry)
+        started = time.perf_counter()
+        registry = self.create_registry(entry.path, shared)
+        # Многоуровневый режим переносит веса на устройство сам, выгрузка хуками — тоже
+        registry.load(device="cpu" if self.tiered or not self.move_weights else self.device)
+        with self.lock:
+            entry.registry = registry
+            entry.timings["load"] = time.perf_counter() - started
+            entry.loads += 1
+            entry.state = HOT if not self.tiered else WARM
+        logger.info(f"Модель {entry.name} загружена за {entry.timings['load']:.1f} с"
+                    + (f", общие компоненты: {entry.shared_from}" if entry.shared_from else ""))
+        self._fit_host(0, keep=entry)
+
+    def _disk_bytes(self, entry):
+        if os.path.isfile(entry.path):
+            return os.path.getsize(entry.path)
+        total = 0
+        for root, _, files in os.walk(entry.path):
+            total += sum(os.path.getsize(os.path.join(root, name)) for name in files if name.endswith(".safetensors"))
+        return total
+
+    def _shared_components(self, entry):
+        """
+        Компоненты уже загруженных моделей с теми же весами, что у entry.
+        """
+        entry.shared_from = {}
+        shared = {}
+        if not self.move_weights:
+            return shared
+        for component, names in SHAREABLE_COMPONENTS.items():
+            fingerprint = entry.fingerprints.get(component)
+            if component not in entry.fingerprints:
+                fingerprint = entry.fingerprints[component] = component_fingerprint(entry.path, component)
+            if fingerprint is None:
+                continue
+            for other in self.entries.values():
+                if other is entry or other.state == COLD or other.fingerprints.get(component) != fingerprint:
+                    continue
+                shared.update({name: other.registry.components[name] for name in names})
+                entry.shared_from[component] = other.name
+                if component == "text_encoder" and other.embedding_cache is not None:
+                    # Тот же энкодер — те же эмбеддинги
+                    entry.embedding_cache = other.embedding_cache
+                break
+        return shared
+
+    def _unique_bytes(self, entries, exclude=()):
+        # Объём модулей entries без повторов общих компонентов и без модулей из exclude
+        excluded = {id(module) for module in exclude}
+        seen = {}
+        for entry in entries:
+            for module in entry.modules().values():
+                if id(module) not in excluded:
+                    seen[id(module)] = module
+        return sum(module_size_bytes(module) for module in seen.values())
+
+    def _device_modules(self, exclude=None):
+        return [module for other in self.entries.values() if other.state == HOT and other is not exclude
+                for module in other.modules().values()]
+
+    def _promote(self, entry):
+        while True:
+            on_device = self._device_modules()
+            needed = self._unique_bytes([entry], exclude=on_device)
+            used = self._unique_bytes([other for other in self.entries.values() if other.state == HOT])
+            if used + needed <= self.device_budget:
+                break
+            victims = [other for other in self.entries.values() if other.state == HOT]
+            if not victims:
+                logger.warning(f"Модель {entry.name} больше бюджета устройства ({needed} > {self.device_budget} байт)")
+                break
+            self._evict(min(victims, key=lambda other: other.last_used))
+
+        started = time.perf_counter()
+        for module in entry.modules().values():
+            module.to(self.device)
+        if entry.embedding_cache is not None and hasattr(entry.embedding_cache, "to"):
+            entry.embedding_cache.to(self.device)
+        synchronize(self.device)
+        with self.lock:
+            entry.timings["to_device"] = time.perf_counter() - started
+            entry.promotions += 1
+            entry.state = HOT
+        logger.info(f"Модель {entry.name} перенесена на {self.device} за {entry.timings['to_device']:.2f} с")
+
+    def _evict(self, entry):
+        import torch
+
+        # С устройства уходят только модули, не нужные другим горячим моделям
+        started = time.perf_counter()
+        still_needed = {id(module) for module in self._device_modules(exclude=entry)}
+        moved = [module for module in entry.modules().values() if id(module) not in still_needed]
+        for module in moved:
+            module.to("cpu")
+        if entry.embedding_cache is not None and hasattr(entry.embedding_cache, "to") \
+                and id(entry.modules().get("text_encoder")) not in still_needed:
+            entry.embedding_cache.to("cpu")
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        with self.lock:
+            entry.timings["to_host"] = time.perf_counter() - started
+            entry.evictions += 1
+            entry.state = WARM
+        logger.info(f"Модель {entry.name} вытеснена в RAM за {entry.timings['to_host']:.2f} с")
+
+    def _fit_host(self, extra_bytes, keep=None):
+        # Выгружает давно не использованные модели, пока загруженное (и extra_bytes) не уложится в host_budget.
+        # В многоуровневом режиме горячие модели RAM почти не занимают и не выгружаются.
+        while True:
+            candidates = [other for other in self.entries.values()
+                          if other.state == (HOT if not self.tiered else WARM) and other is not keep]
+            loaded = [other for other in self.entries.values() if other.state in (WARM, HOT)
+                      and (not self.tiered or other.state == WARM)]
+            if self._unique_bytes(loaded) + extra_bytes <= self.host_budget or not candidates:
+                return
+            self._unload(min(candidates, key=lambda other: other.last_used))
+
+    def _unload(self, entry):
+        import torch
+
+        started = time.perf_counter()
+        entry.registry.unload()
+        with self.lock:
+            entry.registry = None
+            entry.embedding_cache = None
+            entry.shared_from = {}
+            entry.state = COLD
+            entry.unloads += 1
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        with self.lock:
+            entry.timings["unload"] = time.perf_counter() - started
+        logger.info(f"Модель {entry.name} выгружена за {entry.timings['unload']:.2f} с")
+
+    def loaded(self):
+        """
+        Загруженные модели (горячие и тёплые).
+        """
+        return [entry for entry in self.entries.values() if entry.state != COLD]
+
+    def stats(self):
+        with self.lock:
+            entries = list(self.entries.values())
+            models = {
+                entry.name: {
+                    "path": entry.path,
+                    "state": entry.state,
+                    "bytes": self._unique_bytes([entry]),
+                    "shared_from": dict(entry.shared_from),
+                    "last_used": entry.last_used,
+                    "requests": entry.requests,
+                    "loads": entry.loads,
+                    "promotions": entry.promotions,
+                    "evictions": entry.evictions,
+                    "unloads": entry.unloads,
+                    "timings": dict(entry.timings),
+                    "pipelines": entry.registry.stats() if entry.registry is not None else None,
+                }
+                for entry in entries
+            }
+        return {
+            "device": str(self.device),
+            "device_budget": self.device_budget if self.tiered else None,
+            "host_budget": self.host_budget,
+            "device_bytes": self._unique_bytes([entry for entry in entries if entry.state == HOT]) if self.tiered else None,
+            "models": models,
+        }
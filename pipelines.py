@@ -0,0 +1,434 @@
+import inspect
+import logging
+import math
+import os
+import random
+import time
+from dataclasses import dataclass
+
+logger = logging.getLogger("FastAPI")
+
+# Классы diffusers указаны по имени и импортируются при первом использовании:
+# импорт diffusers и transformers занимает секунды, а модулю при импорте они не нужны.
+
+# Типы пайплайнов, которые строятся поверх одних и тех же компонентов
+PIPELINE_CLASSES = {
+    "txt2img": "StableDiffusionPipeline",
+    "img2img": "StableDiffusionImg2ImgPipeline",
+    "inpaint": "StableDiffusionInpaintPipeline",
+}
+
+# Планировщики, которые можно выбрать в запросе: класс и поправки к конфигу чекпоинта.
+# "default" — планировщик из самого чекпоинта.
+SCHEDULERS = {
+    "default": None,
+    "dpmpp_2m": ("DPMSolverMultistepScheduler", {}),
+    "dpmpp_2m_karras": ("DPMSolverMultistepScheduler", {"use_karras_sigmas": True}),
+    "euler": ("EulerDiscreteScheduler", {}),
+    "euler_a": ("EulerAncestralDiscreteScheduler", {}),
+    "ddim": ("DDIMScheduler", {}),
+}
+
+
+def diffusers_class(name):
+    import diffusers
+
+    return getattr(diffusers, name)
+
+
+def module_size_bytes(module):
+    """
+    Размер параметров и буферов модуля в байтах.
+    """
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class PipelineRegistry:
+    """
+    Загружает веса модели один раз и строит поверх них пайплайны разных типов.
+    - UNet, VAE и текстовый энкодер общие для всех пайплайнов — в памяти одна копия.
+    - Пайплайны создаются лениво при первом обращении.
+    - Планировщики из SCHEDULERS создаются один раз из конфига чекпоинта и подменяются
+      в пайплайне перед вызовом, без перезагрузки весов.
+    - Планировщик общий и хранит состояние, поэтому пайплайны нельзя вызывать параллельно
+      (сервер вызывает их только из одного потока инференса).
+    - shared_components — уже загруженные компоненты другой модели с теми же весами
+      (текстовый энкодер, VAE): они не читаются с диска повторно (см. models.ModelManager).
+    model_path — каталог diffusers или однофайловый чекпоинт .safetensors/.ckpt.
+    """
+
+    def __init__(self, model_path, device="cuda", torch_dtype=None, shared_components=None):
+        import torch
+
+        self.model_path = model_path
+        self.device = device
+        # По умолчанию float16 (torch импортируется лениво, поэтому не в значении по умолчанию)
+        self.torch_dtype = torch.float16 if torch_dtype is None else torch_dtype
+        self.shared_components = shared_components or {}
+        self.components = None
+        self.pipelines = {}
+        self.schedulers = {}
+        self.timings = {}
+        self.component_stats = {}
+
+    def _read_weights(self):
+        cls = diffusers_class(PIPELINE_CLASSES["txt2img"])
+        if os.path.isfile(self.model_path):
+            return cls.from_single_file(
+                self.model_path,
+                torch_dtype=self.torch_dtype,
+                load_safety_checker=False,
+                **self.shared_components,
+            )
+        # safetensors читаются через mmap, и с low_cpu_mem_usage веса попадают в модули
+        # без промежуточной копии state_dict в RAM
+        return cls.from_pretrained(
+            self.model_path,
+            torch_dtype=self.torch_dtype,
+            safety_checker=None,
+            low_cpu_mem_usage=True,
+            **self.shared_components,
+        )
+
+    def load(self, device=None):
+        """
+        Загружает веса и переносит их на device (по умолчанию — self.device).
+        """
+        import torch
+
+        device = device or self.device
+        started = time.perf_counter()
+        base = self._read_weights()
+        self.timings["weight_load"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        # Общие компоненты остаются там, где их держит модель, у которой они взяты
+        for name, component in base.components.items():
+            if isinstance(component, torch.nn.Module) and name not in self.shared_components:
+                component.to(device)
+        synchronize(device)
+        self.timings["device_transfer"] = time.perf_counter() - started
+
+        self.components = base.components
+        self.pipelines["txt2img"] = base
+
+        for name, component in self.components.items():
+            if isinstance(component, torch.nn.Module):
+                self.component_stats[name] = {
+                    "class": type(component).__name__,
+                    "parameters": sum(p.numel() for p in component.parameters()),
+                    "bytes": module_size_bytes(component),
+                    "dtype": str(component.dtype) if hasattr(component, "dtype") else None,
+                    "device": str(component.device) if hasattr(component, "device") else None,
+                }
+
+        total_mb = sum(stats["bytes"] for stats in self.component_stats.values()) / (1024 * 1024)
+        logger.info(
+            f"Модель загружена за {self.timings['weight_load']:.1f} с, "
+            f"перенос на {device} — {self.timings['device_transfer']:.1f} с, всего {total_mb:.0f} МБ"
+        )
+        for name, stats in self.component_stats.items():
+            shared = " (общий)" if name in self.shared_components else ""
+            logger.info(f"  {name}: {stats['class']}, {stats['bytes'] / (1024 * 1024):.0f} МБ{shared}")
+
+    def unload(self):
+        """
+        Отпускает веса и пайплайны. Общие компоненты остаются у моделей, которые их тоже используют.
+        """
+        self.components = None
+        self.pipelines.clear()
+        self.schedulers.clear()
+        self.shared_components = {}
+
+    def get(self, kind):
+        """
+        Возвращает пайплайн нужного типа, собирая его из общих компонентов при первом запросе.
+        """
+        if self.components is None:
+            raise RuntimeError("Модель ещё не загружена")
+        if kind not in self.pipelines:
+            if kind not in PIPELINE_CLASSES:
+                raise ValueError(f"Неизвестный тип пайплайна: {kind}")
+            cls = diffusers_class(PIPELINE_CLASSES[kind])
+            accepted = inspect.signature(cls.__init__).parameters
+            components = {name: value for name, value in self.components.items() if name in accepted}
+            if "requires_safety_checker" in accepted:
+                components["requires_safety_checker"] = False
+            started = time.perf_counter()
+            self.pipelines[kind] = cls(**components)
+            self.timings[f"build_{kind}"] = time.perf_counter() - started
+            logger.info(f"Пайплайн {kind} собран из общих компонентов")
+        return self.pipelines[kind]
+
+    def replace_component(self, name, value):
+        """
+        Подменяет общий компонент (например, UNet на скомпилированный) во всех пайплайнах,
+        в том числе собираемых позже.
+        """
+        if self.components is None:
+            raise RuntimeError("Модель ещё не загружена")
+        self.components[name] = value
+        for pipe in self.pipelines.values():
+            setattr(pipe, name, value)
+
+    def scheduler(self, name):
+        """
+        Возвращает экземпляр планировщика name, создавая его при первом запросе.
+        """
+        if self.components is None:
+            raise RuntimeError("Модель ещё не загружена")
+        if name not in self.schedulers:
+            if name not in SCHEDULERS:
+                raise ValueError(f"Неизвестный планировщик: {name}")
+            base = self.components["scheduler"]
+            if SCHEDULERS[name] is None:
+                self.schedulers[name] = base
+            else:
+                class_name, overrides = SCHEDULERS[name]
+                cls = diffusers_class(class_name)
+                self.schedulers[name] = cls.from_config(base.config, **overrides)
+                logger.info(f"Планировщик {name} создан ({cls.__name__})")
+        return self.schedulers[name]
+
+    def stats(self):
+        return {
+            "model_path": self.model_path,
+            "device": str(self.device),
+            "dtype": str(self.torch_dtype),
+            "timings": self.timings,
+            "components": {
+                name: {**stats, "device": str(self.components[name].device)}
+                if self.components is not None and hasattr(self.components.get(name), "device") else stats
+                for name, stats in self.component_stats.items()
+            },
+            "pipelines": sorted(self.pipelines),
+            "schedulers": sorted(self.schedulers),
+        }
+
+
+# Параметры сэмплинга батча. Неизменяемые и хэшируемые: в один батч попадают
+# только запросы с одинаковыми параметрами.
+@dataclass(frozen=True)
+class SamplingParams:
+    steps: int
+    guidance: float
+    scheduler: str = "default"
+    negative_prompt: str = ""
+    width: int = None  # только txt2img; для img2img размер задаёт референс
+    height: int = None
+    strength: float = None  # только img2img
+    # Только txt2img: латентный hires — латенты базового размера увеличиваются в hires_scale раз
+    # и дорабатываются hires_steps шагами img2img с силой hires_strength (см. refine_hires)
+    hires_scale: float = None
+    hires_steps: int = None
+    hires_strength: float = None
+
+
+# Один запрос внутри батча в переносимом виде (без future), например для отправки в Ray-актор
+@dataclass
+class BatchRequest:
+    prompt: str
+    num_images: int
+    image: object = None
+    seed: int = None  # i-е изображение запроса генерируется с seed + i
+
+
+# Генераторы для батча: у запросов с seed детерминированный шум, остальным — случайный.
+# Отдельный генератор на каждое изображение делает результат независимым от соседей по батчу.
+def make_generators(items, device):
+    import torch
+
+    if all(item.seed is None for item in items):
+        return None
+    generators = []
+    for item in items:
+        base_seed = item.seed if item.seed is not None else random.randrange(2 ** 32)
+        for i in range(item.num_images):
+            generators.append(torch.Generator(device=device).manual_seed(base_seed + i))
+    return generators
+
+
+# Синхронизация с устройством, чтобы замер времени покрывал уже выполненную на GPU работу
+def synchronize(device):
+    import torch
+
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+# Устройство, на котором пайплайн считает: при выгрузке моделей в RAM (профиль offload)
+# веса между вызовами лежат на CPU, а pipe.device показывает именно их
+def execution_device(pipe):
+    return getattr(pipe, "_execution_device", pipe.device)
+
+
+# Размер выхода батча (ширина, высота) с учётом hires
+def output_size(kind, items, params):
+    if kind != "txt2img":
+        return items[0].image.size
+    if not params.hires_scale:
+        return params.width, params.height
+    return (round(params.width / 8 * params.hires_scale) * 8, round(params.height / 8 * params.hires_scale) * 8)
+
+
+# Шагов денойзинга на изображение: у img2img их меньше steps, у hires добавляется второй проход
+def denoising_steps(kind, params):
+    if kind != "txt2img":
+        return int(params.steps * params.strength)
+    return params.steps + (params.hires_steps if params.hires_scale else 0)
+
+
+def upscale_latents(latents, scale):
+    """
+    Увеличивает латенты (N, 4, h, w) в scale раз билинейной интерполяцией.
+    Деталей это не добавляет — их дорисовывает следующий за ним проход img2img.
+    """
+    import torch
+
+    height, width = latents.shape[-2:]
+    size = (round(height * scale), round(width * scale))
+    return torch.nn.functional.interpolate(latents, size=size, mode="bilinear", align_corners=False)
+
+
+# Все запросы батча отменены или просрочены — денойзинг прерывается из колбэка шага, чтобы освободить
+# устройство (локально и в Ray-акторе)
+class BatchCancelled(Exception):
+    pass
+
+
+# Колбэк шага для пайплайна: on_step(step, steps, latents) вызывается после каждого шага денойзинга.
+# latents — по одному на изображение, в порядке items; исключение из on_step прерывает батч.
+# Число шагов берём из пайплайна: у img2img оно меньше steps и зависит от strength.
+# Если передан marks, после последнего шага в него пишется время конца денойзинга ("denoised").
+def make_step_callback(on_step, marks=None):
+    if on_step is None and marks is None:
+        return {}
+
+    def callback(pipe, step, timestep, callback_kwargs):
+        if on_step is not None:
+            on_step(step + 1, pipe.num_timesteps, callback_kwargs["latents"])
+        if marks is not None and step + 1 == pipe.num_timesteps:
+            synchronize(execution_device(pipe))
+            marks["denoised"] = time.perf_counter()
+        return callback_kwargs
+
+    return {"callback_on_step_end": callback, "callback_on_step_end_tensor_inputs": ["latents"]}
+
+
+def run_pipeline_batch(registry, embedding_cache, kind, items, params, on_step=None, timings=None,
+                       latent_cache=None):
+    """
+    Синхронный батчевый вызов пайплайна.
+    items — объекты с полями prompt, num_images, image, seed (и необязательным reference_key);
+    params — SamplingParams батча;
+    on_step — необязательный колбэк шага (см. make_step_callback);
+    timings — необязательный StageTimings для стадий text_encoding, vae_encode, denoising и vae_decode;
+    latent_cache — необязательный ReferenceLatentCache: референсы img2img с reference_key
+    кодируются VAE один раз.
+    Возвращает список PIL-изображений в порядке items.
+    """
+    pipe = registry.get(kind)
+    pipe.scheduler = registry.scheduler(params.scheduler)
+    hires = kind == "txt2img" and bool(params.hires_scale)
+    generators = make_generators(items, execution_device(pipe))
+    if kind == "txt2img":
+        counts = {item.num_images for item in items}
+        if len(counts) == 1:
+            # У всех одинаковое количество — отдаём его через num_images_per_prompt
+            prompts = [item.prompt for item in items]
+            per_prompt = counts.pop()
+        else:
+            prompts = [item.prompt for item in items for _ in range(item.num_images)]
+            per_prompt = 1
+        extra = {"num_images_per_prompt": per_prompt, "width": params.width, "height": params.height}
+        if hires:
+            # Первый проход отдаёт латенты без декодирования VAE
+            extra["output_type"] = "latent"
+    else:
+        # img2img: диффузоры дублируют латенты картинок «по кругу», а не по промптам,
+        # поэтому разворачиваем пары промпт/картинка явно
+        prompts = [item.prompt for item in items for _ in range(item.num_images)]
+        images = [item.image for item in items for _ in range(item.num_images)]
+        if latent_cache is not None and all(getattr(item, "reference_key", None) for item in items):
+            encode_started = time.perf_counter()
+            keys = [f"{registry.model_path}:{item.reference_key}:{item.image.width}x{item.image.height}"
+                    for item in items for _ in range(item.num_images)]
+            images = latent_cache.encode(pipe, keys, images, generators)
+            if timings is not None:
+                synchronize(execution_device(pipe))
+                timings.record("vae_encode", time.perf_counter() - encode_started, len(keys))
+        extra = {"image": images, "strength": params.strength}
+    size = sum(item.num_images for item in items)
+
+    started = time.perf_counter()
+    prompt_embeds = embedding_cache.encode(prompts)
+    negative_prompt_embeds = embedding_cache.encode([params.negative_prompt] * len(prompts))
+    marks = None
+    if timings is not None:
+        synchronize(execution_device(pipe))
+        marks = {"encoded": time.perf_counter()}
+        timings.record("text_encoding", marks["encoded"] - started, size)
+
+    result = pipe(
+        prompt_embeds=prompt_embeds,
+        negative_prompt_embeds=negative_prompt_embeds,
+        num_inference_steps=params.steps,
+        guidance_scale=params.guidance,
+        generator=generators,
+        **extra,
+        **make_step_callback(on_step, marks),
+    ).images
+
+    if timings is not None:
+        finished = time.perf_counter()
+        denoised = marks.get("denoised", finished)
+        timings.record("denoising", denoised - marks["encoded"], size)
+        if not hires:
+            timings.record("vae_decode", finished - denoised, size)
+    if hires:
+        result = refine_hires(registry, embedding_cache, items, params, result, on_step=on_step, timings=timings)
+    return result
+
+
+def refine_hires(registry, embedding_cache, items, params, latents, on_step=None, timings=None):
+    """
+    Второй проход латентного hires: латенты базового размера увеличиваются в params.hires_scale раз
+    и дорабатываются img2img — без декодирования и повторного кодирования VAE между проходами.
+    img2img выполняет int(num_inference_steps * strength) шагов, поэтому число шагов
+    пересчитывается так, чтобы доработка заняла примерно params.hires_steps шагов.
+    Латенты идут в порядке изображений items, как их вернул первый проход.
+    """
+    pipe = registry.get("img2img")
+    pipe.scheduler = registry.scheduler(params.scheduler)
+    device = execution_device(pipe)
+    size = latents.shape[0]
+
+    started = time.perf_counter()
+    latents = upscale_latents(latents, params.hires_scale)
+    prompts = [item.prompt for item in items for _ in range(item.num_images)]
+    prompt_embeds = embedding_cache.encode(prompts)
+    negative_prompt_embeds = embedding_cache.encode([params.negative_prompt] * len(prompts))
+    marks = None
+    if timings is not None:
+        synchronize(device)
+        marks = {"encoded": time.perf_counter()}
+        timings.record("latent_upscale", marks["encoded"] - started, size)
+
+    result = pipe(
+        prompt_embeds=prompt_embeds,
+        negative_prompt_embeds=negative_prompt_embeds,
+        image=latents,
+        strength=params.hires_strength,
+        num_inference_steps=math.ceil(params.hires_steps / params.hires_strength),
+        guidance_scale=params.guidance,
+        generator=make_generators(items, device),
+        **make_step_callback(on_step, marks),
+    ).images
+
+    if timings is not None:
+        finished = time.perf_counter()
+        denoised = marks.get("denoised", finished)
+        timings.record("hires_denoising", denoised - marks["encoded"], size)
+        timings.record("vae_decode", finished - denoised, size)
+    return result
@@ -0,0 +1,38 @@
+import io
+
+from PIL import Image
+
+# Линейное приближение VAE-декодера SD 1.x: 4 канала латентов -> RGB.
+# Результат грубый, но считается одним умножением матриц вместо прохода VAE.
+LATENT_RGB_FACTORS = [
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177],
+]
+
+
+def latents_to_images(latents, scale=1):
+    """
+    Быстрое превью латентов (N, 4, h, w) без VAE.
+    Возвращает список PIL-изображений, увеличенных в scale раз
+    (латенты в 8 раз меньше картинки, поэтому без увеличения превью крошечное).
+    """
+    import torch
+
+    factors = torch.tensor(LATENT_RGB_FACTORS, dtype=latents.dtype, device=latents.device)
+    rgb = torch.einsum("nchw,cr->nhwr", latents, factors)
+    rgb = ((rgb + 1) / 2).clamp(0, 1).mul(255).to(torch.uint8).cpu().numpy()
+    images = [Image.fromarray(array) for array in rgb]
+    if scale != 1:
+        images = [image.resize((image.width * scale, image.height * scale), Image.BILINEAR) for image in images]
+    return images
+
+
+def encode_preview(image, quality=70):
+    """
+    Кодирует превью в JPEG: оно маленькое и уходит клиенту часто.
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
@@ -0,0 +1,61 @@
+import logging
+
+from tensor_cache import TensorLRUCache
+
+logger = logging.getLogger("FastAPI")
+
+
+class PromptEmbeddingCache(TensorLRUCache):
+    """
+    LRU-кэш эмбеддингов текстового энкодера CLIP (см. tensor_cache.TensorLRUCache).
+    - Ключ — токенизированный промпт, поэтому промпты, отличающиеся только
+      хвостом за пределами 77 токенов, делят одну запись.
+    - Промахи одного батча кодируются одним проходом энкодера.
+    - Объём ограничен max_bytes, вытесняются давно не использованные записи.
+    Результат передаётся в пайплайн через prompt_embeds / negative_prompt_embeds.
+    """
+
+    def __init__(self, tokenizer, text_encoder, max_bytes):
+        super().__init__(max_bytes)
+        self.tokenizer = tokenizer
+        self.text_encoder = text_encoder
+
+    def _tokenize(self, prompts):
+        return self.tokenizer(
+            prompts,
+            padding="max_length",
+            max_length=self.tokenizer.model_max_length,
+            truncation=True,
+            return_tensors="pt",
+        )
+
+    def _encode_ids(self, input_ids, attention_mask):
+        import torch
+
+        device = self.text_encoder.device
+        if not getattr(self.text_encoder.config, "use_attention_mask", False):
+            attention_mask = None
+        elif attention_mask is not None:
+            attention_mask = attention_mask.to(device)
+        with torch.inference_mode():
+            embeds = self.text_encoder(input_ids.to(device), attention_mask=attention_mask)[0]
+        return embeds.to(dtype=self.text_encoder.dtype)
+
+    def encode(self, prompts):
+        """
+        Возвращает эмбеддинги для списка промптов одним тензором (len(prompts), seq_len, hidden).
+        """
+        text_inputs = self._tokenize(prompts)
+        keys = [tuple(ids) for ids in text_inputs.input_ids.tolist()]
+        return self.lookup(keys, lambda rows: self._encode_ids(text_inputs.input_ids[rows],
+                                                               text_inputs.attention_mask[rows]))
+
+    def warmup(self, prompts):
+        """
+        Заранее кодирует промпты, которые используются постоянно (например, негативный),
+        и закрепляет их в кэше.
+        """
+        prompts = list(prompts)
+        self.encode(prompts)
+        self.pin(tuple(ids) for ids in self._tokenize(prompts).input_ids.tolist())
+        logger.info(f"Эмбеддинги предвычислены для {len(prompts)} промптов")
@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import math
+import threading
+import uuid
+
+import numpy as np
+import ray
+from PIL import Image
+from ray.util.scheduling_strategies import NodeAffinitySchedulingStrategy
+
+from devices import (ProfileStats, configure_threads, enable_compile_cache, optimize_pipelines, resolve_device,
+                     select_dtype)
+from pipelines import BatchCancelled, BatchRequest, PipelineRegistry, denoising_steps, output_size, run_pipeline_batch
+from prompt_cache import PromptEmbeddingCache
+
+logger = logging.getLogger("FastAPI")
+
+# Параллельных вызовов на актор: батчи всё равно идут по одному (под блокировкой),
+# а остальные потоки нужны, чтобы cancel и stats не ждали конца батча
+ACTOR_MAX_CONCURRENCY = 4
+# Как часто пул проверяет, не пора ли прервать батч на акторе, секунд
+CANCEL_POLL_SECONDS = 0.25
+
+
+class InferenceActor:
+    """
+    Долгоживущий Ray-актор: загружает модель один раз и выполняет батчи.
+    Изображения принимает и возвращает как uint8-массивы, чтобы они шли через
+    object store без пикла PIL-объектов.
+    Батч, отменённый через cancel, прерывается на ближайшем шаге денойзинга с BatchCancelled.
+    """
+
+    def __init__(self, model_path, device, dtype, memory_profile, embedding_cache_bytes, warmup_prompts,
+                 threads=(0, 0), compile_unet=False, compile_mode="default", compile_cache_dir=None):
+        # Те же настройки PyTorch, что у локального бэкенда (server.load_models)
+        configure_threads(*threads)
+        if compile_cache_dir is not None:
+            enable_compile_cache(compile_cache_dir)
+        device = resolve_device(device)
+        self.registry = PipelineRegistry(model_path, device=device, torch_dtype=select_dtype(device, dtype))
+        self.registry.load()
+        optimize_pipelines(self.registry, compile_unet=compile_unet, compile_mode=compile_mode,
+                           memory_profile=memory_profile)
+        self.profile_stats = ProfileStats(memory_profile, device)
+        pipe = self.registry.get("txt2img")
+        self.embedding_cache = PromptEmbeddingCache(pipe.tokenizer, pipe.text_encoder, max_bytes=embedding_cache_bytes)
+        self.embedding_cache.warmup(warmup_prompts)
+        self.lock = threading.Lock()
+        self.active = set()
+        self.cancelled = set()
+
+    def ready(self):
+        return ray.get_runtime_context().get_node_id()
+
+    def warmup(self, batches):
+        """
+        Прогрев теми же батчами (kind, requests, params), что и локальный server.warmup_models:
+        первые запросы не платят за инициализацию ядер и torch.compile.
+        """
+        with self.lock:
+            for kind, requests, params in batches:
+                run_pipeline_batch(self.registry, self.embedding_cache, kind, requests, params)
+
+    def cancel(self, batch_id):
+        # Батч, который уже завершился (или ещё не пришёл), не запоминаем
+        if batch_id in self.active:
+            self.cancelled.add(batch_id)
+
+    def generate(self, kind, requests, params, batch_id=None):
+        self.active.add(batch_id)
+        try:
+            for request in requests:
+                if request.image is not None:
+                    request.image = Image.fromarray(request.image)
+            images_count = sum(request.num_images for request in requests)
+            with self.lock:
+                # Батч могли отменить, пока он ждал предыдущий
+                if batch_id in self.cancelled:
+                    raise BatchCancelled()
+
+                def on_step(step, steps, latents):
+                    if batch_id in self.cancelled:
+                        raise BatchCancelled()
+
+                with self.profile_stats.measure(output_size(kind, requests, params), images_count,
+                                                denoising_steps(kind, params)):
+                    images = run_pipeline_batch(self.registry, self.embedding_cache, kind, requests, params,
+                                                on_step=on_step)
+        finally:
+            self.active.discard(batch_id)
+            self.cancelled.discard(batch_id)
+        # Один непрерывный массив (N, H, W, 3) — читается из object store без копирования
+        return np.stack([np.asarray(image.convert("RGB")) for image in images])
+
+    def stats(self):
+        return {"pipelines": self.registry.stats(), "prompt_embeddings": self.embedding_cache.stats(),
+                "memory_profile": self.profile_stats.stats()}
+
+
+def gpus_per_actor(node_gpus, actors_per_node):
+    """
+    Сколько GPU запросить на актор. Ray принимает либо целое число GPU, либо долю одной GPU,
+    причём акторы с долями должны целиком помещаться на отдельные GPU: 4 GPU на 3 актора — по 1 GPU,
+    2 GPU на 3 актора — по 1/2 (два актора на одной GPU, один на другой).
+    """
+    node_gpus = int(node_gpus)
+    if actors_per_node <= node_gpus:
+        return node_gpus // actors_per_node
+    return 1 / math.ceil(actors_per_node / node_gpus)
+
+
+class RayActorPool:
+    """
+    Пул Ray-акторов инференса.
+    - На каждый живой узел кластера ставится actors_per_node акторов.
+    - На GPU-узлах акторы делят GPU узла (см. gpus_per_actor).
+    - Батч отправляется актору с наименьшим числом изображений в работе.
+    - Акторы настраивают потоки и torch.compile так же, как локальный бэкенд, и прогреваются
+      батчами warmup_batches до того, как start() вернёт управление.
+    Локальная проверка без GPU — на локальном кластере с маленькой моделью на CPU:
+    python benchmark.py --backend ray (или loadgen.py --backend ray).
+    """
+
+    def __init__(self, model_path, actors_per_node=1, device="auto", dtype="auto", memory_profile="balanced",
+                 embedding_cache_bytes=64 * 1024 ** 2, warmup_prompts=("",), threads=(0, 0), compile_unet=False,
+                 compile_mode="default", compile_cache_dir=None, warmup_batches=()):
+        self.model_path = model_path
+        self.actors_per_node = max(1, actors_per_node)
+        self.device = device
+        self.dtype = dtype
+        self.memory_profile = memory_profile
+        self.embedding_cache_bytes = embedding_cache_bytes
+        self.warmup_prompts = list(warmup_prompts)
+        self.threads = tuple(threads)
+        self.compile_unet = compile_unet
+        self.compile_mode = compile_mode
+        self.compile_cache_dir = compile_cache_dir
+        self.warmup_batches = list(warmup_batches)
+        self.actors = []
+        self.load = []  # изображений в работе у каждого актора
+
+    def __len__(self):
+        return len(self.actors)
+
+    def start(self):
+        actor_cls = ray.remote(InferenceActor)
+        for node in ray.nodes():
+            if not node["Alive"]:
+                continue
+            node_gpus = node["Resources"].get("GPU", 0)
+            # "auto" занимает GPU там, где они есть; на узлах без GPU актор работает на CPU
+            use_gpu = self.device in ("auto", "cuda") and node_gpus >= 1
+            num_gpus = gpus_per_actor(node_gpus, self.actors_per_node) if use_gpu else 0
+            for _ in range(self.actors_per_node):
+                actor = actor_cls.options(
+                    num_cpus=1,
+                    num_gpus=num_gpus,
+                    max_concurrency=ACTOR_MAX_CONCURRENCY,
+                    scheduling_strategy=NodeAffinitySchedulingStrategy(node["NodeID"], soft=False),
+                ).remote(self.model_path, self.device, self.dtype, self.memory_profile, self.embedding_cache_bytes,
+                         self.warmup_prompts, self.threads, self.compile_unet, self.compile_mode,
+                         self.compile_cache_dir)
+                self.actors.append(actor)
+                self.load.append(0)
+
+        if not self.actors:
+            raise RuntimeError("В кластере Ray нет живых узлов для акторов инференса")
+        # Ждём, пока все акторы загрузят модель и прогреются
+        nodes = ray.get([actor.ready.remote() for actor in self.actors])
+        if self.warmup_batches:
+            ray.get([actor.warmup.remote(self.warmup_batches) for actor in self.actors])
+            logger.info("Ray: акторы инференса прогреты")
+        logger.info(f"Ray: запущено акторов инференса — {len(self.actors)} на {len(set(nodes))} узлах")
+
+    async def run(self, kind, items, params, should_abort=None):
+        """
+        Выполняет батч на наименее загруженном акторе и возвращает PIL-изображения.
+        should_abort() опрашивается каждые CANCEL_POLL_SECONDS; когда он вернёт True, актор прерывает
+        батч на ближайшем шаге денойзинга, а run поднимает BatchCancelled.
+        """
+        requests = [
+            BatchRequest(
+                prompt=item.prompt,
+                num_images=item.num_images,
+                image=np.asarray(item.image) if item.image is not None else None,
+                seed=item.seed,
+            )
+            for item in items
+        ]
+        size = sum(request.num_images for request in requests)
+        index = min(range(len(self.actors)), key=self.load.__getitem__)
+        actor = self.actors[index]
+        batch_id = uuid.uuid4().hex
+        watcher = asyncio.create_task(self._watch(actor, batch_id, should_abort)) if should_abort else None
+        self.load[index] += size
+        try:
+            # ObjectRef можно ждать прямо в asyncio, event loop не блокируется
+            array = await actor.generate.remote(kind, requests, params, batch_id)
+        except ray.exceptions.RayTaskError as e:
+            if isinstance(e.cause, BatchCancelled):
+                raise BatchCancelled() from None
+            raise
+        finally:
+            self.load[index] -= size
+            if watcher is not None:
+                watcher.cancel()
+        return [Image.fromarray(image) for image in array]
+
+    @staticmethod
+    async def _watch(actor, batch_id, should_abort):
+        # Отмену повторяем до конца батча: первая могла прийти на актор раньше самого generate
+        while True:
+            if should_abort():
+                actor.cancel.remote(batch_id)
+            await asyncio.sleep(CANCEL_POLL_SECONDS)
+
+    def stats(self):
+        return {"actors": len(self.actors), "actors_per_node": self.actors_per_node, "load": list(self.load)}
+
+    async def actor_stats(self):
+        """
+        Статистика каждого актора (InferenceActor.stats): пайплайны, кэш эмбеддингов и профиль памяти.
+        Актор, не ответивший на запрос, представлен ошибкой.
+        """
+        results = await asyncio.gather(*(actor.stats.remote() for actor in self.actors), return_exceptions=True)
+        return [{"error": str(result)} if isinstance(result, Exception) else result for result in results]
@@ -0,0 +1,105 @@
+import io
+import logging
+
+from PIL import Image, ImageOps
+
+from tensor_cache import TensorLRUCache
+
+logger = logging.getLogger("FastAPI")
+
+# Форматы, которые PIL умеет декодировать сразу в уменьшенном масштабе (draft)
+DRAFT_FORMATS = ("JPEG",)
+
+
+class ReferenceRejected(ValueError):
+    """
+    Референс отклонён при приёме: не изображение, повреждён или слишком большой.
+    status — HTTP-код ответа клиенту.
+    """
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def decode_reference(data, max_side, max_pixels):
+    """
+    Декодирует загруженный референс в RGB не больше max_side по длинной стороне,
+    со сторонами, кратными 8.
+    - Число пикселей проверяется по заголовку до декодирования (защита от «бомб»).
+    - JPEG декодируется сразу в уменьшенном масштабе (draft: 1/2, 1/4, 1/8).
+    - Учитывается EXIF-поворот фотографий с телефона.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ReferenceRejected(f"Не удалось открыть референс: {e}")
+    if image.width * image.height > max_pixels:
+        raise ReferenceRejected(f"Референс слишком большой: {image.width}x{image.height}", status=413)
+    if image.format in DRAFT_FORMATS:
+        image.draft("RGB", (max_side, max_side))
+    try:
+        image = ImageOps.exif_transpose(image).convert("RGB")
+    except OSError as e:
+        raise ReferenceRejected(f"Не удалось декодировать референс: {e}")
+
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    size = (max(8, image.width // 8 * 8), max(8, image.height // 8 * 8))
+    if size != image.size:
+        image = image.resize(size, Image.LANCZOS)
+    return image
+
+
+def image_bytes(image):
+    # RGB, 3 байта на пиксель
+    return image.width * image.height * 3
+
+
+class DecodedReferenceCache(TensorLRUCache):
+    """
+    LRU-кэш декодированных и уменьшенных референсов (PIL.Image, get/put из tensor_cache.TensorLRUCache).
+    - Ключ — хэш содержимого файла и наибольшая сторона, поэтому повторная генерация
+      по той же картинке не декодирует её заново.
+    - Объём ограничен max_bytes (RGB, 3 байта на пиксель).
+    Изображения из кэша общие для всех запросов и не должны изменяться на месте.
+    """
+
+    def __init__(self, max_bytes):
+        super().__init__(max_bytes, size=image_bytes)
+
+
+class ReferenceLatentCache(TensorLRUCache):
+    """
+    LRU-кэш латентов VAE для референсов img2img (см. tensor_cache.TensorLRUCache).
+    - Ключ — модель, хэш содержимого референса и размер, с которым он уходит в пайплайн.
+    - Хранится распределение энкодера (среднее и std, 8 каналов), а латенты сэмплируются из него
+      генератором запроса — как при кодировании референса самим пайплайном, поэтому результат
+      с seed не зависит от того, попал ли референс в кэш, в смешанный батч или на Ray-актор.
+    - Промахи одного батча кодируются одним проходом VAE.
+    Результат передаётся в img2img через image: латенты (4 канала) пайплайн не кодирует повторно.
+    """
+
+    def _encode_images(self, pipe, images):
+        import torch
+
+        vae = pipe.vae
+        with torch.inference_mode():
+            pixels = pipe.image_processor.preprocess(images).to(device=vae.device, dtype=vae.dtype)
+            latent_dist = vae.encode(pixels).latent_dist
+            return torch.cat([latent_dist.mean, latent_dist.std], dim=1)
+
+    def encode(self, pipe, keys, images, generators=None):
+        """
+        Возвращает латенты для списка изображений одним тензором (len(images), 4, h / 8, w / 8).
+        keys[i] — ключ кэша i-го изображения; изображения батча одного размера.
+        generators — генераторы изображений (см. pipelines.make_generators) или None.
+        """
+        import torch
+        from diffusers.utils.torch_utils import randn_tensor
+
+        moments = self.lookup(keys, lambda rows: self._encode_images(pipe, [images[i] for i in rows]))
+        mean, std = moments.chunk(2, dim=1)
+        with torch.inference_mode():
+            # Тот же сэмплинг, что в DiagonalGaussianDistribution.sample: по шуму на генератор
+            noise = randn_tensor(mean.shape, generator=generators, device=mean.device, dtype=mean.dtype)
+            return (mean + std * noise) * pipe.vae.config.scaling_factor
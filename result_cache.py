@@ -0,0 +1,239 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger("FastAPI")
+
+INDEX_FILENAME = "index.json"
+# Расширения файлов результатов (по пресетам encoding) — для восстановления индекса по файлам
+RESULT_EXTENSIONS = (".png", ".webp", ".jpg")
+# Индекс переписывается не чаще раза в столько секунд: записи за это время сливаются в одну
+INDEX_SAVE_DELAY = 1.0
+
+
+def make_cache_key(**params):
+    """
+    Ключ результата — хэш всех параметров, от которых зависит картинка.
+    """
+    payload = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def write_index(path, entries):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(entries, f)
+    os.replace(tmp_path, path)
+
+
+def write_file(path, data):
+    # Пишем во временный файл и переименовываем, чтобы не оставить обрезанную запись
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class ResultCache:
+    """
+    Кэш готовых изображений, адресуемый по хэшу параметров генерации.
+    - Индекс хранится в памяти и в index.json, попадание не трогает GPU. index.json переписывается
+      в потоке, отложенно: изменения за INDEX_SAVE_DELAY секунд сливаются в одну запись.
+    - Одинаковые запросы, выполняющиеся одновременно, ждут одну генерацию.
+    - При превышении max_bytes удаляются давно не использованные записи (LRU).
+    - Хранит и отдаёт закодированные байты; чтение и запись файлов идут в потоках.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> {"path", "size", "created_at"}
+        self.total_bytes = 0
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.index_dirty = False
+        self.index_saver = None
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.cache_dir, INDEX_FILENAME)
+
+    def _load_index(self):
+        entries = []
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Не удалось прочитать индекс кэша, пересобираем: {e}")
+                entries = []
+        if not entries:
+            # Индекса нет — восстанавливаем по файлам, старые сначала
+            for name in os.listdir(self.cache_dir):
+                stem, extension = os.path.splitext(name)
+                if extension in RESULT_EXTENSIONS:
+                    path = os.path.join(self.cache_dir, name)
+                    entries.append({"key": stem, "path": path, "size": os.path.getsize(path),
+                                    "created_at": os.path.getmtime(path)})
+            entries.sort(key=lambda entry: entry["created_at"])
+
+        for entry in entries:
+            if os.path.exists(entry["path"]):
+                self.entries[entry["key"]] = {k: v for k, v in entry.items() if k != "key"}
+                self.total_bytes += entry["size"]
+        logger.info(f"Кэш результатов: {len(self.entries)} записей, {self.total_bytes / (1024 * 1024):.1f} МБ")
+
+    def _index_snapshot(self):
+        return [{"key": key, **entry} for key, entry in self.entries.items()]
+
+    def _schedule_index_save(self):
+        self.index_dirty = True
+        if self.index_saver is None or self.index_saver.done():
+            self.index_saver = asyncio.create_task(self._save_index_later())
+
+    async def _save_index_later(self):
+        # Снимок индекса берётся в event loop, пишется в потоке; изменения во время записи уходят следующей
+        while self.index_dirty:
+            await asyncio.sleep(INDEX_SAVE_DELAY)
+            self.index_dirty = False
+            try:
+                await asyncio.to_thread(write_index, self.index_path, self._index_snapshot())
+            except OSError as e:
+                logger.warning(f"Не удалось записать индекс кэша: {e}")
+
+    async def flush(self):
+        """
+        Записывает отложенные изменения индекса (при остановке сервера).
+        """
+        if self.index_saver is not None and not self.index_saver.done():
+            self.index_saver.cancel()
+            await asyncio.gather(self.index_saver, return_exceptions=True)
+        if self.index_dirty:
+            self.index_dirty = False
+            await asyncio.to_thread(write_index, self.index_path, self._index_snapshot())
+
+    async def get(self, key):
+        """
+        Возвращает байты результата или None, если записи нет.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        try:
+            return await asyncio.to_thread(read_file, entry["path"])
+        except FileNotFoundError:
+            if self.entries.get(key) is entry:
+                self._drop(key)
+                self._schedule_index_save()
+            return None
+
+    async def put(self, key, data, extension=".png"):
+        """
+        Сохраняет байты результата в кэш; extension — расширение их формата.
+        """
+        cached_path = os.path.join(self.cache_dir, f"{key}{extension}")
+        await asyncio.to_thread(write_file, cached_path, data)
+        if key in self.entries:
+            previous = self.entries[key]
+            if previous["path"] != cached_path:
+                self._drop(key)
+            else:
+                self.total_bytes -= self.entries.pop(key)["size"]
+        self.entries[key] = {"path": cached_path, "size": len(data), "created_at": time.time()}
+        self.total_bytes += len(data)
+        self._evict()
+        self._schedule_index_save()
+
+    def _drop(self, key):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry["size"]
+        try:
+            os.remove(entry["path"])
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            key = next(iter(self.entries))
+            self._drop(key)
+            self.evictions += 1
+
+    async def get_or_create(self, key, factory, extension=".png", on_start=None):
+        """
+        Возвращает результат из кэша, либо дожидается уже идущей генерации с тем же ключом,
+        либо запускает factory() — корутину, возвращающую байты нового результата в формате extension.
+        Генерация идёт в отдельной задаче, общей для всех ожидающих: отмена одного из них
+        (в том числе того, кто её запустил) не задевает остальных, а отменяется генерация,
+        только когда уходит последний ожидающий.
+        on_start(task) вызывается, как только ясно, откуда придёт результат: task — задача генерации,
+        запущенной этим вызовом (до её первого шага), или None, если результат взят из кэша
+        или уже идущей генерации.
+        """
+        cached = await self.get(key)
+        if cached is not None:
+            self.hits += 1
+            logger.info(f"Кэш: попадание {key[:12]}")
+            if on_start is not None:
+                on_start(None)
+            return cached
+
+        flight = self.inflight.get(key)
+        shared = flight is not None
+        if not shared:
+            self.misses += 1
+            flight = {"task": asyncio.create_task(self._create(key, factory, extension)), "waiters": 0}
+            self.inflight[key] = flight
+        else:
+            self.coalesced += 1
+        if on_start is not None:
+            on_start(None if shared else flight["task"])
+        flight["waiters"] += 1
+        try:
+            return await asyncio.shield(flight["task"])
+        finally:
+            flight["waiters"] -= 1
+            if flight["waiters"] == 0 and not flight["task"].done():
+                # Результат больше никому не нужен; новый запрос с тем же ключом запустит генерацию заново
+                flight["task"].cancel()
+                if self.inflight.get(key) is flight:
+                    del self.inflight[key]
+
+    async def _create(self, key, factory, extension):
+        try:
+            data = await factory()
+            await self.put(key, data, extension)
+            return data
+        finally:
+            flight = self.inflight.get(key)
+            if flight is not None and flight["task"] is asyncio.current_task():
+                del self.inflight[key]
+
+    def stats(self):
+        # Присоединившиеся к идущей генерации — тоже обращения: без них доля попаданий завышена
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "coalesced_rate": self.coalesced / lookups if lookups else 0.0,
+        }
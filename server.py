@@ -1,113 +1,1080 @@
 import os
 import uuid
 import logging
-import torch
-import ray
 import psutil
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from diffusers import StableDiffusionPipeline, StableDiffusionImg2ImgPipeline
+from typing import Optional
 from PIL import Image
-import numpy as np
-import tempfile
 import asyncio
-import cv2
+import base64
 import io
-from torch.cuda.amp import autocast  # Для ускорения работы с пониженной точностью
+import hashlib
+import json
+import math
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass, field, replace
+from functools import partial
+from bulk import BulkError, BulkRun, parse_rows, run_root
+from devices import (MEMORY_PROFILES, ProfileStats, configure_threads, enable_compile_cache, optimize_pipelines,
+                     resolve_device, select_dtype)
+from encoding import PRESETS, OutputSpec, encode_image
+from fair_queue import PRIORITIES, Client, FairQueue
+from jobs import CANCELLED, EXPIRED, FAILED, JobStore, Preview
+from lifecycle import Startup
+from models import COLD, HOT, WARM, ModelManager
+from pipelines import (SCHEDULERS, BatchCancelled, BatchRequest, PipelineRegistry, SamplingParams, denoising_steps,
+                       output_size, run_pipeline_batch)
+from previews import encode_preview, latents_to_images
+from prompt_cache import PromptEmbeddingCache
+from references import DecodedReferenceCache, ReferenceLatentCache, ReferenceRejected, decode_reference
+from result_cache import ResultCache, make_cache_key
+from timings import StageTimings, prometheus_gauge
+from upscalers import UPSCALER_FACTORIES, get_upscaler
 
-# Инициализация Ray
 logger = logging.getLogger("FastAPI")
 logging.basicConfig(level=logging.INFO)
 
-logger.info("Инициализация Ray...")
-ray.init(ignore_reinit_error=True, logging_level=logging.INFO)
-logger.info("Ray инициализирован ✅")
+# Жизненный цикл: при импорте модуля модель не загружается. После старта uvicorn она грузится
+# и прогревается в фоне (см. start_models), готовность видна на /ready.
+@asynccontextmanager
+async def lifespan(app):
+    await on_startup()
+    yield
+    await on_shutdown()
 
 # Инициализация FastAPI
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Параметры
-MODEL_PATH = r"E:\spammer\Myproject\stable-diffusion-webui\models\converted_anythingv3"
-CACHE_DIR = r"E:\spammer\Myproject\models\cache"
-MAX_SIZE = (512, 512)
-
-# Создание кэш директории
-os.makedirs(CACHE_DIR, exist_ok=True)
-logger.info(f"Кэш директория создана: {CACHE_DIR}")
-
-# Загрузка моделей
-logger.info("Загрузка моделей...")
-
-try:
-    txt2img_pipe = StableDiffusionPipeline.from_pretrained(
-        MODEL_PATH,
-        torch_dtype=torch.float16,
-        safety_checker=None,
-    ).to("cuda")
-    
-    img2img_pipe = StableDiffusionImg2ImgPipeline.from_pretrained(
-        MODEL_PATH,
-        torch_dtype=torch.float16,
-        safety_checker=None,
-    ).to("cuda")
+MODEL_PATH = os.getenv("MODEL_PATH", r"E:\spammer\Myproject\stable-diffusion-webui\models\converted_anythingv3")
+# Несколько чекпоинтов: MODELS — JSON {"имя": "каталог diffusers или файл .safetensors"}, по умолчанию
+# одна модель "default" из MODEL_PATH. Модель выбирается полем model запроса, без него — DEFAULT_MODEL.
+# Модели держатся в памяти по LRU (см. models.ModelManager): на устройстве — пока веса умещаются
+# в MODEL_DEVICE_BUDGET_BYTES, в RAM — в MODEL_HOST_BUDGET_BYTES (0 — 70% видеопамяти и 50% RAM).
+# В режиме Ray доступна только модель по умолчанию.
+MODELS = json.loads(os.getenv("MODELS", "{}")) or {"default": MODEL_PATH}
+DEFAULT_MODEL = os.getenv("DEFAULT_MODEL") or next(iter(MODELS))
+MODEL_DEVICE_BUDGET_BYTES = int(os.getenv("MODEL_DEVICE_BUDGET_BYTES", "0"))
+MODEL_HOST_BUDGET_BYTES = int(os.getenv("MODEL_HOST_BUDGET_BYTES", "0"))
+# Устройство инференса: "auto" (CUDA, если доступна, иначе CPU), "cuda", "cuda:1" или "cpu"
+INFERENCE_DEVICE = os.getenv("INFERENCE_DEVICE", "auto")
+# dtype весов: "auto" (float16 на CUDA, float32 на CPU), "float16", "bfloat16" или "float32"
+INFERENCE_DTYPE = os.getenv("INFERENCE_DTYPE", "auto")
+# Потоки PyTorch для инференса на CPU (0 — по умолчанию PyTorch, по числу ядер)
+TORCH_INTRA_OP_THREADS = int(os.getenv("TORCH_INTRA_OP_THREADS", "0"))
+TORCH_INTER_OP_THREADS = int(os.getenv("TORCH_INTER_OP_THREADS", "0"))
+# torch.compile для UNet: кэш компиляции в CACHE_DIR/torch_compile, граф прогревается при старте
+TORCH_COMPILE = os.getenv("TORCH_COMPILE", "0") == "1"
+TORCH_COMPILE_MODE = os.getenv("TORCH_COMPILE_MODE", "default")
+# Профиль памяти (devices.MEMORY_PROFILES): "speed", "balanced", "low_vram" или "offload".
+# Пиковая память и скорость активного профиля по размерам выхода — в /pipelines и /metrics.
+MEMORY_PROFILE = os.getenv("MEMORY_PROFILE", "balanced")
+# "diffusers" — настоящая модель, "stub" — заглушка без весов с фиксированной стоимостью шага (для бенчмарков)
+PIPELINE_BACKEND = os.getenv("PIPELINE_BACKEND", "diffusers")
+STUB_STEP_MS = float(os.getenv("STUB_STEP_MS", "20"))
+
+# Выполнение инференса в пуле Ray-акторов вместо локального потока.
+# RAY_ADDRESS пустой — локальный кластер, "auto" — подключение к запущенному.
+USE_RAY = os.getenv("USE_RAY", "0") == "1"
+RAY_ADDRESS = os.getenv("RAY_ADDRESS") or None
+RAY_ACTORS_PER_NODE = int(os.getenv("RAY_ACTORS_PER_NODE", "1"))
+RAY_DEVICE = os.getenv("RAY_DEVICE", "auto")
+CACHE_DIR = os.getenv("CACHE_DIR", r"E:\spammer\Myproject\models\cache")
+
+# Приём референсов img2img: лимит загрузки, лимит пикселей по заголовку файла
+# и наибольшая сторона после уменьшения (если в запросе не задан размер больше)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 ** 2)))
+MAX_REFERENCE_PIXELS = int(os.getenv("MAX_REFERENCE_PIXELS", str(50 * 1000 ** 2)))
+REFERENCE_MAX_SIDE = int(os.getenv("REFERENCE_MAX_SIDE", "512"))
+# Кэши по хэшу содержимого референса: декодированные изображения и их латенты VAE
+REFERENCE_CACHE_MAX_BYTES = int(os.getenv("REFERENCE_CACHE_MAX_BYTES", str(128 * 1024 ** 2)))
+REFERENCE_LATENT_CACHE_MAX_BYTES = int(os.getenv("REFERENCE_LATENT_CACHE_MAX_BYTES", str(32 * 1024 ** 2)))
+
+# Параметры микробатчинга: сколько изображений максимум идёт в один проход UNet
+# и сколько миллисекунд ждём попутные запросы, прежде чем запускать батч
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "4"))
+BATCH_MAX_WAIT_MS = int(os.getenv("BATCH_MAX_WAIT_MS", "50"))
+
+# Максимум изображений, ожидающих инференса; сверх этого клиент сразу получает 429
+INFERENCE_QUEUE_MAX = int(os.getenv("INFERENCE_QUEUE_MAX", "32"))
+# Справедливое разделение очереди между клиентами (бот, API-ключ или пользователь).
+# CLIENT_WEIGHTS — JSON {"клиент или префикс до ':'": вес}, например {"telegram": 2, "discord": 1}; по умолчанию вес 1.
+# Класс приоритета high доступен только клиентам из PRIORITY_CLIENTS (через запятую, тоже по префиксу),
+# у остальных он понижается до normal.
+CLIENT_WEIGHTS = json.loads(os.getenv("CLIENT_WEIGHTS", "{}"))
+PRIORITY_CLIENTS = {name.strip() for name in os.getenv("PRIORITY_CLIENTS", "").split(",") if name.strip()}
+# Максимум изображений одного клиента в работе одновременно (по умолчанию — один полный батч)
+MAX_CLIENT_IMAGES_IN_FLIGHT = int(os.getenv("MAX_CLIENT_IMAGES_IN_FLIGHT", str(BATCH_MAX_SIZE)))
+# Период опроса CPU/RAM фоновым сэмплером (секунды)
+RESOURCE_SAMPLE_INTERVAL = 1.0
+
+# Сколько секунд хранить завершённые задачи и максимум ожидания для long-poll
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", "3600"))
+# Лимит памяти под изображения завершённых задач: сверх него байты самых старых задач освобождаются
+# (статус и пути на диске остаются, /status/images отвечает 410). Синхронные эндпоинты освобождают
+# изображения сразу после ответа.
+JOB_RESULTS_MAX_BYTES = int(os.getenv("JOB_RESULTS_MAX_BYTES", str(512 * 1024 ** 2)))
+MAX_LONG_POLL_SECONDS = 60
+# Срок задачи генерации: незавершённая к сроку задача прерывается (expired, 504), её запросы
+# выбрасываются из очереди, а идущий батч останавливается между шагами денойзинга.
+# Клиент может сократить срок полем timeout — например, до своего таймаута HTTP. 0 — без срока по умолчанию.
+JOB_TIMEOUT_SECONDS = float(os.getenv("JOB_TIMEOUT_SECONDS", "600"))
+# Как часто синхронные эндпоинты проверяют, что клиент ещё ждёт ответа (ушедший клиент отменяет задачу)
+DISCONNECT_POLL_SECONDS = 1.0
+# Интервал пустых keep-alive сообщений в SSE
+SSE_KEEPALIVE_SECONDS = 15
+
+# Промежуточные превью из цикла денойзинга: каждые N шагов (0 — выключены).
+# Превью считается по латентам без VAE и увеличивается в PREVIEW_SCALE раз (64 -> 256 px).
+# В режиме Ray превью не строятся.
+PREVIEW_EVERY_STEPS = int(os.getenv("PREVIEW_EVERY_STEPS", "5"))
+PREVIEW_SCALE = 4
+
+# Параметры сэмплинга
+TXT2IMG_STEPS = 35
+TXT2IMG_GUIDANCE = 9.0
+IMG2IMG_STEPS = 40
+IMG2IMG_GUIDANCE = 8.5
+IMG2IMG_STRENGTH = 0.4
+UPSCALE_FACTOR = 2
+MAX_STEPS = 100
+# Планировщик по умолчанию (см. pipelines.SCHEDULERS); "default" — из чекпоинта
+DEFAULT_SCHEDULER = os.getenv("DEFAULT_SCHEDULER", "default")
+
+# Ярусы качества: "quality" — параметры выше, "fast" — меньше шагов на DPM++ 2M,
+# "auto" — fast, если ожидание в очереди дольше AUTO_FAST_WAIT_SECONDS
+TIERS = ("quality", "fast", "auto")
+FAST_TXT2IMG_STEPS = 18
+FAST_IMG2IMG_STEPS = 20
+FAST_SCHEDULER = "dpmpp_2m"
+AUTO_FAST_WAIT_SECONDS = float(os.getenv("AUTO_FAST_WAIT_SECONDS", "20"))
+
+# Размеры изображений округляются к корзинам по RESOLUTION_BUCKET пикселей (кратно 8),
+# чтобы запросы с близкими размерами попадали в один батч
+DEFAULT_WIDTH = 512
+DEFAULT_HEIGHT = 512
+MIN_SIDE = 256
+MAX_SIDE = 1024
+RESOLUTION_BUCKET = max(8, int(os.getenv("RESOLUTION_BUCKET", "64")) // 8 * 8)
+
+# Латентный hires для txt2img: генерация в базовом размере, увеличение латентов в hires_scale раз
+# и короткая доработка img2img. Итоговая сторона не больше HIRES_MAX_SIDE.
+HIRES_MAX_SCALE = 2.0
+HIRES_MAX_SIDE = int(os.getenv("HIRES_MAX_SIDE", "2048"))
+HIRES_STEPS = 15
+FAST_HIRES_STEPS = 8
+HIRES_STRENGTH = 0.5
+
+# Апскейлер по умолчанию: "none", "cubic", "lanczos" или "realesrgan"
+DEFAULT_UPSCALER = os.getenv("DEFAULT_UPSCALER", "cubic")
+# Потоки для апскейла и кодирования PNG (работа на CPU, вне event loop)
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "4"))
+
+# Кэш результатов для детерминированных запросов (с явным seed)
+RESULT_CACHE_DIR = os.path.join(CACHE_DIR, "results")
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+
+# Массовая генерация датасетов: каталоги прогонов в BULK_OUTPUT_DIR (см. bulk.BulkRun)
+BULK_OUTPUT_DIR = os.getenv("BULK_OUTPUT_DIR", os.path.join(CACHE_DIR, "bulk"))
+BULK_SHARD_SIZE = 1000
+# Образцов прогона в работе одновременно: с запасом на следующий батч, чтобы GPU не простаивал,
+# но заметно меньше INFERENCE_QUEUE_MAX, чтобы запросы ботов не получали 429
+BULK_MAX_IN_FLIGHT = int(os.getenv("BULK_MAX_IN_FLIGHT", str(2 * BATCH_MAX_SIZE)))
+# Сколько ошибок образцов показывать в статусе прогона
+BULK_MAX_REPORTED_FAILURES = 20
+
+# Трасса запросов генерации для воспроизведения нагрузки (loadgen.py --trace): JSONL, строка на запрос.
+# Промпты не пишутся, у референсов — только размер файла и изображения. Пусто — трасса не пишется.
+REQUEST_TRACE_PATH = os.getenv("REQUEST_TRACE_PATH") or None
+
+# Лимит памяти кэша эмбеддингов промптов (один промпт в fp16 — около 120 КБ)
+PROMPT_EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("PROMPT_EMBEDDING_CACHE_MAX_BYTES", str(64 * 1024 ** 2)))
+
+# Негативный промпт для txt2img
+NEGATIVE_PROMPT = (
+    "low quality, blurry, jpeg artifacts, bad anatomy, extra limbs, deformed hands, "
+    "missing fingers, extra fingers, mutated, poorly drawn, lowres, watermark, text, "
+    "logo, signature, badly drawn hands, disfigured hands, bad hands, missing fingers"
+)
+
+# Прогревочная генерация при старте: WARMUP_STEPS шагов (0 — без прогрева, с TORCH_COMPILE — минимум 2)
+# на батче из WARMUP_BATCH_SIZE изображений txt2img и одном img2img.
+# Готовит ядра CUDA/oneDNN и пулы аллокатора под размер реального батча.
+WARMUP_STEPS = int(os.getenv("WARMUP_STEPS", "2"))
+WARMUP_BATCH_SIZE = int(os.getenv("WARMUP_BATCH_SIZE", str(BATCH_MAX_SIZE)))
+
+# Ход запуска для /health и /ready
+startup = Startup()
+
+result_cache = None  # создаётся при старте приложения (см. on_startup)
+model_manager = None  # только для локального инференса
+reference_latent_cache = None  # только для локального инференса с настоящей моделью
+ray_pool = None
+
+
+# Подготовка загруженной модели (в потоке инференса, после первого переноса на устройство):
+# оптимизации под устройство и профиль памяти, кэш эмбеддингов с предвычисленными
+# негативным и пустым промптами — если кэш не достался от модели с тем же текстовым энкодером.
+def prepare_model(entry):
+    registry = entry.registry
+    txt2img_pipe = registry.get("txt2img")
+    registry.get("img2img")
+
+    started = time.perf_counter()
+    if PIPELINE_BACKEND != "stub":
+        # xformers на CUDA, channels_last и attention slicing на CPU, профиль памяти
+        optimize_pipelines(registry, compile_unet=TORCH_COMPILE, compile_mode=TORCH_COMPILE_MODE,
+                           memory_profile=MEMORY_PROFILE)
+    entry.timings["optimize"] = time.perf_counter() - started
+
+    if entry.embedding_cache is None:
+        started = time.perf_counter()
+        entry.embedding_cache = PromptEmbeddingCache(
+            txt2img_pipe.tokenizer, txt2img_pipe.text_encoder, max_bytes=PROMPT_EMBEDDING_CACHE_MAX_BYTES
+        )
+        entry.embedding_cache.warmup([NEGATIVE_PROMPT, ""])
+        entry.timings["prompt_cache"] = time.perf_counter() - started
+
+
+# Загрузка моделей (синхронно, в потоке инференса). Фазы запуска пишутся в startup.
+# При старте загружается только модель по умолчанию, остальные — при первом запросе к ним.
+def load_models():
+    global model_manager, reference_latent_cache, ray_pool
+    logger.info("Загрузка моделей...")
+
+    if USE_RAY:
+        # Модель загружается только в акторах, фронтенд FastAPI весов не держит
+        import ray
+        from ray_pool import RayActorPool
+
+        with startup.phase("ray_init"):
+            ray.init(address=RAY_ADDRESS, ignore_reinit_error=True, logging_level=logging.INFO)
+        logger.info("Ray инициализирован ✅")
+        pool = RayActorPool(
+            MODELS[DEFAULT_MODEL],
+            actors_per_node=RAY_ACTORS_PER_NODE,
+            device=RAY_DEVICE,
+            dtype=INFERENCE_DTYPE,
+            memory_profile=MEMORY_PROFILE,
+            embedding_cache_bytes=PROMPT_EMBEDDING_CACHE_MAX_BYTES,
+            warmup_prompts=[NEGATIVE_PROMPT, ""],
+            threads=(TORCH_INTRA_OP_THREADS, TORCH_INTER_OP_THREADS),
+            compile_unet=TORCH_COMPILE,
+            compile_mode=TORCH_COMPILE_MODE,
+            compile_cache_dir=os.path.join(CACHE_DIR, "torch_compile") if TORCH_COMPILE else None,
+            warmup_batches=warmup_batches(),
+        )
+        # Акторы считаются запущенными после загрузки модели и прогрева
+        with startup.phase("actors_start"):
+            pool.start()
+        ray_pool = pool
+        return
+
+    # Веса каждой модели загружаются один раз, txt2img и img2img используют общие UNet, VAE и текстовый энкодер
+    if PIPELINE_BACKEND == "stub":
+        from stub_pipeline import StubPipelineRegistry
+
+        device = "cpu"
+
+        def create_registry(path, shared_components):
+            return StubPipelineRegistry(step_ms=STUB_STEP_MS)
+    else:
+        # torch не импортируется вместе с server.py: его импорт — заметная часть запуска
+        with startup.phase("torch_import"):
+            import torch
+        configure_threads(TORCH_INTRA_OP_THREADS, TORCH_INTER_OP_THREADS)
+        if TORCH_COMPILE:
+            enable_compile_cache(os.path.join(CACHE_DIR, "torch_compile"))
+        device = resolve_device(INFERENCE_DEVICE)
+        dtype = select_dtype(device, INFERENCE_DTYPE)
+        profile_stats.device = device
 
-    logger.info("Модели загружены ✅")
+        def create_registry(path, shared_components):
+            return PipelineRegistry(path, device=device, torch_dtype=dtype, shared_components=shared_components)
 
-    # Попытка активировать xformers для оптимизации памяти
+    manager = ModelManager(
+        MODELS,
+        device,
+        create_registry,
+        prepare=prepare_model,
+        device_budget=MODEL_DEVICE_BUDGET_BYTES,
+        host_budget=MODEL_HOST_BUDGET_BYTES,
+        # При выгрузке хуками accelerate веса переносит сам пайплайн
+        move_weights=not MEMORY_PROFILES.get(MEMORY_PROFILE, {}).get("model_cpu_offload"),
+    )
+    entry = manager.acquire(DEFAULT_MODEL)
+    registry_timings = getattr(entry.registry, "timings", {})
+    phases = {
+        "weight_load": registry_timings.get("weight_load"),
+        "device_transfer": entry.timings.get("to_device", registry_timings.get("device_transfer")),
+        "optimize": entry.timings.get("optimize"),
+        "prompt_cache": entry.timings.get("prompt_cache"),
+    }
+    for phase, seconds in phases.items():
+        if seconds is not None:
+            startup.record(phase, seconds)
+    logger.info(f"Модель {DEFAULT_MODEL} загружена ✅ (всего моделей: {len(MODELS)})")
+
+    model_manager = manager
+    if PIPELINE_BACKEND != "stub":
+        reference_latent_cache = ReferenceLatentCache(max_bytes=REFERENCE_LATENT_CACHE_MAX_BYTES)
+
+
+# Прогревочная генерация модели по умолчанию (в потоке инференса), в /timings не попадает
+# Прогревочные батчи (kind, requests, params) — общие для локального прогрева и Ray-акторов
+def warmup_batches():
+    steps = max(WARMUP_STEPS, 2) if TORCH_COMPILE else WARMUP_STEPS
+    if steps <= 0:
+        return []
+    # strength=1: при малом числе шагов и обычном strength у img2img не осталось бы ни одного шага
+    reference = Image.new("RGB", (DEFAULT_WIDTH, DEFAULT_HEIGHT), (127, 127, 127))
+    return [
+        ("txt2img", [BatchRequest(prompt="", num_images=WARMUP_BATCH_SIZE)],
+         SamplingParams(steps=steps, guidance=TXT2IMG_GUIDANCE, negative_prompt=NEGATIVE_PROMPT,
+                        width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT)),
+        ("img2img", [BatchRequest(prompt="", num_images=1, image=reference)],
+         SamplingParams(steps=steps, guidance=IMG2IMG_GUIDANCE, strength=1.0)),
+    ]
+
+
+def warmup_models():
+    batches = warmup_batches()
+    if not batches:
+        return
+    entry = model_manager.acquire(DEFAULT_MODEL)
+    for kind, requests, params in batches:
+        run_pipeline_batch(entry.registry, entry.embedding_cache, kind, requests, params)
+    logger.info(f"Прогрев: {batches[0][2].steps} шагов, батч txt2img из {WARMUP_BATCH_SIZE} изображений и img2img")
+
+
+# Загрузка и прогрев в фоне: порт уже открыт, /health отвечает, /ready — после прогрева.
+# Ошибка загрузки не роняет процесс, а переводит сервер в состояние failed.
+async def start_models():
+    loop = asyncio.get_running_loop()
     try:
-        txt2img_pipe.enable_xformers_memory_efficient_attention()
-        img2img_pipe.enable_xformers_memory_efficient_attention()
-        logger.info("✅ xformers активирован.")
+        await loop.run_in_executor(batcher.executor, load_models)
+        if ray_pool is not None:
+            batcher.attach_pool(ray_pool)
+        else:
+            with startup.phase("warmup"):
+                await loop.run_in_executor(batcher.executor, warmup_models)
+        startup.mark_ready()
+        phases = ", ".join(f"{name} {seconds:.1f} с" for name, seconds in startup.phases.items())
+        logger.info(f"Сервер готов ✅ ({phases})")
     except Exception as e:
-        logger.warning(f"⚠️ Не удалось активировать xformers: {e}")
-except Exception as e:
-    logger.error(f"Ошибка при загрузке моделей: {e}")
-    raise
+        logger.error(f"Ошибка при загрузке моделей: {e}")
+        startup.mark_failed(str(e))
+
+
+async def on_startup():
+    global result_cache
+    # Создание кэш директории
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    logger.info(f"Кэш директория создана: {CACHE_DIR}")
+    result_cache = ResultCache(RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_BYTES)
+    resource_sampler.start()
+    startup.task = asyncio.create_task(start_models())
+
+
+async def on_shutdown():
+    if startup.task is not None and not startup.task.done():
+        startup.task.cancel()
+    # Прогоны массовой генерации останавливаются с закрытием шардов: потом их можно продолжить
+    running = [job for job in bulk_jobs.values() if job_store.cancel(job)]
+    await asyncio.gather(*(job.task for job in running), return_exceptions=True)
+    batcher.executor.shutdown(wait=False, cancel_futures=True)
+    image_executor.shutdown(wait=False, cancel_futures=True)
+    bulk_executor.shutdown(wait=True)
+    if result_cache is not None:
+        await result_cache.flush()
+
+# torch, если он уже импортирован загрузкой модели; иначе None — тогда и памяти GPU занимать нечему.
+# Так мониторинг и очистка памяти не тянут импорт torch в сервер с заглушкой или с Ray.
+def loaded_torch():
+    return sys.modules.get("torch")
 
 # Очистка памяти GPU
 def clear_gpu_memory():
+    torch = loaded_torch()
+    if torch is None or not torch.cuda.is_available():
+        return
     torch.cuda.empty_cache()
     logger.info("GPU память очищена.")
 
-# Функция для увеличения изображения
-async def upscale_image(input_path, scale=2):
-    if not os.path.exists(input_path):
-        raise FileNotFoundError(f"Файл не найден: {input_path}")
+# Длительности стадий генерации для бенчмарков и мониторинга (см. /timings и /metrics)
+stage_timings = StageTimings()
+# Пиковая память и скорость активного профиля памяти (локальный инференс)
+profile_stats = ProfileStats(MEMORY_PROFILE)
+
+
+class ResponseTimingMiddleware:
+    """
+    Замеряет стадию response_send — отправку изображений клиенту (от заголовков до конца тела).
+    Потоковые ответы не учитываются: их длительность — это время самой генерации.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = None
+        streamed = False
+
+        async def timed_send(message):
+            nonlocal started, streamed
+            if message["type"] == "http.response.start":
+                content_type = dict(message.get("headers", [])).get(b"content-type", b"")
+                if content_type.startswith((b"image/", b"multipart/")):
+                    started = time.perf_counter()
+            await send(message)
+            if message["type"] == "http.response.body" and started is not None:
+                if message.get("more_body", False):
+                    streamed = True
+                elif not streamed:
+                    stage_timings.record("response_send", time.perf_counter() - started)
+
+        await self.app(scope, receive, timed_send)
+
 
+app.add_middleware(ResponseTimingMiddleware)
+
+# Пул потоков для апскейла и кодирования изображений
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+# Один поток записи шардов и манифестов массовой генерации: запись прогона последовательна
+bulk_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bulk")
+
+# Синхронная часть стадии апскейла: увеличение один раз и кодирование в основной выход
+# и дополнительные варианты (пресеты encoding.PRESETS). Стадии кодирования — <формат>_encode.
+def upscale_and_encode(image, scale, upscaler, output=OutputSpec(), variants=()):
+    started = time.perf_counter()
+    upscaled_image = get_upscaler(upscaler).upscale(image, scale)
+    stage_timings.record("upscale", time.perf_counter() - started)
+    encoded = {}
+    for name, spec in [(None, output)] + [(name, PRESETS[name]) for name in variants]:
+        started = time.perf_counter()
+        encoded[name] = encode_image(upscaled_image, spec)
+        stage_timings.record(f"{spec.format}_encode", time.perf_counter() - started)
+    return encoded.pop(None), encoded
+
+# Функция для увеличения изображения: работает с изображением в памяти в пуле потоков,
+# возвращает байты основного выхода и словарь вариантов
+async def upscale_image(image, scale=UPSCALE_FACTOR, upscaler=DEFAULT_UPSCALER, output=OutputSpec(), variants=()):
     try:
-        image = Image.open(input_path).convert("RGB")
-        image_np = np.array(image)
-        height, width = image_np.shape[:2]
-        new_size = (width * scale, height * scale)
-
-        upscaled_np = cv2.resize(image_np, new_size, interpolation=cv2.INTER_CUBIC)
-        upscaled_image = Image.fromarray(upscaled_np)
-
-        output_path = input_path.replace(".png", f"_x{scale}.png")
-        upscaled_image.save(output_path)
-        logger.info(f"Изображение увеличено и сохранено: {output_path}")
-        return output_path
+        loop = asyncio.get_running_loop()
+        data, encoded_variants = await loop.run_in_executor(image_executor, upscale_and_encode, image, scale,
+                                                            upscaler, output, variants)
+        logger.info(f"Изображение увеличено ({upscaler}, x{scale}): {output.format}, {len(data)} байт")
+        return data, encoded_variants
     except Exception as e:
         logger.error(f"Ошибка при увеличении изображения: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка при увеличении изображения: {e}")
 
+# Запись готовых байтов на диск (выполняется в пуле потоков)
+def write_file(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+# Фоновый сэмплер системных ресурсов: psutil.cpu_percent(interval=1) спит секунду,
+# поэтому он крутится в своём потоке, а запросы читают готовый снимок
+class ResourceSampler:
+    def __init__(self, interval=RESOURCE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.snapshot = {"cpu": 0.0, "ram": psutil.virtual_memory().percent, "timestamp": time.time()}
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="resource-sampler", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            cpu_usage = psutil.cpu_percent(interval=self.interval)
+            ram_usage = psutil.virtual_memory().percent
+            self.snapshot = {"cpu": cpu_usage, "ram": ram_usage, "timestamp": time.time()}
+
+
+resource_sampler = ResourceSampler()
+
 # Функция для проверки системных ресурсов
 def check_system_resources():
-    cpu_usage = psutil.cpu_percent(interval=1)
-    ram_usage = psutil.virtual_memory().percent
-    logger.info(f"CPU: {cpu_usage}%, RAM: {ram_usage}%")
-    
+    snapshot = resource_sampler.snapshot
+    cpu_usage = snapshot["cpu"]
+    ram_usage = snapshot["ram"]
+    logger.debug(f"CPU: {cpu_usage}%, RAM: {ram_usage}%")
+
     if cpu_usage > 90 or ram_usage > 90:
         logger.warning("Системные ресурсы перегружены.")
         return False
     return True
 
 
-# Асинхронная генерация изображения
-async def generate_image(prompt: str, is_reference: bool = False, image: Image.Image = None, use_ray: bool = False):
-    try:
-        clear_gpu_memory()
+# Элемент очереди микробатчера: один запрос на num_images изображений
+@dataclass
+class BatchItem:
+    kind: str  # "txt2img" или "img2img"
+    prompt: str
+    num_images: int
+    image: Image.Image = None
+    seed: int = None  # i-е изображение запроса генерируется с seed + i
+    params: SamplingParams = None
+    future: asyncio.Future = None
+    enqueued_at: float = None  # loop.time() постановки в очередь
+    on_preview: object = None  # on_preview(step, steps, previews) в event loop, previews — JPEG по изображениям
+    client: Client = Client()  # чей это запрос: по клиентам делится очередь
+    job_id: str = None  # задача, которой принадлежит запрос (для положения в очереди)
+    reference_key: str = None  # хэш содержимого референса: по нему кэшируются латенты VAE
+    model: str = DEFAULT_MODEL  # имя модели из MODELS
+    deadline: float = None  # loop.time(), после которого результат уже никому не нужен
+
+    def abandoned(self, now):
+        # Запрос больше никто не ждёт: задача отменена или срок истёк
+        return self.future.done() or self.overdue(now)
+
+    def overdue(self, now):
+        return self.deadline is not None and now >= self.deadline
+
+    def expire(self):
+        # Просроченный запрос отменяется, а его задача заранее помечается истёкшей: так она завершится
+        # expired, а не cancelled (выполняется в event loop)
+        if not self.future.done():
+            job_store.mark_timed_out(self.job_id)
+            self.future.cancel()
+
+    @property
+    def batch_key(self):
+        # В один батч попадают только запросы к одной модели одного типа с одинаковыми параметрами
+        # сэмплинга (включая размер), а для img2img — ещё и с референсом одного размера
+        return (self.model, self.kind, self.params, self.image.size if self.image is not None else None)
+
+
+# Синхронный батчевый вызов локального пайплайна (выполняется вне event loop).
+# Модель у батча одна; её загрузка или перенос на устройство попадает в /timings как model_switch.
+def run_local_batch(kind, items, params, on_step=None):
+    images = sum(item.num_images for item in items)
+    model = items[0].model
+    if model_manager.is_hot(model):
+        entry = model_manager.acquire(model)
+    else:
+        started = time.perf_counter()
+        entry = model_manager.acquire(model)
+        stage_timings.record("model_switch", time.perf_counter() - started, images)
+    with profile_stats.measure(output_size(kind, items, params), images, denoising_steps(kind, params)):
+        return run_pipeline_batch(entry.registry, entry.embedding_cache, kind, items, params, on_step=on_step,
+                                  timings=stage_timings, latent_cache=reference_latent_cache)
+
+
+# Колбэк шага денойзинга для батча (выполняется в потоке инференса):
+# отменяет просроченные запросы, прерывает батч, если его уже никто не ждёт,
+# и раз в PREVIEW_EVERY_STEPS шагов рассылает превью
+def make_batch_step_callback(loop, batch):
+    def on_step(step, steps, latents):
+        now = loop.time()
+        for item in batch:
+            if item.overdue(now) and not item.future.done():
+                loop.call_soon_threadsafe(item.expire)
+        if all(item.abandoned(now) for item in batch):
+            raise BatchCancelled()
+        if PREVIEW_EVERY_STEPS <= 0 or step % PREVIEW_EVERY_STEPS or step == steps:
+            return
+        listening = [item.on_preview is not None and not item.future.done() for item in batch]
+        if not any(listening):
+            return
+        previews = [encode_preview(image) for image in latents_to_images(latents, scale=PREVIEW_SCALE)]
+        offset = 0
+        for item, listens in zip(batch, listening):
+            if listens:
+                loop.call_soon_threadsafe(item.on_preview, step, steps, previews[offset:offset + item.num_images])
+            offset += item.num_images
+
+    return on_step
+
+
+# Проверка батча, ушедшего на Ray-актор (выполняется в event loop, см. RayActorPool.run):
+# отменяет просроченные запросы и сообщает, что батч пора прервать, потому что его уже никто не ждёт
+def make_batch_abort_check(loop, batch):
+    def should_abort():
+        now = loop.time()
+        for item in batch:
+            if item.overdue(now):
+                item.expire()
+        return all(item.abandoned(now) for item in batch)
+
+    return should_abort
+
+
+# Очередь инференса переполнена
+class QueueFullError(Exception):
+    def __init__(self, queue_depth, estimated_wait):
+        super().__init__(f"Очередь переполнена: {queue_depth} изображений, ожидание ~{estimated_wait:.0f} с")
+        self.queue_depth = queue_depth
+        self.estimated_wait = estimated_wait
+
+
+class MicroBatcher:
+    """
+    Собирает одновременные запросы к пайплайнам в батчи.
+    - Ждёт попутные запросы не дольше max_wait_ms после первого.
+    - Батч ограничен max_batch_size изображениями.
+    - Каждое изображение возвращается своему вызывающему.
+    - Очередь ограничена max_queue изображениями, лишние запросы отклоняются сразу. Задача может
+      занять места под все свои изображения заранее (reserve): тогда её запросы уже не отклоняются.
+    - Очередь делится между клиентами взвешенно-справедливо (см. FairQueue): первым в батч
+      идёт запрос, выбранный очередью, попутные добираются в её же порядке.
+    - Отменённые и просроченные запросы выбрасываются из очереди, не дойдя до GPU;
+      future просроченного запроса отменяется.
+    - Локально пайплайны вызываются только из выделенного потока инференса, event loop не блокируется.
+    - С пулом Ray батчи уходят наименее загруженным акторам, по одному батчу в работе на актор.
+    """
+
+    def __init__(self, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS, max_queue=INFERENCE_QUEUE_MAX,
+                 pool=None, max_client_in_flight=MAX_CLIENT_IMAGES_IN_FLIGHT):
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue = max(self.max_batch_size, max_queue)
+        self.max_client_in_flight = max_client_in_flight
+        self.queue = None
+        self.worker = None
+        # Единственный поток, который владеет пайплайнами и вызывает их
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        self.pool = pool
+        self.concurrency = len(pool) if pool is not None else 1
+        self.slots = None  # семафор на число одновременно выполняемых батчей
+        self.running = set()
+        self.queued_images = 0  # изображений в очереди (ещё не взятых в батч)
+        self.reserved = {}  # задача -> изображений, под которые занято место, но ещё не поставленных в очередь
+        self.batch_time = None  # скользящее среднее длительности батча, секунды
+        self.dropped = {"cancelled": 0, "expired": 0}  # изображений выброшено из очереди
+        self.aborted_batches = 0  # батчей, прерванных посреди денойзинга
+
+    def attach_pool(self, pool):
+        # Пул Ray появляется после запуска акторов при старте приложения, до первого запроса
+        self.pool = pool
+        self.concurrency = len(pool)
+
+    @property
+    def pending_images(self):
+        # Изображения в очереди и места, занятые допущенными задачами
+        return self.queued_images + sum(self.reserved.values())
+
+    def admit(self, num_images):
+        """
+        Проверяет, что в очереди есть место под num_images изображений с учётом занятых задачами мест;
+        иначе QueueFullError.
+        """
+        pending = self.pending_images
+        if pending + num_images > self.max_queue:
+            raise QueueFullError(pending, self.wait_for_images(pending))
+
+    def reserve(self, job_id, num_images):
+        """
+        Занимает места под num_images изображений задачи job_id (после admit, без await между ними).
+        Запросы задачи расходуют резерв; остаток снимает release(job_id).
+        """
+        self.reserved[job_id] = self.reserved.get(job_id, 0) + num_images
+
+    def release(self, job_id, num_images=None):
+        # Снимает резерв задачи целиком или только num_images изображений
+        if num_images is None or self.reserved.get(job_id, 0) <= num_images:
+            self.reserved.pop(job_id, None)
+        else:
+            self.reserved[job_id] -= num_images
+
+    def transfer(self, job_id, owner, num_images):
+        """
+        Передаёт до num_images изображений резерва задачи job_id другому владельцу (без await между
+        ними место не освобождается): так общая генерация кэша расходует резерв запустившей её задачи.
+        """
+        moved = min(num_images, self.reserved.get(job_id, 0))
+        if moved:
+            self.release(job_id, moved)
+            self.reserve(owner, moved)
+
+    def estimated_wait(self, extra_images=0):
+        """
+        Оценка ожидания в секундах для запроса, вставшего в конец очереди.
+        """
+        return self.wait_for_images(self.queued_images + extra_images)
+
+    def wait_for_images(self, images):
+        # Оценка времени, за которое будут обработаны images изображений очереди
+        batches = math.ceil(images / self.max_batch_size)
+        return math.ceil(batches / self.concurrency) * (self.batch_time or 0.0)
+
+    def queue_position(self, job_id):
+        """
+        Положение задачи в очереди: сколько изображений будет обработано раньше её первого
+        ожидающего запроса и оценка ожидания; None, если запросов задачи в очереди нет.
+        """
+        if self.queue is None:
+            return None
+        ahead = self.queue.position(lambda item: item.job_id == job_id)
+        if ahead is None:
+            return None
+        return {"queue_position": ahead, "estimated_wait": round(self.wait_for_images(ahead), 1)}
+
+    def _ensure_started(self):
+        if self.worker is None or self.worker.done():
+            if self.queue is None:
+                self.queue = FairQueue(max_in_flight=self.max_client_in_flight)
+                self.slots = asyncio.Semaphore(self.concurrency)
+            self.worker = asyncio.create_task(self._run())
+
+    async def submit(self, kind, prompt, params, num_images=1, image=None, seed=None, on_preview=None,
+                     client=Client(), job_id=None, reference_key=None, model=DEFAULT_MODEL, deadline=None,
+                     reservation=None):
+        """
+        Ставит запрос клиента client к модели model с параметрами сэмплинга params в очередь и возвращает
+        список сгенерированных изображений. Запросы больше max_batch_size режутся на части.
+        on_preview(index, step, steps, data) получает JPEG-превью index-го изображения запроса.
+        deadline — loop.time(), после которого запрос отменяется (CancelledError).
+        reservation — владелец резерва мест (см. reserve), по умолчанию job_id.
+        """
+        self._ensure_started()
+        # Изображения, под которые задача уже заняла место, проверку не проходят повторно
+        reservation = job_id if reservation is None else reservation
+        reserved = min(num_images, self.reserved.get(reservation, 0)) if reservation is not None else 0
+        self.admit(num_images - reserved)
+        if reserved:
+            self.reserved[reservation] -= reserved
+
+        loop = asyncio.get_running_loop()
+        futures = []
+        remaining = num_images
+        while remaining > 0:
+            chunk = min(remaining, self.max_batch_size)
+            item = BatchItem(kind=kind, prompt=prompt, num_images=chunk, image=image, seed=seed, params=params,
+                             future=loop.create_future(), enqueued_at=loop.time(),
+                             on_preview=None if on_preview is None else partial(dispatch_previews, on_preview,
+                                                                                num_images - remaining),
+                             client=client, job_id=job_id, reference_key=reference_key, model=model,
+                             deadline=deadline)
+            self.queue.put(item)
+            self.queued_images += chunk
+            futures.append(item.future)
+            remaining -= chunk
+            if seed is not None:
+                seed += chunk
+
+        results = await asyncio.gather(*futures)
+        return [img for chunk_images in results for img in chunk_images]
+
+    def _drop(self, items):
+        # Выброшенные запросы: просроченные отменяются, чтобы их задачи сразу узнали об этом
+        for item in items:
+            self.queued_images -= item.num_images
+            if item.future.done():
+                self.dropped["cancelled"] += item.num_images
+            else:
+                item.expire()
+                self.dropped["expired"] += item.num_images
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        # Отменённые и просроченные запросы не занимают место в батче и не сдвигают очередь
+        self._drop(self.queue.purge(lambda item: item.abandoned(loop.time())))
+        while True:
+            first = await self.queue.get()
+            if not first.abandoned(loop.time()):
+                break
+            # Срок истёк, пока очередь ждала свободный слот
+            self.queue.release([first])
+            self._drop([first])
+        batch, size = [first], first.num_images
+
+        def fits(item):
+            return item.batch_key == first.batch_key and size + item.num_images <= self.max_batch_size \
+                and not item.abandoned(loop.time())
+
+        deadline = loop.time() + self.max_wait
+        while size < self.max_batch_size:
+            # Попутные запросы — сначала уже стоящие в очереди, затем пришедшие в окне ожидания
+            item = self.queue.pop(fits)
+            if item is None:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                item = await self.queue.get(fits, timeout)
+                if item is None:
+                    break
+            batch.append(item)
+            size += item.num_images
+        return batch, size
+
+    async def _run(self):
+        while True:
+            # Сначала ждём свободный слот, чтобы батч собирался из самых свежих запросов
+            await self.slots.acquire()
+            batch, size = await self._collect()
+            self.queued_images -= size
+            task = asyncio.create_task(self._execute(batch, size))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def _execute(self, batch, size):
+        loop = asyncio.get_running_loop()
+        kind, params = batch[0].kind, batch[0].params
+        logger.info(f"Запуск батча {kind}: {len(batch)} запросов, {size} изображений, "
+                    f"{params.steps} шагов {params.scheduler}")
+        for item in batch:
+            stage_timings.record("queue_wait", loop.time() - item.enqueued_at, item.num_images)
+        started = time.perf_counter()
+        try:
+            if self.pool is not None:
+                images = await self.pool.run(kind, batch, params, make_batch_abort_check(loop, batch))
+            else:
+                images = await loop.run_in_executor(self.executor, run_local_batch, kind, batch, params,
+                                                    make_batch_step_callback(loop, batch))
+        except BatchCancelled:
+            self.aborted_batches += 1
+            for item in batch:
+                item.future.cancel()
+            logger.info(f"Батч {kind} прерван: все запросы отменены или просрочены")
+            return
+        except Exception as e:
+            logger.error(f"Ошибка при выполнении батча {kind}: {e}")
+            if self.pool is None:
+                # После ошибки (чаще всего OOM) освобождаем кэш аллокатора в потоке инференса
+                await loop.run_in_executor(self.executor, clear_gpu_memory)
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            return
+        finally:
+            self.queue.release(batch)
+            self.slots.release()
+
+        elapsed = time.perf_counter() - started
+        stage_timings.record(f"inference_{kind}", elapsed, size)
+        self.batch_time = elapsed if self.batch_time is None else 0.8 * self.batch_time + 0.2 * elapsed
+
+        offset = 0
+        for item in batch:
+            if not item.future.done():
+                item.future.set_result(images[offset:offset + item.num_images])
+            offset += item.num_images
+
+
+# Раздаёт превью части запроса по индексам изображений внутри запроса
+def dispatch_previews(on_preview, first_index, step, steps, previews):
+    for i, data in enumerate(previews):
+        on_preview(first_index + i, step, steps, data)
+
+
+batcher = MicroBatcher(pool=ray_pool)
+
+# Параметры одной генерации, общие для txt2img и img2img
+@dataclass
+class GenerationOptions:
+    seed: int = None  # С seed результат детерминирован и кэшируется
+    upscaler: str = DEFAULT_UPSCALER
+    save_raw: bool = False  # Сохранить также исходник без апскейла
+    save_to_disk: bool = True  # Сохранить результат в CACHE_DIR
+    sampling: SamplingParams = None  # None — параметры яруса quality
+    preview: object = None  # preview(index, step, steps, data) — получатель JPEG-превью
+    output: OutputSpec = OutputSpec()  # кодирование основного выхода
+    variants: tuple = ()  # имена дополнительных выходов из encoding.PRESETS
+    client: Client = Client()  # клиент, от имени которого запрос стоит в очереди
+    job_id: str = None  # задача, которой принадлежит генерация
+    reservation: str = None  # чей резерв мест в очереди расходует генерация; None — резерв задачи job_id
+    model: str = DEFAULT_MODEL  # имя модели из MODELS
+    timeout: float = None  # срок задачи в секундах; None — без срока
+    deadline: float = None  # loop.time() срока задачи (проставляется при постановке задачи)
+
+    def for_image(self, index):
+        # Параметры index-го изображения запроса: seed сдвигается на index, превью получают этот index
+        return replace(
+            self,
+            seed=None if self.seed is None else self.seed + index,
+            preview=None if self.preview is None else partial(shift_preview_index, self.preview, index),
+        )
+
+
+def shift_preview_index(preview, offset, index, step, steps, data):
+    preview(offset + index, step, steps, data)
+
+
+# Округление стороны изображения к ближайшей корзине в пределах [MIN_SIDE, MAX_SIDE]
+def snap_to_bucket(value):
+    low = math.ceil(MIN_SIDE / RESOLUTION_BUCKET) * RESOLUTION_BUCKET
+    high = MAX_SIDE // RESOLUTION_BUCKET * RESOLUTION_BUCKET
+    return min(high, max(low, round(value / RESOLUTION_BUCKET) * RESOLUTION_BUCKET))
+
 
+# Проверка параметров сэмплинга запроса и сборка SamplingParams.
+# Явно заданные steps и scheduler важнее настроек яруса.
+def build_sampling(kind, tier="quality", steps=None, guidance=None, strength=None, scheduler=None,
+                   width=None, height=None, hires_scale=None, hires_steps=None, hires_strength=None):
+    if tier not in TIERS:
+        raise HTTPException(status_code=400, detail=f"Неизвестный ярус: {tier}. Доступны: {', '.join(TIERS)}")
+    if tier == "auto":
+        tier = "fast" if batcher.estimated_wait() > AUTO_FAST_WAIT_SECONDS else "quality"
+    fast = tier == "fast"
+    scheduler = scheduler or (FAST_SCHEDULER if fast else DEFAULT_SCHEDULER)
+    if scheduler not in SCHEDULERS:
+        raise HTTPException(status_code=400, detail=f"Неизвестный планировщик: {scheduler}. Доступны: {', '.join(SCHEDULERS)}")
+    if steps is not None and not 1 <= steps <= MAX_STEPS:
+        raise HTTPException(status_code=400, detail=f"steps должно быть от 1 до {MAX_STEPS}")
+    if strength is not None and not 0 < strength <= 1:
+        raise HTTPException(status_code=400, detail="strength должно быть в (0, 1]")
+    # hires_scale = 1 — то же, что без hires
+    hires = hires_scale is not None and hires_scale != 1
+    if hires:
+        if kind != "txt2img":
+            raise HTTPException(status_code=400, detail="hires доступен только для txt2img")
+        if not 1 < hires_scale <= HIRES_MAX_SCALE:
+            raise HTTPException(status_code=400, detail=f"hires_scale должно быть в (1, {HIRES_MAX_SCALE}]")
+        if hires_steps is not None and not 1 <= hires_steps <= MAX_STEPS:
+            raise HTTPException(status_code=400, detail=f"hires_steps должно быть от 1 до {MAX_STEPS}")
+        if hires_strength is not None and not 0 < hires_strength <= 1:
+            raise HTTPException(status_code=400, detail="hires_strength должно быть в (0, 1]")
+
+    if kind == "txt2img":
+        width, height = snap_to_bucket(width or DEFAULT_WIDTH), snap_to_bucket(height or DEFAULT_HEIGHT)
+        if hires and max(width, height) * hires_scale > HIRES_MAX_SIDE:
+            raise HTTPException(status_code=400, detail=f"С hires сторона изображения не больше {HIRES_MAX_SIDE}")
+        return SamplingParams(
+            steps=steps or (FAST_TXT2IMG_STEPS if fast else TXT2IMG_STEPS),
+            guidance=TXT2IMG_GUIDANCE if guidance is None else guidance,
+            scheduler=scheduler,
+            negative_prompt=NEGATIVE_PROMPT,
+            width=width,
+            height=height,
+            hires_scale=hires_scale if hires else None,
+            hires_steps=(hires_steps or (FAST_HIRES_STEPS if fast else HIRES_STEPS)) if hires else None,
+            hires_strength=(HIRES_STRENGTH if hires_strength is None else hires_strength) if hires else None,
+        )
+    # Для img2img размер по умолчанию — размер референса; заданная сторона приводится к корзине
+    return SamplingParams(
+        steps=steps or (FAST_IMG2IMG_STEPS if fast else IMG2IMG_STEPS),
+        guidance=IMG2IMG_GUIDANCE if guidance is None else guidance,
+        scheduler=scheduler,
+        width=None if width is None else snap_to_bucket(width),
+        height=None if height is None else snap_to_bucket(height),
+        strength=IMG2IMG_STRENGTH if strength is None else strength,
+    )
+
+
+# Результат генерации одного изображения: байты в памяти и, если нужно, путь на диске
+@dataclass
+class ImageResult:
+    data: bytes
+    filename: str
+    content_type: str = "image/png"
+    path: str = None
+    variants: dict = field(default_factory=dict)  # имя пресета -> ImageResult того же изображения
+
+    def nbytes(self):
+        return len(self.data or b"") + sum(variant.nbytes() for variant in self.variants.values())
+
+    def without_data(self):
+        # То, что остаётся в задаче после освобождения памяти: имена и пути на диске
+        return replace(self, data=None, variants={name: variant.without_data()
+                                                  for name, variant in self.variants.items()})
+
+
+# Асинхронная генерация изображения.
+# С явным seed результат детерминирован и берётся из кэша, если уже генерировался
+# (кроме запросов с вариантами: кэш хранит только основной выход).
+async def generate_image(prompt: str, is_reference: bool = False, image: Image.Image = None,
+                         options: GenerationOptions = None, reference_hash: str = None):
+    options = options or GenerationOptions()
+    if options.sampling is None:
+        options = replace(options, sampling=build_sampling("img2img" if is_reference else "txt2img"))
+    if options.seed is None or options.variants:
+        data, variants = await render_image(prompt, is_reference, image, options, reference_hash)
+    else:
+        if is_reference and reference_hash is None:
+            reference_hash = hashlib.sha256(image.tobytes()).hexdigest()
+        key = make_cache_key(
+            model=MODELS[options.model],
+            kind="img2img" if is_reference else "txt2img",
+            prompt=prompt,
+            negative_prompt=None if is_reference else options.sampling.negative_prompt,
+            steps=options.sampling.steps,
+            guidance=options.sampling.guidance,
+            strength=options.sampling.strength,
+            scheduler=options.sampling.scheduler,
+            width=options.sampling.width,
+            height=options.sampling.height,
+            hires_scale=options.sampling.hires_scale,
+            hires_steps=options.sampling.hires_steps,
+            hires_strength=options.sampling.hires_strength,
+            seed=options.seed,
+            reference=reference_hash,
+            upscale=UPSCALE_FACTOR,
+            upscaler=options.upscaler,
+            output=options.output,
+        )
+
+        # Генерацию ждут все запросы с этим ключом, поэтому она ничья: срок, превью и положение в очереди
+        # запустившей её задачи к ней не относятся, а отменяет её кэш, когда не остаётся ожидающих.
+        # Место в очереди она берёт из резерва запустившей задачи — переданного ей, чтобы отмена
+        # задачи не заставила генерацию заново проходить проверку очереди
+        flight_id = f"flight:{uuid.uuid4().hex}"
+
+        async def render_main():
+            data, _ = await render_image(prompt, is_reference, image,
+                                         replace(options, deadline=None, job_id=None, preview=None,
+                                                 reservation=flight_id),
+                                         reference_hash)
+            return data
+
+        def on_start(task):
+            # Результат из кэша или чужой генерации места в очереди не занимает
+            if task is None:
+                batcher.release(options.job_id, 1)
+            else:
+                batcher.transfer(options.job_id, flight_id, 1)
+                task.add_done_callback(lambda _: batcher.release(flight_id))
+
+        data = await result_cache.get_or_create(key, render_main, options.output.extension, on_start)
+        variants = {}
+
+    suffix = "" if options.upscaler == "none" else f"_x{UPSCALE_FACTOR}"
+    stem = f"{'ref' if is_reference else 'gen'}_{uuid.uuid4().hex}{suffix}"
+    result = ImageResult(data=data, filename=f"{stem}{options.output.extension}",
+                         content_type=options.output.content_type)
+    for name, variant_data in variants.items():
+        spec = PRESETS[name]
+        result.variants[name] = ImageResult(data=variant_data, filename=f"{stem}_{name}{spec.extension}",
+                                            content_type=spec.content_type)
+
+    # Запись на диск необязательна: клиенты, получающие байты по HTTP, в ней не нуждаются
+    if options.save_to_disk:
+        loop = asyncio.get_running_loop()
+        for saved in [result, *result.variants.values()]:
+            saved.path = os.path.join(CACHE_DIR, saved.filename)
+            await loop.run_in_executor(image_executor, write_file, saved.path, saved.data)
+        logger.info(f"Изображение сохранено как: {result.path}")
+    return result
+
+# Ответ 429 на переполненную очередь: глубина очереди, оценка ожидания и Retry-After
+def queue_full_error(e: QueueFullError):
+    logger.warning(str(e))
+    return HTTPException(
+        status_code=429,
+        detail={"message": "Очередь генерации переполнена, попробуйте позже",
+                "queue_depth": e.queue_depth, "estimated_wait": round(e.estimated_wait, 1)},
+        headers={"Retry-After": str(max(1, math.ceil(e.estimated_wait)))},
+    )
+
+# Генерация и апскейл одного изображения, результат — байты основного выхода и словарь вариантов
+async def render_image(prompt: str, is_reference: bool = False, image: Image.Image = None,
+                       options: GenerationOptions = None, reference_hash: str = None):
+    options = options or GenerationOptions()
+    sampling = options.sampling or build_sampling("img2img" if is_reference else "txt2img")
+    try:
         # Проверка ресурсов перед выполнением
         if not check_system_resources():
             raise HTTPException(status_code=503, detail="Системные ресурсы перегружены, попробуйте позже")
@@ -119,129 +1086,1011 @@ async def generate_image(prompt: str, is_reference: bool = False, image: Image.I
             if image is None:
                 raise ValueError("Reference image is required.")
             logger.info(f"Запуск img2img генерации с prompt: {prompt}")
-
-            # Используем ray, если указано
-            if use_ray:
-                result = await ray.get(generate_img2img_task.remote(prompt, image))
-            else:
-                result = img2img_pipe(prompt=prompt, image=image, strength=0.4, guidance_scale=8.5, num_inference_steps=40).images[0]
+            if sampling.width or sampling.height:
+                size = (sampling.width or snap_to_bucket(image.width), sampling.height or snap_to_bucket(image.height))
+                if size != image.size:
+                    image = await asyncio.get_running_loop().run_in_executor(
+                        image_executor, image.resize, size, Image.LANCZOS)
+            result = (await batcher.submit("img2img", prompt, sampling, image=image, seed=options.seed,
+                                           on_preview=options.preview, client=options.client,
+                                           job_id=options.job_id, reference_key=reference_hash,
+                                           model=options.model, deadline=options.deadline,
+                                           reservation=options.reservation))[0]
 
         # Если используем текстовое описание (txt2img)
         else:
-            negative_prompt = (
-                "low quality, blurry, jpeg artifacts, bad anatomy, extra limbs, deformed hands, "
-                "missing fingers, extra fingers, mutated, poorly drawn, lowres, watermark, text, "
-                "logo, signature, badly drawn hands, disfigured hands, bad hands, missing fingers"
-            )
             logger.info(f"Запуск txt2img генерации с prompt: {prompt}")
+            result = (await batcher.submit("txt2img", prompt, sampling, seed=options.seed,
+                                           on_preview=options.preview, client=options.client,
+                                           job_id=options.job_id, model=options.model,
+                                           deadline=options.deadline, reservation=options.reservation))[0]
 
-            # Используем ray, если указано
-            if use_ray:
-                result = await ray.get(generate_txt2img_task.remote(prompt, negative_prompt))
-            else:
-                result = txt2img_pipe(prompt=prompt, negative_prompt=negative_prompt, num_inference_steps=35, guidance_scale=9.0).images[0]
-
-        # Сохраняем изображение в кэш
-        filename = f"{'ref' if is_reference else 'gen'}_{uuid.uuid4().hex}.png"
-        raw_path = os.path.join(CACHE_DIR, filename)
-        result.save(raw_path)
+        # Исходник без апскейла сохраняем только по явному запросу
+        if options.save_raw:
+            raw_path = os.path.join(CACHE_DIR, f"{'ref' if is_reference else 'gen'}_{uuid.uuid4().hex}.png")
+            await asyncio.get_running_loop().run_in_executor(image_executor, result.save, raw_path)
+            logger.info(f"Исходное изображение сохранено как: {raw_path}")
 
-        logger.info(f"Изображение сохранено как: {raw_path}")
-
-        # Для увеличения изображения по пути после сохранения
-        return await upscale_image(raw_path)
+        # Апскейл и кодирование в памяти
+        scale = 1 if options.upscaler == "none" else UPSCALE_FACTOR
+        return await upscale_image(result, scale=scale, upscaler=options.upscaler, output=options.output,
+                                   variants=options.variants)
 
+    except HTTPException:
+        raise
+    except QueueFullError as e:
+        raise queue_full_error(e)
     except Exception as e:
         logger.error(f"Ошибка при генерации изображения: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка при генерации изображения: {e}")
 
+# Режимы ответа:
+# - path      — JSON с путями к файлам на сервере (как раньше, файлы всегда пишутся на диск)
+# - image     — тело ответа — одно изображение (только при num_images = 1)
+# - multipart — все изображения одним multipart/mixed ответом
+# - stream    — multipart/mixed с chunked-передачей: каждое изображение уходит, как только готово
+RESPONSE_MODES = ("path", "image", "multipart", "stream")
+
 # Модель для приема данных от клиента
 class PromptRequest(BaseModel):
     prompt: str
     num_images: int = 1  # По умолчанию 1 изображение
+    seed: Optional[int] = None  # С seed результат детерминирован и кэшируется
+    upscaler: str = DEFAULT_UPSCALER  # "none", "cubic", "lanczos" или "realesrgan"
+    save_raw: bool = False  # Сохранить также исходник без апскейла
+    response_mode: str = "path"  # "path", "image", "multipart" или "stream"
+    save_to_disk: Optional[bool] = None  # По умолчанию пишем на диск только в режиме path
+    width: Optional[int] = None  # По умолчанию 512, округляется к корзине RESOLUTION_BUCKET
+    height: Optional[int] = None
+    steps: Optional[int] = None  # По умолчанию — по ярусу
+    guidance: Optional[float] = None
+    scheduler: Optional[str] = None  # "default", "dpmpp_2m", "dpmpp_2m_karras", "euler", "euler_a", "ddim"
+    tier: str = "quality"  # "quality", "fast" или "auto"
+    hires_scale: Optional[float] = None  # латентный hires: во сколько раз увеличить, до 2
+    hires_steps: Optional[int] = None  # шагов доработки hires, по умолчанию — по ярусу
+    hires_strength: Optional[float] = None  # сила доработки hires, по умолчанию 0.5
+    client_id: Optional[str] = None  # Бот или пользователь, например "discord:1234"; по нему делится очередь
+    priority: str = "normal"  # "high", "normal" или "low"
+    output_format: str = "png"  # формат или пресет: "png", "webp", "jpeg", "discord", "telegram", "dataset", ...
+    output_quality: Optional[int] = None  # качество WebP/JPEG, 1-100
+    output_max_bytes: Optional[int] = None  # WebP/JPEG: подобрать качество под размер файла
+    png_compress_level: Optional[int] = None  # PNG: 0-9
+    variants: Optional[str] = None  # дополнительные выходы через запятую, например "dataset,thumbnail"
+    model: Optional[str] = None  # имя модели из MODELS, по умолчанию DEFAULT_MODEL
+    timeout: Optional[float] = None  # срок задачи в секундах, не больше JOB_TIMEOUT_SECONDS
+
+# Клиент очереди: явный client_id, иначе заголовок X-Client-Id, иначе API-ключ, иначе адрес.
+# Вес и право на класс high ищутся по полному имени, затем по префиксу до ':' ("discord:123" -> "discord").
+def resolve_client(request: Request, client_id=None, priority="normal"):
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"Неизвестный приоритет: {priority}. Доступны: {', '.join(PRIORITIES)}")
+    client_id = client_id or request.headers.get("X-Client-Id")
+    if not client_id:
+        api_key = request.headers.get("X-API-Key")
+        if api_key:
+            client_id = f"key:{hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]}"
+        else:
+            client_id = f"ip:{request.client.host if request.client else 'unknown'}"
+    group = client_id.split(":", 1)[0]
+    weight = float(CLIENT_WEIGHTS.get(client_id, CLIENT_WEIGHTS.get(group, 1.0)))
+    if weight <= 0:
+        raise HTTPException(status_code=500, detail=f"Некорректный вес клиента {client_id} в CLIENT_WEIGHTS")
+    if priority == "high" and client_id not in PRIORITY_CLIENTS and group not in PRIORITY_CLIENTS:
+        priority = "normal"
+    return Client(id=client_id, weight=weight, priority=priority)
+
+# Параметры кодирования: пресет из encoding.PRESETS с переопределёнными полями и список вариантов
+def build_output(output_format="png", quality=None, max_bytes=None, compress_level=None, variants=None):
+    if output_format not in PRESETS:
+        raise HTTPException(status_code=400, detail=f"Неизвестный формат вывода: {output_format}. Доступны: {', '.join(PRESETS)}")
+    spec = PRESETS[output_format]
+    if quality is not None:
+        if not 1 <= quality <= 100:
+            raise HTTPException(status_code=400, detail="output_quality должно быть от 1 до 100")
+        spec = replace(spec, quality=quality)
+    if max_bytes is not None:
+        if max_bytes <= 0:
+            raise HTTPException(status_code=400, detail="output_max_bytes должно быть положительным")
+        spec = replace(spec, max_bytes=max_bytes)
+    if compress_level is not None:
+        if not 0 <= compress_level <= 9:
+            raise HTTPException(status_code=400, detail="png_compress_level должно быть от 0 до 9")
+        spec = replace(spec, compress_level=compress_level)
+    names = tuple(dict.fromkeys(name.strip() for name in (variants or "").split(",") if name.strip()))
+    unknown = [name for name in names if name not in PRESETS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Неизвестные варианты: {', '.join(unknown)}. Доступны: {', '.join(PRESETS)}")
+    return spec, names
+
+# Модель запроса: имя из MODELS, по умолчанию DEFAULT_MODEL
+def resolve_model(model=None):
+    model = model or DEFAULT_MODEL
+    if model not in MODELS:
+        raise HTTPException(status_code=400, detail=f"Неизвестная модель: {model}. Доступны: {', '.join(MODELS)}")
+    if USE_RAY and model != DEFAULT_MODEL:
+        raise HTTPException(status_code=400, detail=f"В режиме Ray доступна только модель {DEFAULT_MODEL}")
+    return model
+
+# Срок задачи: запрошенный клиентом, но не больше JOB_TIMEOUT_SECONDS
+def resolve_timeout(timeout=None):
+    if timeout is not None and timeout <= 0:
+        raise HTTPException(status_code=400, detail="timeout должно быть положительным")
+    limit = JOB_TIMEOUT_SECONDS if JOB_TIMEOUT_SECONDS > 0 else None
+    if timeout is None or limit is None:
+        return timeout if timeout is not None else limit
+    return min(timeout, limit)
+
+# Проверка параметров запроса и сборка GenerationOptions
+def build_options(seed, upscaler, save_raw, response_mode, save_to_disk, sampling=None, client=None,
+                  output=OutputSpec(), variants=(), model=None, timeout=None):
+    if upscaler not in UPSCALER_FACTORIES:
+        raise HTTPException(status_code=400, detail=f"Неизвестный апскейлер: {upscaler}. Доступны: {', '.join(UPSCALER_FACTORIES)}")
+    if response_mode not in RESPONSE_MODES:
+        raise HTTPException(status_code=400, detail=f"Неизвестный режим ответа: {response_mode}. Доступны: {', '.join(RESPONSE_MODES)}")
+    if response_mode == "path":
+        save_to_disk = True
+    elif save_to_disk is None:
+        save_to_disk = False
+    return GenerationOptions(seed=seed, upscaler=upscaler, save_raw=save_raw, save_to_disk=save_to_disk,
+                             sampling=sampling, client=client or Client(), output=output, variants=variants,
+                             model=resolve_model(model), timeout=resolve_timeout(timeout))
+
+def build_txt2img_options(data: PromptRequest, request: Request):
+    if not 1 <= data.num_images <= INFERENCE_QUEUE_MAX:
+        raise HTTPException(status_code=400, detail=f"num_images должно быть от 1 до {INFERENCE_QUEUE_MAX}")
+    if data.response_mode == "image" and data.num_images > 1:
+        raise HTTPException(status_code=400, detail="Режим image отдаёт одно изображение: для num_images > 1 "
+                                                    "используйте multipart или stream")
+    sampling = build_sampling("txt2img", data.tier, steps=data.steps, guidance=data.guidance,
+                              scheduler=data.scheduler, width=data.width, height=data.height,
+                              hires_scale=data.hires_scale, hires_steps=data.hires_steps,
+                              hires_strength=data.hires_strength)
+    client = resolve_client(request, data.client_id, data.priority)
+    output, variants = build_output(data.output_format, data.output_quality, data.output_max_bytes,
+                                    data.png_compress_level, data.variants)
+    return build_options(data.seed, data.upscaler, data.save_raw, data.response_mode, data.save_to_disk, sampling,
+                         client, output, variants, data.model, data.timeout)
 
-# Структура для хранения статуса задачи
-tasks_status = {}
+# Хранилище задач генерации (с TTL, вместо вечно растущего словаря статусов)
+job_store = JobStore(ttl=JOB_TTL_SECONDS, max_result_bytes=JOB_RESULTS_MAX_BYTES, result_size=ImageResult.nbytes,
+                     release_result=ImageResult.without_data)
+
+# Ставит задачу генерации; run(options) возвращает корутину задачи.
+# Превью изображений задачи публикуются в хранилище и уходят клиентам по SSE.
+# Срок задачи переходит в её запросы к очереди: просроченные выбрасываются планировщиком.
+# Места в очереди под все num_images изображений занимаются до создания задачи: если их нет,
+# запрос сразу получает 429 с Retry-After, а не task_id задачи, которая потом упадёт.
+def submit_job(kind, options, run, num_images=1):
+    def start(job):
+        preview = partial(publish_job_preview, job) if PREVIEW_EVERY_STEPS > 0 and ray_pool is None else None
+        deadline = None if options.timeout is None else asyncio.get_running_loop().time() + options.timeout
+        return run(replace(options, preview=preview, job_id=job.id, deadline=deadline))
+    try:
+        batcher.admit(num_images)
+    except QueueFullError as e:
+        raise queue_full_error(e)
+    job = job_store.submit(kind, start, timeout=options.timeout)
+    batcher.reserve(job.id, num_images)
+    # Остаток резерва (попадания в кэш, отмена до постановки в очередь) снимается по завершении задачи
+    job.task.add_done_callback(lambda task: batcher.release(job.id))
+    return job
+
+# Статус задачи; пока её запросы ждут в очереди — вместе с положением в очереди и оценкой ожидания
+def job_status(job):
+    status = job.to_dict()
+    position = batcher.queue_position(job.id)
+    if position is not None:
+        status.update(position)
+    return status
+
+def publish_job_preview(job, index, step, steps, data):
+    job_store.publish_preview(job, Preview(index=index, step=step, steps=steps, data=data))
+
+# Генерация по текстовому запросу, результат — список ImageResult в порядке готовности.
+# on_result вызывается для каждого готового изображения (для потоковой отдачи).
+# Все изображения сразу встают в очередь; делить GPU с другими клиентами — забота очереди.
+async def run_txt2img_job(prompt: str, num_images: int, options: GenerationOptions, on_result=None):
+    tasks = [asyncio.create_task(generate_image(prompt=prompt, is_reference=False, options=options.for_image(i)))
+             for i in range(num_images)]
+    results = []
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            result = await next_result
+            results.append(result)
+            if on_result is not None:
+                on_result(result)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    logger.info(f"Генерация {len(results)} изображений завершена.")
+    return results
+
+# Дожидается задачи и возвращает результаты либо пробрасывает её ошибку.
+# С request задача отменяется, если клиент отключился, не дождавшись ответа.
+async def wait_job_results(job, request: Request = None):
+    if request is not None:
+        while not await job_store.wait_finished(job, DISCONNECT_POLL_SECONDS):
+            if await request.is_disconnected():
+                logger.info(f"Клиент отключился, задача {job.id} отменена")
+                job_store.cancel(job)
+                break
+    await job_store.wait_finished(job)
+    if job.exception is not None:
+        raise job.exception
+    if job.state == CANCELLED:
+        raise HTTPException(status_code=410, detail="Задача отменена")
+    if job.state == EXPIRED:
+        raise HTTPException(status_code=504, detail="Срок задачи истёк")
+    return job.results
+
+# Части multipart/mixed ответа
+# Часть multipart с изображением; варианты идут сразу за основным выходом с заголовком X-Variant
+def multipart_part(boundary, result):
+    body = b""
+    for variant, part in [(None, result), *result.variants.items()]:
+        headers = (
+            f"--{boundary}\r\n"
+            f"Content-Type: {part.content_type}\r\n"
+            f'Content-Disposition: attachment; filename="{part.filename}"\r\n'
+            + (f"X-Variant: {variant}\r\n" if variant else "")
+            + f"Content-Length: {len(part.data)}\r\n\r\n"
+        )
+        body += headers.encode("utf-8") + part.data + b"\r\n"
+    return body
+
+def multipart_error_part(boundary, error):
+    payload = json.dumps({"error": error}, ensure_ascii=False).encode("utf-8")
+    headers = f"--{boundary}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n"
+    return headers.encode("utf-8") + payload + b"\r\n"
+
+def multipart_end(boundary):
+    return f"--{boundary}--\r\n".encode("utf-8")
+
+# Ответ с готовыми результатами задачи в выбранном режиме
+def build_results_response(job, results, response_mode):
+    if response_mode == "image":
+        result = results[0]
+        return Response(content=result.data, media_type=result.content_type, headers={
+            "X-Task-Id": job.id,
+            "X-Image-Count": str(len(results)),
+            "Content-Disposition": f'inline; filename="{result.filename}"',
+        })
+    if response_mode == "multipart":
+        boundary = uuid.uuid4().hex
+        body = b"".join(multipart_part(boundary, result) for result in results) + multipart_end(boundary)
+        return Response(content=body, media_type=f"multipart/mixed; boundary={boundary}", headers={"X-Task-Id": job.id})
+    return {"task_id": job.id, "filenames": [result.path for result in results]}
+
+# Потоковый ответ: изображения отправляются по мере готовности, не дожидаясь всей задачи
+def build_streaming_response(job, ready):
+    boundary = uuid.uuid4().hex
+
+    async def body():
+        try:
+            while True:
+                getter = asyncio.ensure_future(ready.get())
+                await asyncio.wait({getter, job.task}, return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    yield multipart_part(boundary, getter.result())
+                    continue
+                getter.cancel()
+                while not ready.empty():
+                    yield multipart_part(boundary, ready.get_nowait())
+                break
+        finally:
+            # Клиент отключился посреди потока — оставшиеся изображения уже некому отдать
+            if job_store.cancel(job):
+                logger.info(f"Клиент отключился, задача {job.id} отменена")
+            else:
+                job_store.release_results(job)
+        if job.error is not None:
+            yield multipart_error_part(boundary, job.error)
+        elif job.state == EXPIRED:
+            yield multipart_error_part(boundary, "Срок задачи истёк")
+        yield multipart_end(boundary)
+
+    return StreamingResponse(body(), media_type=f"multipart/mixed; boundary={boundary}", headers={"X-Task-Id": job.id})
+
+# Генерации принимаются только после загрузки и прогрева модели
+def require_ready():
+    if not startup.ready:
+        detail = "Модель ещё загружается" if startup.error is None else f"Модель не загрузилась: {startup.error}"
+        raise HTTPException(status_code=503, detail=detail, headers={"Retry-After": "10"})
 
 # Основная функция для генерации изображений
 @app.post("/generate")
-async def generate_images(data: PromptRequest):
+async def generate_images(data: PromptRequest, request: Request):
+    """
+    Синхронная генерация: ждёт готовые изображения и возвращает их в режиме response_mode
+    """
     try:
+        require_ready()
         prompt = data.prompt.strip()
+        options = build_txt2img_options(data, request)
+        record_request("generate", options, data.num_images, request_params(data))
 
-        # Ограничение на количество одновременно выполняемых задач
-        max_tasks = 2  # Максимум 2 параллельные задачи
-        tasks = [generate_image(prompt=prompt, is_reference=False) for _ in range(min(data.num_images, max_tasks))]
-
-        # Ожидание всех задач
-        task_ids = [str(uuid.uuid4()) for _ in tasks]
-        for task_id, task in zip(task_ids, tasks):
-            tasks_status[task_id] = "in_progress"
-        
-        upscaled_images = await asyncio.gather(*tasks)
-
-        for task_id in task_ids:
-            tasks_status[task_id] = "completed"
+        if data.response_mode == "stream":
+            ready = asyncio.Queue()
+            job = submit_job("txt2img", options,
+                             lambda options: run_txt2img_job(prompt, data.num_images, options, on_result=ready.put_nowait),
+                             data.num_images)
+            return build_streaming_response(job, ready)
 
-        logger.info(f"Генерация {data.num_images} изображений завершена.")
-        return {"filenames": upscaled_images}
+        job = submit_job("txt2img", options, lambda options: run_txt2img_job(prompt, data.num_images, options),
+                         data.num_images)
+        results = await wait_job_results(job, request)
+        response = build_results_response(job, results, data.response_mode)
+        # Изображения уже в ответе: задача остаётся для статуса, а память освобождается
+        job_store.release_results(job)
+        return response
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при генерации изображений: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка при генерации изображений: {e}")
 
+# Асинхронная постановка задачи: сразу возвращает task_id
+@app.post("/submit")
+async def submit_images(data: PromptRequest, request: Request):
+    require_ready()
+    prompt = data.prompt.strip()
+    options = build_txt2img_options(data, request)
+    record_request("submit", options, data.num_images, request_params(data))
+    job = submit_job("txt2img", options, lambda options: run_txt2img_job(prompt, data.num_images, options),
+                         data.num_images)
+    logger.info(f"Задача {job.id} поставлена в очередь: {data.num_images} изображений, клиент {options.client.id}")
+    return job_status(job)
+
+def get_job_or_404(task_id: str):
+    job = job_store.get(task_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+    return job
+
+# Результаты завершённой задачи либо ошибка, если задача упала или ещё выполняется
+def get_finished_results(task_id: str):
+    job = get_job_or_404(task_id)
+    if job.state == FAILED:
+        raise HTTPException(status_code=500, detail=job.error)
+    if job.state == CANCELLED:
+        raise HTTPException(status_code=410, detail="Задача отменена")
+    if job.state == EXPIRED:
+        raise HTTPException(status_code=504, detail="Срок задачи истёк")
+    if not job.finished:
+        raise HTTPException(status_code=409, detail=f"Задача ещё не завершена: {job.state}")
+    return job, job.results
+
+# Байты изображений завершённой задачи: 410, если они уже освобождены
+def get_finished_images(task_id: str):
+    job, results = get_finished_results(task_id)
+    if job.results_released:
+        raise HTTPException(status_code=410, detail="Изображения задачи больше не хранятся в памяти сервера")
+    return job, results
+
+# Liveness: процесс жив и модель не упала при загрузке (503 — перезапустить)
+@app.get("/health")
+async def get_health():
+    status = startup.to_dict()
+    if startup.error is not None:
+        return JSONResponse(status, status_code=503)
+    return status
+
+# Readiness: модель загружена и прогрета, трафик можно направлять сюда
+@app.get("/ready")
+async def get_ready():
+    status = startup.to_dict()
+    return JSONResponse(status, status_code=200 if startup.ready else 503)
+
+# Эндпоинт с информацией о моделях: состояние, время загрузки и переносов, память по компонентам,
+# профиль памяти с пиковой памятью и скоростью по размерам выхода
+@app.get("/pipelines")
+async def get_pipelines():
+    require_ready()
+    if ray_pool is not None:
+        return {"ray": {**ray_pool.stats(), "actor_stats": await ray_pool.actor_stats()}}
+    return {**model_manager.stats(), "default_model": DEFAULT_MODEL, "memory_profile": profile_stats.stats()}
+
+# Список моделей и их состояние: hot — на устройстве, warm — в RAM, cold — на диске
+@app.get("/models")
+async def get_models():
+    if model_manager is None:
+        state = "ray" if ray_pool is not None else None
+        models = {name: {"path": path, "state": state if name == DEFAULT_MODEL else None} for name, path in MODELS.items()}
+    else:
+        models = {name: {"path": stats["path"], "state": stats["state"], "timings": stats["timings"]}
+                  for name, stats in model_manager.stats()["models"].items()}
+    return {"default": DEFAULT_MODEL, "models": models}
+
+# Заранее перенести модель на устройство (например, перед пиком запросов к ней).
+# Загрузка идёт в потоке инференса между батчами.
+@app.post("/models/{name}/load")
+async def load_model(name: str):
+    require_ready()
+    name = resolve_model(name)
+    if model_manager is None:
+        return {"name": name, "state": "ray"}
+    started = time.perf_counter()
+    await asyncio.get_running_loop().run_in_executor(batcher.executor, model_manager.acquire, name)
+    stats = model_manager.stats()["models"][name]
+    logger.info(f"Модель {name} перенесена на устройство по запросу за {time.perf_counter() - started:.1f} с")
+    return {"name": name, "state": stats["state"], "timings": stats["timings"]}
+
+# Кэши эмбеддингов загруженных моделей (модели с общим текстовым энкодером делят один кэш)
+def embedding_cache_stats():
+    if model_manager is None:
+        return {}
+    return {entry.name: entry.embedding_cache.stats() for entry in model_manager.loaded()
+            if entry.embedding_cache is not None}
+
+# Статистика кэшей результатов и эмбеддингов промптов
+@app.get("/cache")
+async def get_cache_stats():
+    return {
+        "results": result_cache.stats(),
+        # В режиме Ray кэш эмбеддингов живёт в каждом акторе отдельно
+        "prompt_embeddings": embedding_cache_stats() or None,
+        "references": reference_cache.stats(),
+        "reference_latents": reference_latent_cache.stats() if reference_latent_cache is not None else None,
+    }
+
+# Длительности стадий генерации: очередь, инференс, апскейл, кодирование PNG
+@app.get("/timings")
+async def get_timings():
+    return stage_timings.stats()
+
+# Метрики в текстовом формате Prometheus: гистограммы стадий и текущее состояние сервера
+@app.get("/metrics")
+async def get_metrics():
+    lines = stage_timings.prometheus("sd_stage_duration_seconds")
+    lines += prometheus_gauge("sd_ready", "Модель загружена и прогрета", int(startup.ready))
+    lines += prometheus_gauge("sd_startup_phase_seconds", "Длительность фаз запуска",
+                              {(("phase", name),): seconds for name, seconds in startup.phases.items()})
+    lines += prometheus_gauge("sd_jobs", "Задачи генерации по состояниям",
+                              {(("state", state),): count for state, count in job_store.counts().items()})
+    lines += prometheus_gauge("sd_job_result_bytes", "Память изображений завершённых задач", job_store.result_bytes)
+    lines += prometheus_gauge("sd_job_results_released", "Задачи, изображения которых вытеснены лимитом памяти",
+                              job_store.released)
+    lines += prometheus_gauge("sd_queue_images", "Изображения, ожидающие инференса", batcher.queued_images)
+    lines += prometheus_gauge("sd_queue_reserved_images", "Места в очереди, занятые допущенными задачами",
+                              batcher.pending_images - batcher.queued_images)
+    lines += prometheus_gauge("sd_running_batches", "Батчи в работе", len(batcher.running))
+    lines += prometheus_gauge("sd_dropped_images", "Изображения, выброшенные из очереди без генерации",
+                              {(("reason", reason),): count for reason, count in batcher.dropped.items()})
+    lines += prometheus_gauge("sd_aborted_batches", "Батчи, прерванные посреди денойзинга", batcher.aborted_batches)
+    lines += prometheus_gauge("sd_queue_estimated_wait_seconds", "Оценка ожидания нового запроса",
+                              batcher.estimated_wait())
+    snapshot = resource_sampler.snapshot
+    lines += prometheus_gauge("sd_host_cpu_percent", "Загрузка CPU хоста", snapshot["cpu"])
+    lines += prometheus_gauge("sd_host_memory_percent", "Занятая память хоста", snapshot["ram"])
+    lines += prometheus_gauge("sd_process_rss_bytes", "Резидентная память процесса сервера",
+                              psutil.Process().memory_info().rss)
+    torch = loaded_torch()
+    if torch is not None and torch.cuda.is_available():
+        devices = range(torch.cuda.device_count())
+        lines += prometheus_gauge("sd_gpu_memory_allocated_bytes", "Память GPU, занятая тензорами",
+                                  {(("device", str(i)),): torch.cuda.memory_allocated(i) for i in devices})
+        lines += prometheus_gauge("sd_gpu_memory_reserved_bytes", "Память GPU, удерживаемая аллокатором",
+                                  {(("device", str(i)),): torch.cuda.memory_reserved(i) for i in devices})
+    profile = profile_stats.stats()
+    sizes = profile["sizes"]
+    lines += prometheus_gauge("sd_profile_peak_memory_bytes", "Пиковая память батча по размерам выхода",
+                              {(("profile", profile["profile"]), ("size", size)): entry["peak_bytes"]
+                               for size, entry in sizes.items()})
+    lines += prometheus_gauge("sd_profile_seconds_per_image", "Время инференса на изображение по размерам выхода",
+                              {(("profile", profile["profile"]), ("size", size)): entry["seconds_per_image"]
+                               for size, entry in sizes.items()})
+    if model_manager is not None:
+        models = model_manager.stats()["models"]
+        lines += prometheus_gauge("sd_model_state", "Состояние моделей: 1 — модель в этом состоянии",
+                                  {(("model", name), ("state", state)): int(stats["state"] == state)
+                                   for name, stats in models.items() for state in (HOT, WARM, COLD)})
+        lines += prometheus_gauge("sd_model_transition_seconds",
+                                  "Последняя длительность загрузки, подготовки и переносов модели",
+                                  {(("model", name), ("phase", phase)): seconds
+                                   for name, stats in models.items() for phase, seconds in stats["timings"].items()})
+        lines += prometheus_gauge("sd_model_evictions", "Вытеснения модели с устройства",
+                                  {(("model", name),): stats["evictions"] for name, stats in models.items()})
+    caches = {"results": result_cache.stats()}
+    for name, stats in embedding_cache_stats().items():
+        caches[f"prompt_embeddings:{name}"] = stats
+    caches["references"] = reference_cache.stats()
+    if reference_latent_cache is not None:
+        caches["reference_latents"] = reference_latent_cache.stats()
+    lines += prometheus_gauge("sd_cache_hit_ratio", "Доля попаданий в кэш",
+                              {(("cache", name),): stats["hit_rate"] for name, stats in caches.items()})
+    lines += prometheus_gauge("sd_cache_coalesced_ratio",
+                              "Доля запросов к кэшу результатов, присоединившихся к уже идущей генерации",
+                              {(("cache", "results"),): caches["results"]["coalesced_rate"]})
+    lines += prometheus_gauge("sd_cache_bytes", "Объём кэша в байтах",
+                              {(("cache", name),): stats["bytes"] for name, stats in caches.items()})
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+# Сброс замеров стадий (например, между прогонами бенчмарка)
+@app.delete("/timings")
+async def reset_timings():
+    stage_timings.reset()
+    profile_stats.reset()
+    return {"status": "ok"}
+
 # Эндпоинт для получения статуса задачи
 @app.get("/status")
-async def get_status(task_id: str):
+async def get_status(task_id: str, wait: float = 0):
     """
     Возвращает статус задачи по task_id
     """
-    if task_id not in tasks_status:
-        raise HTTPException(status_code=404, detail="Task not found")
-    
-    status = tasks_status[task_id]
-    return {"task_id": task_id, "status": status}
+    return await get_status_by_path(task_id, wait)
+
+@app.get("/status/files/{task_id}")
+async def get_status_files(task_id: str):
+    """
+    Возвращает пути к изображениям завершённой задачи (None для изображений, не записанных на диск)
+    """
+    job, results = get_finished_results(task_id)
+    filenames = [result.path for result in results]
+    if job.kind == "img2img":
+        return {"task_id": job.id, "filename": filenames[0], "filenames": filenames, "count": len(results)}
+    return {"task_id": job.id, "filenames": filenames, "count": len(results)}
+
+@app.get("/status/images/{task_id}")
+async def get_status_images(task_id: str):
+    """
+    Возвращает все изображения завершённой задачи одним multipart/mixed ответом
+    """
+    job, results = get_finished_images(task_id)
+    return build_results_response(job, results, "multipart")
+
+@app.get("/status/images/{task_id}/{index}")
+async def get_status_image(task_id: str, index: int, variant: Optional[str] = None):
+    """
+    Возвращает одно изображение завершённой задачи; variant — один из запрошенных дополнительных выходов
+    """
+    job, results = get_finished_images(task_id)
+    if not 0 <= index < len(results):
+        raise HTTPException(status_code=404, detail="Image not found")
+    result = results[index]
+    if variant is not None:
+        if variant not in result.variants:
+            raise HTTPException(status_code=404, detail=f"Variant not found: {variant}")
+        result = result.variants[variant]
+    return build_results_response(job, [result], "image")
+
+@app.get("/status/{task_id}")
+async def get_status_by_path(task_id: str, wait: float = 0):
+    """
+    Возвращает статус задачи. С wait > 0 работает как long-poll:
+    отвечает сразу после завершения задачи, но не позже чем через wait секунд.
+    """
+    job = get_job_or_404(task_id)
+    if wait > 0 and not job.finished:
+        await job_store.wait_finished(job, min(wait, MAX_LONG_POLL_SECONDS))
+    return job_status(job)
+
+# Отмена задачи: её запросы выбрасываются из очереди, а батч, который больше никому не нужен,
+# прерывается между шагами денойзинга
+@app.post("/status/{task_id}/cancel")
+@app.delete("/status/{task_id}")
+async def cancel_task(task_id: str):
+    job = get_job_or_404(task_id)
+    if not job_store.cancel(job):
+        raise HTTPException(status_code=409, detail=f"Задача уже завершена: {job.state}")
+    await job_store.wait_finished(job)
+    return job_status(job)
+
+# SSE-событие с превью: JPEG в base64
+def preview_event(preview):
+    payload = {
+        "index": preview.index,
+        "step": preview.step,
+        "steps": preview.steps,
+        "content_type": "image/jpeg",
+        "data": base64.b64encode(preview.data).decode("ascii"),
+    }
+    return f"event: preview\ndata: {json.dumps(payload)}\n\n"
+
+@app.get("/status/{task_id}/events")
+async def get_status_events(task_id: str, previews: bool = True):
+    """
+    Поток server-sent events с изменениями статуса задачи до её завершения.
+    С previews=true в поток также идут события preview с промежуточными изображениями.
+    """
+    job = get_job_or_404(task_id)
+
+    async def event_stream():
+        state = None
+        sent_steps = {}  # индекс изображения -> шаг последнего отправленного превью
+        while True:
+            if previews:
+                for preview in list(job.previews.values()):
+                    if sent_steps.get(preview.index) != preview.step:
+                        sent_steps[preview.index] = preview.step
+                        yield preview_event(preview)
+            if job.state != state:
+                state = job.state
+                yield f"event: status\ndata: {json.dumps(job_status(job))}\n\n"
+            if job.finished:
+                return
+            while not await job_store.wait_changed(job, SSE_KEEPALIVE_SECONDS):
+                yield ": keep-alive\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Читает загруженный референс, не больше MAX_UPLOAD_BYTES
+async def read_upload(image: UploadFile):
+    data = await image.read(MAX_UPLOAD_BYTES + 1)
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Файл больше {MAX_UPLOAD_BYTES // 1024 ** 2} МБ")
+    if not data:
+        raise HTTPException(status_code=400, detail="Пустой файл")
+    return data
+
+# Строки трассы дописываются из пула потоков
+trace_lock = threading.Lock()
+
+def append_trace(event, reference=None):
+    if reference is not None:
+        event["reference"] = {"bytes": len(reference)}
+        try:
+            # Размер — из заголовка, без декодирования
+            with Image.open(io.BytesIO(reference)) as image:
+                event["reference"].update(width=image.width, height=image.height, format=image.format)
+        except (OSError, Image.DecompressionBombError):
+            pass
+    line = json.dumps(event, ensure_ascii=False)
+    with trace_lock:
+        with open(REQUEST_TRACE_PATH, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+# Запись принятого запроса в трассу, не задерживая ответ. params — параметры запроса без промпта.
+def record_request(endpoint, options, num_images=1, params=None, reference=None):
+    if REQUEST_TRACE_PATH is None:
+        return
+    event = {
+        "t": time.time(),
+        "endpoint": endpoint,
+        "client_id": options.client.id,
+        "num_images": num_images,
+        "options": {name: value for name, value in (params or {}).items() if value is not None},
+    }
+    image_executor.submit(append_trace, event, reference)
+
+# Параметры JSON-запроса для трассы: всё, кроме промпта, числа изображений и клиента
+def request_params(data: PromptRequest):
+    return {name: value for name, value in data if name not in ("prompt", "num_images", "client_id")}
+
+# Поля формы запроса для трассы: всё, кроме промпта, файла и клиента (форма уже разобрана FastAPI)
+async def form_params(request: Request):
+    form = await request.form()
+    return {name: value for name, value in form.items()
+            if name not in ("prompt", "image", "client_id") and isinstance(value, str)}
+
+# Декодированные и уменьшенные референсы по хэшу содержимого
+reference_cache = DecodedReferenceCache(max_bytes=REFERENCE_CACHE_MAX_BYTES)
+
+# Приём референса: декодирование с уменьшением в пуле потоков, повторная картинка берётся из кэша
+async def load_reference(image_bytes: bytes, reference_hash: str, max_side: int):
+    key = (reference_hash, max_side)
+    image = reference_cache.get(key)
+    if image is None:
+        started = time.perf_counter()
+        image = await asyncio.get_running_loop().run_in_executor(
+            image_executor, decode_reference, image_bytes, max_side, MAX_REFERENCE_PIXELS)
+        stage_timings.record("reference_decode", time.perf_counter() - started)
+        reference_cache.put(key, image)
+    return image
 
 # Функция для генерации изображения по референсному изображению
-async def generate_reference_image(prompt: str, image_bytes: bytes) -> str:
+async def generate_reference_image(prompt: str, image_bytes: bytes, options: GenerationOptions = None) -> ImageResult:
     try:
-        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-        logger.info("Генерация изображения по референсному изображению...")
-        return await generate_image(prompt=prompt, is_reference=True, image=image)
+        reference_hash = hashlib.sha256(image_bytes).hexdigest()
+        sampling = options.sampling if options is not None else None
+        max_side = max(REFERENCE_MAX_SIDE, (sampling and sampling.width) or 0, (sampling and sampling.height) or 0)
+        image = await load_reference(image_bytes, reference_hash, max_side)
+        logger.info(f"Генерация изображения по референсному изображению {image.width}x{image.height}...")
+        return await generate_image(prompt=prompt, is_reference=True, image=image, options=options,
+                                    reference_hash=reference_hash)
+    except HTTPException:
+        raise
+    except ReferenceRejected as e:
+        raise HTTPException(status_code=e.status, detail=str(e))
     except Exception as e:
         logger.error(f"Ошибка при генерации изображения по референсному изображению: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка при генерации изображения по референсному изображению: {e}")
 
+async def run_reference_job(prompt: str, image_bytes: bytes, options: GenerationOptions, on_result=None):
+    result = await generate_reference_image(prompt=prompt, image_bytes=image_bytes, options=options)
+    if on_result is not None:
+        on_result(result)
+    return [result]
+
 # Эндпоинт для генерации изображения с референсным изображением
 @app.post("/generate_by_reference")
 async def generate_by_reference_image(
+    request: Request,
     prompt: str = Form(...),  # Формат для текстового запроса
     image: UploadFile = File(...),  # Формат для загрузки изображения
+    seed: Optional[int] = Form(None),  # С seed результат детерминирован и кэшируется
+    upscaler: str = Form(DEFAULT_UPSCALER),  # "none", "cubic", "lanczos" или "realesrgan"
+    save_raw: bool = Form(False),  # Сохранить также исходник без апскейла
+    response_mode: str = Form("path"),  # "path", "image", "multipart" или "stream"
+    save_to_disk: Optional[bool] = Form(None),  # По умолчанию пишем на диск только в режиме path
+    width: Optional[int] = Form(None),  # По умолчанию — размер референса
+    height: Optional[int] = Form(None),
+    steps: Optional[int] = Form(None),  # По умолчанию — по ярусу
+    guidance: Optional[float] = Form(None),
+    strength: Optional[float] = Form(None),
+    scheduler: Optional[str] = Form(None),
+    tier: str = Form("quality"),  # "quality", "fast" или "auto"
+    client_id: Optional[str] = Form(None),  # Бот или пользователь; по нему делится очередь
+    priority: str = Form("normal"),  # "high", "normal" или "low"
+    output_format: str = Form("png"),  # формат или пресет из encoding.PRESETS
+    output_quality: Optional[int] = Form(None),
+    output_max_bytes: Optional[int] = Form(None),
+    png_compress_level: Optional[int] = Form(None),
+    variants: Optional[str] = Form(None),  # дополнительные выходы через запятую
+    model: Optional[str] = Form(None),  # имя модели из MODELS
+    timeout: Optional[float] = Form(None),  # срок задачи в секундах, не больше JOB_TIMEOUT_SECONDS
 ):
     try:
+        require_ready()
+        sampling = build_sampling("img2img", tier, steps=steps, guidance=guidance, strength=strength,
+                                  scheduler=scheduler, width=width, height=height)
+        client = resolve_client(request, client_id, priority)
+        output, variants = build_output(output_format, output_quality, output_max_bytes, png_compress_level, variants)
+        options = build_options(seed, upscaler, save_raw, response_mode, save_to_disk, sampling, client, output,
+                                variants, model, timeout)
         logger.info("Получен референс для генерации.")
         
-        # Проверим, что файл действительно загружен
-        image_bytes = await image.read()
+        # Проверим, что файл действительно загружен и не больше лимита
+        image_bytes = await read_upload(image)
         logger.info(f"Получено изображение с размером {len(image_bytes)} байт.")
+        record_request("generate_by_reference", options, params=await form_params(request), reference=image_bytes)
 
         # Генерация изображения по референсному изображению
-        filename = await generate_reference_image(prompt=prompt, image_bytes=image_bytes)
+        if response_mode == "stream":
+            ready = asyncio.Queue()
+            job = submit_job("img2img", options,
+                             lambda options: run_reference_job(prompt, image_bytes, options, on_result=ready.put_nowait))
+            return build_streaming_response(job, ready)
 
-        logger.info(f"Референсное изображение сгенерировано и сохранено: {filename}")
-        return {"filename": filename}
+        job = submit_job("img2img", options, lambda options: run_reference_job(prompt, image_bytes, options))
+        results = await wait_job_results(job, request)
+
+        logger.info(f"Референсное изображение сгенерировано: {results[0].filename}")
+        job_store.release_results(job)
+        if response_mode == "path":
+            return {"task_id": job.id, "filename": results[0].path}
+        return build_results_response(job, results, response_mode)
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при обработке референсного изображения: {e}")
         raise HTTPException(status_code=500, detail="Ошибка при обработке изображения")
 
-# Функции для выполнения через Ray (для асинхронных задач)
-@ray.remote
-def generate_img2img_task(prompt, image):
-    return img2img_pipe(prompt=prompt, image=image, strength=0.4, guidance_scale=8.5, num_inference_steps=40).images[0]
+# Асинхронная постановка задачи по референсу: сразу возвращает task_id
+@app.post("/submit_by_reference")
+async def submit_by_reference_image(
+    request: Request,
+    prompt: str = Form(...),
+    image: UploadFile = File(...),
+    seed: Optional[int] = Form(None),
+    upscaler: str = Form(DEFAULT_UPSCALER),
+    save_raw: bool = Form(False),
+    response_mode: str = Form("path"),
+    save_to_disk: Optional[bool] = Form(None),
+    width: Optional[int] = Form(None),
+    height: Optional[int] = Form(None),
+    steps: Optional[int] = Form(None),
+    guidance: Optional[float] = Form(None),
+    strength: Optional[float] = Form(None),
+    scheduler: Optional[str] = Form(None),
+    tier: str = Form("quality"),
+    client_id: Optional[str] = Form(None),
+    priority: str = Form("normal"),
+    output_format: str = Form("png"),
+    output_quality: Optional[int] = Form(None),
+    output_max_bytes: Optional[int] = Form(None),
+    png_compress_level: Optional[int] = Form(None),
+    variants: Optional[str] = Form(None),
+    model: Optional[str] = Form(None),
+    timeout: Optional[float] = Form(None),
+):
+    require_ready()
+    sampling = build_sampling("img2img", tier, steps=steps, guidance=guidance, strength=strength,
+                              scheduler=scheduler, width=width, height=height)
+    client = resolve_client(request, client_id, priority)
+    output, variants = build_output(output_format, output_quality, output_max_bytes, png_compress_level, variants)
+    options = build_options(seed, upscaler, save_raw, response_mode, save_to_disk, sampling, client, output, variants,
+                            model, timeout)
+    image_bytes = await read_upload(image)
+    record_request("submit_by_reference", options, params=await form_params(request), reference=image_bytes)
+    job = submit_job("img2img", options, lambda options: run_reference_job(prompt, image_bytes, options))
+    logger.info(f"Задача {job.id} по референсу поставлена в очередь ({len(image_bytes)} байт), клиент {client.id}")
+    return job_status(job)
+
+# Прогоны массовой генерации, запущенные в этом процессе: имя -> задача
+bulk_jobs = {}
+
+def get_bulk_root(name: str):
+    try:
+        return run_root(BULK_OUTPUT_DIR, name)
+    except BulkError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def ensure_bulk_not_running(name: str):
+    job = bulk_jobs.get(name)
+    if job is not None and not job.finished:
+        raise HTTPException(status_code=409, detail=f"Прогон {name} уже выполняется: задача {job.id}")
+
+# Один образец прогона: генерация через общую очередь без кэша результатов и запись в шард.
+# Переполненная очередь или перегруженный хост не теряют образец — запрос повторяется.
+async def generate_bulk_sample(run: BulkRun, sample, options: GenerationOptions, tier: str):
+    params = sample.sampling()
+    model = params.pop("model", options.model)
+    sampling = build_sampling("txt2img", params.pop("tier", tier), **params)
+    sample_options = replace(options, seed=sample.seed, sampling=sampling, model=model)
+    while True:
+        try:
+            data, _ = await render_image(sample.prompt, options=sample_options)
+            break
+        except HTTPException as e:
+            if e.status_code not in (429, 503):
+                raise
+            await asyncio.sleep(min(10.0, float((e.headers or {}).get("Retry-After", 1))))
+
+    metadata = {"prompt": sample.prompt, "seed": sample.seed, **asdict(sampling), "upscaler": options.upscaler,
+                "model": model, "checkpoint": os.path.basename(os.path.normpath(MODELS[model]))}
+    files = {
+        options.output.extension: data,
+        ".txt": sample.prompt.encode("utf-8"),
+        ".json": json.dumps(metadata, ensure_ascii=False).encode("utf-8"),
+    }
+    await asyncio.get_running_loop().run_in_executor(bulk_executor, run.write, sample, files)
+
+# Прогон массовой генерации: готовые по манифесту образцы пропускаются, остальные идут в очередь
+# не больше BULK_MAX_IN_FLIGHT одновременно. Ошибка образца не останавливает прогон:
+# такой образец не попадает в манифест и будет сгенерирован при продолжении.
+async def run_bulk_job(job, run: BulkRun, options: GenerationOptions, tier: str):
+    loop = asyncio.get_running_loop()
+    done = await loop.run_in_executor(bulk_executor, run.recover)
+    samples = run.samples()
+    pending = iter([sample for sample in samples if sample.key not in done])
+    failures = []
+    progress = job.progress = {"total": len(samples), "done": len(done), "failed": 0, "images_per_sec": 0.0,
+                               "failures": failures}
+    started = time.perf_counter()
+    generated = 0
+    logger.info(f"Прогон {run.root}: образцов {len(samples)}, уже готово {len(done)}")
+
+    async def worker():
+        nonlocal generated
+        # Итератор общий: следующий образец берёт освободившийся воркер
+        for sample in pending:
+            try:
+                await generate_bulk_sample(run, sample, options, tier)
+            except Exception as e:
+                progress["failed"] += 1
+                if len(failures) < BULK_MAX_REPORTED_FAILURES:
+                    failures.append({"key": sample.key, "error": str(getattr(e, "detail", e))})
+                logger.warning(f"Прогон {run.root}: образец {sample.key} не сгенерирован: {e}")
+                continue
+            generated += 1
+            progress["done"] += 1
+            progress["images_per_sec"] = round(generated / (time.perf_counter() - started), 3)
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, BULK_MAX_IN_FLIGHT))]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+    finally:
+        await loop.run_in_executor(bulk_executor, run.close)
+    logger.info(f"Прогон {run.root} завершён: готово {progress['done']} из {progress['total']}, "
+                f"ошибок {progress['failed']}")
+    return []
+
+def start_bulk_job(name: str, run: BulkRun, request: Request):
+    config = run.config
+    client = resolve_client(request, config.get("client_id") or f"bulk:{name}", config.get("priority", "low"))
+    output, _ = build_output(config.get("output_format", "png"), config.get("output_quality"))
+    options = GenerationOptions(upscaler=config.get("upscaler", "none"), save_to_disk=False, client=client,
+                                output=output, model=resolve_model(config.get("model")))
+    job = job_store.submit("bulk", lambda job: run_bulk_job(job, run, replace(options, job_id=job.id),
+                                                            config.get("tier", "quality")))
+    bulk_jobs[name] = job
+    return job
+
+# Массовая генерация датасета из JSONL или CSV промптов.
+# Строка: prompt и необязательные key, seed, num_images, steps, guidance, scheduler, width, height, tier,
+# hires_scale, hires_steps, hires_strength, model. Результат — webdataset-шарды или дерево каталогов
+# с манифестом в BULK_OUTPUT_DIR/<name>; прерванный прогон продолжается через /bulk/{name}/resume.
+@app.post("/bulk")
+async def submit_bulk(
+    request: Request,
+    prompts: UploadFile = File(...),
+    name: Optional[str] = Form(None),  # имя прогона и его каталога; по умолчанию — по времени
+    output: str = Form("tar"),  # "tar" (webdataset) или "directory"
+    shard_size: int = Form(BULK_SHARD_SIZE),  # образцов в шарде
+    upscaler: str = Form("none"),  # для датасета обычно нужен исходный размер
+    tier: str = Form("quality"),  # ярус для строк без своего tier
+    output_format: str = Form("png"),
+    output_quality: Optional[int] = Form(None),
+    client_id: Optional[str] = Form(None),  # по умолчанию bulk:<name>
+    priority: str = Form("low"),  # по умолчанию не мешает интерактивным запросам
+    model: Optional[str] = Form(None),  # модель для строк без своей model
+):
+    require_ready()
+    name = name or time.strftime("bulk_%Y%m%d_%H%M%S")
+    root = get_bulk_root(name)
+    ensure_bulk_not_running(name)
+    data = await read_upload(prompts)
+    model = build_options(None, upscaler, False, "path", False, model=model).model
+    build_output(output_format, output_quality)
+    try:
+        rows = parse_rows(data, prompts.filename or "")
+    except BulkError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Параметры строк проверяются до старта, а не посреди прогона
+    for row in rows:
+        params = {key: value for key, value in row.items()
+                  if key not in ("prompt", "key", "seed", "num_images", "tier", "model")}
+        try:
+            resolve_model(row.get("model"))
+            build_sampling("txt2img", row.get("tier", tier), **params)
+        except HTTPException as e:
+            raise HTTPException(status_code=400, detail=f"Строка {row['key']}: {e.detail}")
+
+    create = partial(BulkRun.create, root, rows, output=output, shard_size=shard_size, upscaler=upscaler,
+                     tier=tier, output_format=output_format, output_quality=output_quality, client_id=client_id,
+                     priority=priority, model=model)
+    try:
+        run = await asyncio.get_running_loop().run_in_executor(bulk_executor, create)
+    except FileExistsError:
+        raise HTTPException(status_code=409, detail=f"Прогон {name} уже существует, продолжить: POST /bulk/{name}/resume")
+    except BulkError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    job = start_bulk_job(name, run, request)
+    logger.info(f"Прогон {name} поставлен: {len(rows)} строк, {len(run.samples())} образцов, задача {job.id}")
+    return {"name": name, **job_status(job)}
+
+# Продолжение прерванного или завершённого с ошибками прогона: готовые образцы не генерируются заново
+@app.post("/bulk/{name}/resume")
+async def resume_bulk(name: str, request: Request):
+    require_ready()
+    root = get_bulk_root(name)
+    ensure_bulk_not_running(name)
+    try:
+        run = await asyncio.get_running_loop().run_in_executor(bulk_executor, BulkRun.open, root)
+    except BulkError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    job = start_bulk_job(name, run, request)
+    logger.info(f"Прогон {name} продолжен, задача {job.id}")
+    return {"name": name, **job_status(job)}
+
+# Состояние прогона: сводка по манифесту на диске и задача, если прогон запускался в этом процессе
+@app.get("/bulk/{name}")
+async def get_bulk(name: str):
+    root = get_bulk_root(name)
+
+    def load():
+        run = BulkRun.open(root)
+        run.read_manifest()
+        return run.stats()
+
+    try:
+        stats = await asyncio.get_running_loop().run_in_executor(image_executor, load)
+    except BulkError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    job = bulk_jobs.get(name)
+    return {"name": name, **stats, "job": job_status(job) if job is not None else None}
 
-@ray.remote
-def generate_txt2img_task(prompt, negative_prompt):
-    return txt2img_pipe(prompt=prompt, negative_prompt=negative_prompt, num_inference_steps=35, guidance_scale=9.0).images[0]
+# Фаза import: от старта процесса до готового приложения (без загрузки модели)
+startup.record("import", time.time() - psutil.Process().create_time())
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,119 @@
+import hashlib
+import logging
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from PIL import Image
+
+logger = logging.getLogger("FastAPI")
+
+# Размеры, совпадающие с CLIP из SD 1.x
+STUB_MAX_LENGTH = 77
+STUB_HIDDEN_SIZE = 768
+
+
+class StubTokenizer:
+    """
+    Токенизатор-заглушка: слова промпта хэшируются в id, как у настоящего — с паддингом до max_length.
+    """
+
+    model_max_length = STUB_MAX_LENGTH
+
+    def __call__(self, prompts, padding="max_length", max_length=STUB_MAX_LENGTH, truncation=True,
+                 return_tensors="pt"):
+        input_ids = torch.zeros((len(prompts), max_length), dtype=torch.long)
+        for row, prompt in enumerate(prompts):
+            words = prompt.split()[:max_length]
+            for col, word in enumerate(words):
+                input_ids[row, col] = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=4).digest(), "big")
+        return SimpleNamespace(input_ids=input_ids, attention_mask=(input_ids != 0).long())
+
+
+class StubTextEncoder:
+    """
+    Текстовый энкодер-заглушка: возвращает тензор нужной формы без вычислений.
+    """
+
+    device = torch.device("cpu")
+    dtype = torch.float32
+    config = SimpleNamespace(use_attention_mask=False)
+
+    def __call__(self, input_ids, attention_mask=None):
+        return (torch.zeros((input_ids.shape[0], input_ids.shape[1], STUB_HIDDEN_SIZE), dtype=self.dtype),)
+
+
+class StubPipeline:
+    """
+    Пайплайн-заглушка с тем же интерфейсом вызова, что у диффузоров.
+    Каждый шаг денойзинга «стоит» step_ms миллисекунд независимо от размера батча
+    (как проход UNet на GPU), колбэки шагов вызываются как у настоящего пайплайна.
+    """
+
+    def __init__(self, kind, step_ms):
+        self.kind = kind
+        self.step_ms = step_ms
+        self.device = torch.device("cpu")
+        self.tokenizer = StubTokenizer()
+        self.text_encoder = StubTextEncoder()
+        self.scheduler = None
+        self.num_timesteps = 0
+
+    def __call__(self, prompt_embeds=None, negative_prompt_embeds=None, num_images_per_prompt=1, image=None,
+                 strength=1.0, width=None, height=None, num_inference_steps=50, guidance_scale=7.5, generator=None,
+                 callback_on_step_end=None, callback_on_step_end_tensor_inputs=("latents",), output_type="pil",
+                 **kwargs):
+        count = prompt_embeds.shape[0] * num_images_per_prompt
+        if isinstance(image, torch.Tensor):
+            # Латенты вместо изображений (hires, кэш латентов референсов)
+            height, width = image.shape[-2] * 8, image.shape[-1] * 8
+            self.num_timesteps = int(num_inference_steps * strength)
+        elif image is not None:
+            width, height = image[0].size
+            self.num_timesteps = int(num_inference_steps * strength)
+        else:
+            width, height = width or 512, height or 512
+            self.num_timesteps = num_inference_steps
+
+        latents = torch.zeros((count, 4, height // 8, width // 8))
+        for step in range(self.num_timesteps):
+            time.sleep(self.step_ms / 1000)
+            if callback_on_step_end is not None:
+                callback_on_step_end(self, step, step, {"latents": latents})
+        if output_type == "latent":
+            return SimpleNamespace(images=latents)
+
+        # Градиент вместо шума: шум кодировался бы в PNG заметно дольше настоящих изображений
+        gradient = np.linspace(0, 255, width, dtype=np.uint8)
+        array = np.stack([np.tile(gradient, (height, 1))] * 3, axis=-1)
+        return SimpleNamespace(images=[Image.fromarray(array) for _ in range(count)])
+
+
+class StubPipelineRegistry:
+    """
+    Замена PipelineRegistry без весов модели — для бенчмарков на CPU.
+    """
+
+    def __init__(self, step_ms):
+        self.step_ms = step_ms
+        self.components = {}
+        self.pipelines = {}
+
+    def load(self, device=None):
+        logger.info(f"Загружен пайплайн-заглушка: {self.step_ms} мс на шаг")
+
+    def unload(self):
+        self.pipelines.clear()
+
+    def get(self, kind):
+        if kind not in self.pipelines:
+            self.pipelines[kind] = StubPipeline(kind, self.step_ms)
+        return self.pipelines[kind]
+
+    def scheduler(self, name):
+        # Заглушке планировщик не нужен, имя лишь сохраняется в пайплайне
+        return name
+
+    def stats(self):
+        return {"backend": "stub", "step_ms": self.step_ms, "pipelines": sorted(self.pipelines)}
@@ -1,16 +1,19 @@
 import os
-import aiohttp
+
 from telegram import Update, InputFile
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
-import uuid
+from api_client import ApiClient, ApiError
 from config import TOKEN2
+from dataset_store import DatasetStore
 
-API_URL = "http://127.0.0.1:8000/generate"
-REF_API_URL = "http://127.0.0.1:8000/generate_by_reference"
 DATASET_PATH = r"E:\spammer\MyProject\datasets"  # Путь к папке для сохранения изображений и промптов
+DATASET_SHARDS = 0  # Число подкаталогов для раскладки датасета (0 — все файлы в одном каталоге)
+
+# Датасет: имена выдаются из индекса в памяти, запись — в пуле потоков
+dataset_store = DatasetStore(DATASET_PATH, shards=DATASET_SHARDS)
 
-if not os.path.exists(DATASET_PATH):
-    os.makedirs(DATASET_PATH)
+# Общий клиент API генерации: пул соединений, таймауты, повторы на 429/503
+api_client = ApiClient()
 
 # ===  генерация по txt (txt2img) ===
 async def generate(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -23,49 +26,23 @@ async def generate(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"Генерация по промпту: {prompt}")
     
     try:
-        # Запрос к API
-        async with aiohttp.ClientSession() as session:
-            async with session.post(API_URL, json={"prompt": prompt}) as res:
-                if res.status != 200:
-                    await update.message.reply_text("Ошибка при генерации изображения.")
-                    return
-                
-                data = await res.json()
-
-        # Проверка, что в ответе есть путь к файлу
-        if "filename" not in data:
-            await update.message.reply_text("Ошибка: файл не был сгенерирован. Попробуйте снова.")
-            return
-        
-        file_path = data["filename"]
-
-        # Проверка существования файла
-        if not os.path.exists(file_path):
-            await update.message.reply_text("Ошибка: файл не найден.")
-            return
-        
-        # Генерация уникального имени файла для датасета
-        unique_id = uuid.uuid4().hex
-        base_filename = f"{prompt.replace(' ', '_')[:30]}_{unique_id}"
-        
-        image_path = os.path.join(DATASET_PATH, f"{base_filename}.png")
-        prompt_path = os.path.join(DATASET_PATH, f"{base_filename}.txt")
-        
-        # Перемещение сгенерированного изображения в папку для датасета
-        os.rename(file_path, image_path)
-        
-        # Сохранение промпта в текстовый файл
-        with open(prompt_path, "w", encoding="utf-8") as f:
-            f.write(prompt)
+        # Запрос к API: сервер возвращает само изображение, а не путь на своём диске.
+        # Пользователю — JPEG в том виде, в каком его всё равно покажет Telegram, в датасет — PNG.
+        image = await api_client.generate(prompt, client_id=f"telegram:{update.effective_user.id}",
+                                          output_format="telegram", variants="dataset")
+
+        # Сохранение изображения и промпта в датасет под новым уникальным именем
+        dataset_image = image.variants.get("dataset", image)
+        base_filename, _ = await dataset_store.save(prompt[:30], dataset_image.data, prompt,
+                                                    extension=os.path.splitext(dataset_image.filename)[1] or ".png")
 
         # Отправка изображения пользователю
-        with open(image_path, "rb") as file:
-            await update.message.reply_photo(photo=InputFile(file))
+        await update.message.reply_photo(photo=InputFile(image.data, filename=image.filename))
 
         # Сообщение о том, что сохранено в датасет
         await update.message.reply_text(f"Изображение и промпт успешно сохранены в датасет под именем {base_filename}.")
 
-    except aiohttp.ClientError as e:
+    except ApiError as e:
         await update.message.reply_text(f"Ошибка при запросе к API: {e}")
     except Exception as e:
         await update.message.reply_text(f"Произошла ошибка: {e}")
@@ -85,44 +62,32 @@ async def refgen(update: Update, context: ContextTypes.DEFAULT_TYPE):
         photo_file = await update.message.photo[-1].get_file()
         img_bytes = await photo_file.download_as_bytearray()
 
-        # Отправляем на API
-        async with aiohttp.ClientSession() as session:
-            files = {'image': ('reference.png', img_bytes, 'image/png')}
-            params = {'prompt': prompt}
-            async with session.post(REF_API_URL, params=params, files=files) as response:
-                if response.status != 200:
-                    await update.message.reply_text("❌ Ошибка генерации изображения.")
-                    return
-
-                data = await response.json()
-                filename = data.get("filename")
+        # Отправляем на API (фото из Telegram приходят в JPEG)
+        image = await api_client.generate_by_reference(prompt, img_bytes, content_type="image/jpeg",
+                                                       client_id=f"telegram:{update.effective_user.id}",
+                                                       output_format="telegram", variants="dataset")
 
-                if not filename or not os.path.exists(filename):
-                    await update.message.reply_text("⚠️ Не удалось получить изображение.")
-                    return
+        # Сохраняем в датасет
+        dataset_image = image.variants.get("dataset", image)
+        base_filename, _ = await dataset_store.save(prompt[:30], dataset_image.data, prompt,
+                                                    extension=os.path.splitext(dataset_image.filename)[1] or ".png")
 
-                # Сохраняем в датасет
-                unique_id = uuid.uuid4().hex
-                base_filename = f"{prompt.replace(' ', '_')[:30]}_{unique_id}"
-                image_path = os.path.join(DATASET_PATH, f"{base_filename}.png")
-                prompt_path = os.path.join(DATASET_PATH, f"{base_filename}.txt")
+        # Отправляем пользователю
+        await update.message.reply_photo(photo=InputFile(image.data, filename=image.filename))
 
-                os.rename(filename, image_path)
-
-                with open(prompt_path, "w", encoding="utf-8") as f:
-                    f.write(prompt)
-
-                # Отправляем пользователю
-                with open(image_path, "rb") as f:
-                    await update.message.reply_photo(photo=InputFile(f))
-
-                await update.message.reply_text(f"✅ Сохранено как `{base_filename}`")
+        await update.message.reply_text(f"✅ Сохранено как `{base_filename}`")
 
+    except ApiError as e:
+        await update.message.reply_text(f"❌ Ошибка генерации изображения: {e}")
     except Exception as e:
         await update.message.reply_text(f"🚨 Ошибка: {e}")
 
+# Закрытие пула соединений к API при остановке бота
+async def close_api_client(application):
+    await api_client.close()
+
 # Создание приложения бота
-app = ApplicationBuilder().token(TOKEN2).build()
+app = ApplicationBuilder().token(TOKEN2).post_shutdown(close_api_client).build()
 
 # Добавление обработчика команды
 app.add_handler(CommandHandler("generate", generate))
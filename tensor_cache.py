@@ -0,0 +1,116 @@
+import threading
+from collections import OrderedDict
+
+
+def tensor_bytes(tensor):
+    return tensor.numel() * tensor.element_size()
+
+
+class TensorLRUCache:
+    """
+    Потокобезопасный LRU-кэш, пополняемый батчами: общая основа кэшей эмбеддингов промптов (prompt_cache),
+    латентов и декодированных референсов (references).
+    - Для тензоров: каждая запись — тензор с ведущей размерностью 1; lookup выдаёт один тензор на весь батч,
+      а промахи батча (без повторов) вычисляет одним вызовом encode.
+    - Для любых значений — поштучно через get и put; размер записи считает size(value).
+    - Объём ограничен max_bytes, вытесняются давно не использованные записи, кроме закреплённых.
+    """
+
+    def __init__(self, max_bytes, size=tensor_bytes):
+        self.max_bytes = max_bytes
+        self.size = size
+        self.entries = OrderedDict()  # ключ -> значение (тензор (1, ...) для lookup)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.pinned = set()  # ключи, которые никогда не вытесняются
+        self.lock = threading.Lock()
+
+    def lookup(self, keys, encode):
+        """
+        Возвращает тензоры для ключей одним тензором (len(keys), ...).
+        encode(rows) вычисляет промахи: rows — индексы первых вхождений отсутствующих ключей,
+        результат — тензор (len(rows), ...) в том же порядке.
+        """
+        import torch
+
+        with self.lock:
+            missing = {}  # key -> индекс первой строки с этим ключом
+            for i, key in enumerate(keys):
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                elif key in missing:
+                    self.hits += 1
+                else:
+                    missing[key] = i
+                    self.misses += 1
+
+            if missing:
+                encoded = encode(list(missing.values()))
+                for row, key in enumerate(missing):
+                    tensor = encoded[row:row + 1]
+                    self.entries[key] = tensor
+                    self.total_bytes += self.size(tensor)
+
+            result = torch.cat([self.entries[key] for key in keys])
+            self._evict()
+        return result
+
+    def get(self, key):
+        """
+        Возвращает значение по ключу или None.
+        """
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Сохраняет значение; уже сохранённое по этому ключу не заменяется, а больше max_bytes — не сохраняется.
+        """
+        size = self.size(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = value
+            self.total_bytes += size
+            self._evict()
+
+    def _evict(self):
+        victims = (key for key in list(self.entries) if key not in self.pinned)
+        while self.total_bytes > self.max_bytes:
+            key = next(victims, None)
+            if key is None:
+                break
+            self.total_bytes -= self.size(self.entries.pop(key))
+
+    def pin(self, keys):
+        with self.lock:
+            self.pinned.update(keys)
+
+    def to(self, device):
+        """
+        Переносит сохранённые тензоры на device — вслед за моделью, которая их вычисляет (см. models.ModelManager).
+        """
+        with self.lock:
+            for key, tensor in self.entries.items():
+                self.entries[key] = tensor.to(device)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
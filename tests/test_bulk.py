@@ -0,0 +1,86 @@
+import io
+import json
+import os
+import tarfile
+
+from bulk import MANIFEST_NAME, BulkRun, parse_rows
+
+ROWS = b"\n".join(json.dumps({"prompt": f"prompt {key}", "key": key, "seed": seed}).encode("utf-8")
+                  for seed, key in enumerate("abcd"))
+
+
+def sample_files(sample):
+    return {".png": sample.key.encode("utf-8") * 600, ".txt": sample.prompt.encode("utf-8")}
+
+
+def tar_names(path):
+    with tarfile.open(path) as tar:
+        return tar.getnames()
+
+
+def test_recover_truncates_cut_tar_member_and_resumes(tmp_path):
+    root = str(tmp_path / "run")
+    run = BulkRun.create(root, parse_rows(ROWS, "rows.jsonl"), output="tar", shard_size=3)
+    samples = {sample.key: sample for sample in run.samples()}
+    for key in "ab":
+        run.write(samples[key], sample_files(samples[key]))
+
+    # Сбой посреди образца c: его член архива оборван, строка манифеста не дописана
+    shard_path = os.path.join(root, "shard-000000.tar")
+    end = os.path.getsize(shard_path)
+    data = sample_files(samples["c"])[".png"]
+    info = tarfile.TarInfo("c.png")
+    info.size = len(data)
+    run.tar.addfile(info, io.BytesIO(data))
+    run.tar_file.flush()
+    run.manifest.write('{"key": "c", "shard": "shard-')
+    run.manifest.flush()
+    run.tar_file.close()
+    run.manifest.close()
+    with open(shard_path, "r+b") as f:
+        f.truncate(end + 512 + len(data) // 2)
+
+    resumed = BulkRun.open(root)
+    assert resumed.recover() == {"a", "b"}
+    assert tar_names(shard_path) == ["a.png", "a.txt", "b.png", "b.txt"]
+    with open(os.path.join(root, MANIFEST_NAME), encoding="utf-8") as f:
+        assert [json.loads(line)["key"] for line in f] == ["a", "b"]
+
+    remaining = [sample for sample in resumed.samples() if sample.key not in resumed.done]
+    assert [sample.key for sample in remaining] == ["c", "d"]
+    for sample in remaining:
+        resumed.write(sample, sample_files(sample))
+    resumed.close()
+
+    # Возобновлённый прогон пишет в новый шард, старый остаётся целым
+    assert tar_names(shard_path) == ["a.png", "a.txt", "b.png", "b.txt"]
+    assert tar_names(os.path.join(root, "shard-000001.tar")) == ["c.png", "c.txt", "d.png", "d.txt"]
+    with open(os.path.join(root, MANIFEST_NAME), encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f]
+    assert [(entry["key"], entry["shard"]) for entry in entries] == [
+        ("a", "shard-000000.tar"), ("b", "shard-000000.tar"), ("c", "shard-000001.tar"), ("d", "shard-000001.tar"),
+    ]
+    with tarfile.open(os.path.join(root, "shard-000001.tar")) as tar:
+        assert tar.extractfile("c.png").read() == sample_files(samples["c"])[".png"]
+
+
+def test_recover_removes_shard_without_finished_samples(tmp_path):
+    root = str(tmp_path / "run")
+    run = BulkRun.create(root, parse_rows(ROWS, "rows.jsonl"), output="tar", shard_size=1)
+    samples = run.samples()
+    run.write(samples[0], sample_files(samples[0]))
+    run.write(samples[1], sample_files(samples[1]))
+    run.close()
+    # Манифест потерял последнюю запись — её шард больше ничему не соответствует
+    path = os.path.join(root, MANIFEST_NAME)
+    with open(path, "rb") as f:
+        first_line = f.readline()
+    with open(path, "wb") as f:
+        f.write(first_line)
+
+    resumed = BulkRun.open(root)
+    assert resumed.recover() == {"a"}
+    assert sorted(os.listdir(root)) == ["config.json", "manifest.jsonl", "rows.jsonl", "shard-000000.tar"]
+    resumed.write(samples[1], sample_files(samples[1]))
+    resumed.close()
+    assert tar_names(os.path.join(root, "shard-000001.tar")) == ["b.png", "b.txt"]
@@ -0,0 +1,80 @@
+from dataclasses import dataclass
+
+from fair_queue import Client, FairQueue
+
+
+@dataclass
+class Item:
+    name: str
+    client: Client
+    num_images: int = 1
+
+
+def drain(queue):
+    names = []
+    while (item := queue.pop()) is not None:
+        names.append(item.name)
+        queue.release([item])
+    return names
+
+
+def test_backlog_of_one_client_does_not_delay_another():
+    queue = FairQueue()
+    bot, user = Client("bot"), Client("user")
+    for i in range(3):
+        queue.put(Item(f"bot{i}", bot))
+    queue.put(Item("user0", user))
+    assert drain(queue) == ["bot0", "user0", "bot1", "bot2"]
+
+
+def test_weight_scales_share_of_images():
+    queue = FairQueue()
+    heavy, light = Client("heavy", weight=2.0), Client("light")
+    for i in range(4):
+        queue.put(Item(f"heavy{i}", heavy))
+    for i in range(2):
+        queue.put(Item(f"light{i}", light))
+    # finish: heavy — 0.5, 1, 1.5, 2; light — 1, 2
+    assert drain(queue) == ["heavy0", "heavy1", "light0", "heavy2", "heavy3", "light1"]
+
+
+def test_priority_classes_are_strict():
+    queue = FairQueue()
+    queue.put(Item("low", Client("a", priority="low")))
+    queue.put(Item("normal", Client("b")))
+    queue.put(Item("high", Client("c", priority="high", weight=0.1), num_images=8))
+    assert drain(queue) == ["high", "normal", "low"]
+
+
+def test_max_in_flight_skips_busy_client_until_release():
+    queue = FairQueue(max_in_flight=2)
+    bot, user = Client("bot"), Client("user")
+    queue.put(Item("bot0", bot, num_images=2))
+    queue.put(Item("bot1", bot, num_images=2))
+    queue.put(Item("user0", user, num_images=2))
+
+    first = queue.pop()
+    assert first.name == "bot0"
+    # У bot в работе уже 2 изображения — его следующий запрос ждёт
+    assert queue.pop().name == "user0"
+    assert queue.pop() is None
+    queue.release([first])
+    assert queue.pop().name == "bot1"
+
+
+def test_request_larger_than_max_in_flight_passes_when_client_idle():
+    queue = FairQueue(max_in_flight=2)
+    queue.put(Item("big", Client("bot"), num_images=4))
+    assert queue.pop().name == "big"
+
+
+def test_position_counts_images_ahead_in_service_order():
+    queue = FairQueue()
+    bot, user = Client("bot"), Client("user")
+    queue.put(Item("bot0", bot, num_images=3))
+    queue.put(Item("bot1", bot, num_images=3))
+    queue.put(Item("user0", user, num_images=1))
+    # user0 (finish 1) обслуживается раньше bot0 (finish 3)
+    assert queue.position(lambda item: item.name == "user0") == 0
+    assert queue.position(lambda item: item.name == "bot1") == 4
+    assert queue.position(lambda item: item.name == "missing") is None
@@ -0,0 +1,101 @@
+import bisect
+import threading
+from collections import deque
+
+# Сколько последних замеров каждой стадии хранить для перцентилей
+TIMINGS_WINDOW = 2048
+# Границы корзин гистограмм в секундах (формат Prometheus, последняя корзина — +Inf)
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class StageTimings:
+    """
+    Длительности стадий генерации (ожидание в очереди, инференс, апскейл, кодирование PNG).
+    - Для каждой стадии считаются количество, сумма и максимум за всё время.
+    - Перцентили считаются по последним window замерам.
+    - Для /metrics ведутся кумулятивные гистограммы по корзинам buckets.
+    - Пишется из разных потоков, поэтому под блокировкой.
+    """
+
+    def __init__(self, window=TIMINGS_WINDOW, buckets=HISTOGRAM_BUCKETS):
+        self.window = window
+        self.buckets = tuple(buckets)
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds, count=1):
+        """
+        Добавляет замер стадии; count — сколько изображений он покрывает (для батчей).
+        """
+        with self.lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = {"count": 0, "images": 0, "total": 0.0, "max": 0.0,
+                                              "recent": deque(maxlen=self.window),
+                                              "buckets": [0] * (len(self.buckets) + 1)}
+            stats["buckets"][bisect.bisect_left(self.buckets, seconds)] += 1
+            stats["count"] += 1
+            stats["images"] += count
+            stats["total"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+            stats["recent"].append(seconds)
+
+    def reset(self):
+        with self.lock:
+            self.stages.clear()
+
+    def stats(self):
+        with self.lock:
+            result = {}
+            for stage, stats in self.stages.items():
+                recent = sorted(stats["recent"])
+                result[stage] = {
+                    "count": stats["count"],
+                    "images": stats["images"],
+                    "total": stats["total"],
+                    "mean": stats["total"] / stats["count"],
+                    "max": stats["max"],
+                    "p50": percentile(recent, 0.5),
+                    "p95": percentile(recent, 0.95),
+                    "p99": percentile(recent, 0.99),
+                }
+            return result
+
+    def prometheus(self, name):
+        """
+        Гистограммы стадий в текстовом формате Prometheus, метка stage — имя стадии.
+        """
+        lines = [f"# HELP {name} Длительность стадий генерации в секундах", f"# TYPE {name} histogram"]
+        with self.lock:
+            for stage, stats in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), stats["buckets"]):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {stats["total"]}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {stats["count"]}')
+        return lines
+
+
+def prometheus_gauge(name, help_text, values):
+    """
+    Метрика-gauge в текстовом формате Prometheus.
+    values — число либо словарь {метки: значение}, где метки — кортеж пар (имя, значение).
+    """
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    if not isinstance(values, dict):
+        values = {(): values}
+    for labels, value in values.items():
+        if value is None:
+            continue
+        label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+        lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    return lines
@@ -0,0 +1,112 @@
+import logging
+import os
+import threading
+
+import cv2
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger("FastAPI")
+
+# Веса Real-ESRGAN: по умолчанию аниме-модель, она лучше всего подходит к AnythingV3
+REALESRGAN_MODEL_PATH = os.getenv("REALESRGAN_MODEL_PATH", os.path.join("weights", "RealESRGAN_x4plus_anime_6B.pth"))
+# Размер тайла Real-ESRGAN (0 — без тайлинга); тайлы ограничивают пиковую память
+REALESRGAN_TILE = int(os.getenv("REALESRGAN_TILE", "256"))
+# Устройство для Real-ESRGAN: "cuda" или "cpu"
+REALESRGAN_DEVICE = os.getenv("REALESRGAN_DEVICE", "cuda")
+
+
+class NoneUpscaler:
+    """
+    Возвращает изображение как есть.
+    """
+
+    def upscale(self, image, scale):
+        return image
+
+
+class Cv2Upscaler:
+    """
+    Интерполяция OpenCV (cubic / Lanczos) прямо по массиву в памяти.
+    """
+
+    def __init__(self, interpolation):
+        self.interpolation = interpolation
+
+    def upscale(self, image, scale):
+        if scale == 1:
+            return image
+        image_np = np.asarray(image.convert("RGB"))
+        height, width = image_np.shape[:2]
+        upscaled_np = cv2.resize(image_np, (width * scale, height * scale), interpolation=self.interpolation)
+        return Image.fromarray(upscaled_np)
+
+
+class RealESRGANUpscaler:
+    """
+    Real-ESRGAN с тайлингом. Модель загружается при первом использовании.
+    На CPU работает в fp32, на CUDA — в fp16.
+    """
+
+    def __init__(self, model_path=REALESRGAN_MODEL_PATH, tile=REALESRGAN_TILE, device=REALESRGAN_DEVICE):
+        self.model_path = model_path
+        self.tile = tile
+        self.device = device
+        self.upsampler = None
+        # RealESRGANer держит промежуточные тензоры в атрибутах, поэтому вызовы сериализуем
+        self.lock = threading.Lock()
+
+    def _load(self):
+        import torch
+        from basicsr.archs.rrdbnet_arch import RRDBNet
+        from realesrgan import RealESRGANer
+
+        device = self.device
+        if device == "cuda" and not torch.cuda.is_available():
+            logger.warning("CUDA недоступна, Real-ESRGAN будет работать на CPU")
+            device = "cpu"
+
+        model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=6, num_grow_ch=32, scale=4)
+        self.upsampler = RealESRGANer(
+            scale=4,
+            model_path=self.model_path,
+            model=model,
+            tile=self.tile,
+            tile_pad=10,
+            pre_pad=0,
+            half=device == "cuda",
+            device=torch.device(device),
+        )
+        logger.info(f"Real-ESRGAN загружен: {self.model_path} на {device}, тайл {self.tile}")
+
+    def upscale(self, image, scale):
+        with self.lock:
+            if self.upsampler is None:
+                self._load()
+            # RealESRGANer работает с BGR-массивами, как cv2
+            image_bgr = cv2.cvtColor(np.asarray(image.convert("RGB")), cv2.COLOR_RGB2BGR)
+            output_bgr, _ = self.upsampler.enhance(image_bgr, outscale=scale)
+        return Image.fromarray(cv2.cvtColor(output_bgr, cv2.COLOR_BGR2RGB))
+
+
+UPSCALER_FACTORIES = {
+    "none": NoneUpscaler,
+    "cubic": lambda: Cv2Upscaler(cv2.INTER_CUBIC),
+    "lanczos": lambda: Cv2Upscaler(cv2.INTER_LANCZOS4),
+    "realesrgan": RealESRGANUpscaler,
+}
+
+_upscalers = {}
+_upscalers_lock = threading.Lock()
+
+
+def get_upscaler(name):
+    """
+    Возвращает экземпляр апскейлера по имени; экземпляры создаются один раз.
+    """
+    if name not in UPSCALER_FACTORIES:
+        raise ValueError(f"Неизвестный апскейлер: {name}. Доступны: {', '.join(UPSCALER_FACTORIES)}")
+    with _upscalers_lock:
+        if name not in _upscalers:
+            _upscalers[name] = UPSCALER_FACTORIES[name]()
+        return _upscalers[name]